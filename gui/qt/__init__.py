@@ -153,7 +153,8 @@ class ElectrumGui:
                 w.bring_to_top()
                 break
         else:
-            wallet = self.daemon.load_wallet(path, self.get_wizard)
+            # the daemon keeps the wallet loaded while its window is open
+            wallet = self.daemon.load_wallet(path, self.get_wizard, pin=True)
             if not wallet:
                 return
             w = self.create_window_for_wallet(wallet)
@@ -165,6 +166,7 @@ class ElectrumGui:
 
     def close_window(self, window):
         self.windows.remove(window)
+        self.daemon.wallets.unpin(window.wallet.storage.path)
         self.build_tray_menu()
         # save wallet path of last open window
         if self.config.get('wallet_path') is None and not self.windows:
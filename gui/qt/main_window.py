@@ -477,12 +477,15 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
             return
         self.print_error("Notifying GUI")
         if len(self.tx_notifications) > 0:
+            tx_hashes = [tx.hash() for tx in self.tx_notifications if tx]
+            deltas = self.wallet.get_wallet_deltas([tx_hash for tx_hash in tx_hashes
+                                                    if tx_hash in self.wallet.transactions])
             # Combine the transactions if there are more then three
             tx_amount = len(self.tx_notifications)
             if(tx_amount >= 3):
                 total_amount = 0
-                for tx in self.tx_notifications:
-                    is_relevant, is_mine, v, fee = self.wallet.get_wallet_delta(tx)
+                for tx_hash in tx_hashes:
+                    is_relevant, is_mine, v, fee = deltas.get(tx_hash, (False, False, 0, None))
                     if(v > 0):
                         total_amount += v
                 self.notify(_("%(txs)s new transactions received. Total amount received in the new transactions %(amount)s") \
@@ -492,7 +495,7 @@ class ElectrumWindow(QMainWindow, MessageBoxMixin, PrintError):
               for tx in self.tx_notifications:
                   if tx:
                       self.tx_notifications.remove(tx)
-                      is_relevant, is_mine, v, fee = self.wallet.get_wallet_delta(tx)
+                      is_relevant, is_mine, v, fee = deltas.get(tx.hash(), (False, False, 0, None))
                       if(v > 0):
                           self.notify(_("New transaction received. %(amount)s") % { 'amount' : self.format_amount_and_units(v)})
 
@@ -193,11 +193,11 @@ class ElectrumGui:
             return
 
         if self.str_description:
-            self.wallet.labels[tx.hash()] = self.str_description
+            self.wallet.set_label(tx.hash(), self.str_description)
 
         h = self.wallet.send_tx(tx)
         print(_("Please wait..."))
-        self.wallet.tx_event.wait()
+        self.wallet.wait_tx(h)
         status, msg = self.wallet.receive_tx( h, tx )
 
         if status:
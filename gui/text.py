@@ -277,7 +277,7 @@ class ElectrumGui:
             elif out == "Edit label":
                 s = self.get_string(6 + self.pos, 18)
                 if s:
-                    self.wallet.labels[address] = s
+                    self.wallet.set_label(address, s)
 
     def run_banner_tab(self, c):
         self.show_message(repr(c))
@@ -335,11 +335,11 @@ class ElectrumGui:
             return
 
         if self.str_description:
-            self.wallet.labels[tx.hash()] = self.str_description
+            self.wallet.set_label(tx.hash(), self.str_description)
 
         h = self.wallet.send_tx(tx)
         self.show_message(_("Please wait..."), getchar=False)
-        self.wallet.tx_event.wait()
+        self.wallet.wait_tx(h)
         status, msg = self.wallet.receive_tx( h, tx )
 
         if status:
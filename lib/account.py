@@ -16,6 +16,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+
 import lbrycrd
 from lbrycrd import *
 from i18n import _
@@ -27,9 +29,15 @@ class Account(object):
     def __init__(self, v):
         self.receiving_pubkeys = v.get('receiving', [])
         self.change_pubkeys = v.get('change', [])
-        # addresses will not be stored on disk
-        self.receiving_addresses = map(self.pubkeys_to_address, self.receiving_pubkeys)
-        self.change_addresses = map(self.pubkeys_to_address, self.change_pubkeys)
+        # addresses are not part of the dump; the wallet may pass the lists
+        # it saved separately so that they are not derived again
+        self.receiving_addresses = self.load_addresses(self.receiving_pubkeys, v.get('receiving_addresses'))
+        self.change_addresses = self.load_addresses(self.change_pubkeys, v.get('change_addresses'))
+
+    def load_addresses(self, pubkeys, addresses):
+        if addresses is not None and len(addresses) == len(pubkeys):
+            return list(addresses)
+        return map(self.pubkeys_to_address, pubkeys)
 
     def dump(self):
         return {'receiving': self.receiving_pubkeys, 'change': self.change_pubkeys}
@@ -101,12 +109,20 @@ class Account(object):
 class ImportedAccount(Account):
     def __init__(self, d):
         self.keypairs = d['imported']
+        # sorted keys of keypairs, kept up to date by add and remove
+        self.addresses = sorted(self.keypairs.keys())
 
     def synchronize(self, wallet):
         return
 
     def get_addresses(self, for_change):
-        return [] if for_change else sorted(self.keypairs.keys())
+        return [] if for_change else self.addresses
+
+    def get_address_sequence(self, address):
+        i = bisect.bisect_left(self.addresses, address)
+        if i == len(self.addresses) or self.addresses[i] != address:
+            raise Exception("Address not found", address)
+        return 0, i
 
     def get_pubkey(self, *sequence):
         for_change, i = sequence
@@ -133,10 +149,13 @@ class ImportedAccount(Account):
 
     def add(self, address, pubkey, privkey, password):
         from wallet import pw_encode
+        if address not in self.keypairs:
+            bisect.insort(self.addresses, address)
         self.keypairs[address] = (pubkey, pw_encode(privkey, password))
 
     def remove(self, address):
         self.keypairs.pop(address)
+        del self.addresses[bisect.bisect_left(self.addresses, address)]
 
     def dump(self):
         return {'imported': self.keypairs}
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+#
+# LBRYum - lightweight LBRYcrd client
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from collections import deque
+
+from lbrycrd import Hash, hash_encode
+from transaction import Transaction
+from util import ThreadJob
+from wallet import history_status, SAVE_INTERVAL
+
+# addresses subscribed on each run, so that a large set of addresses
+# does not hold up the other requests to the server
+SUBSCRIBE_BATCH = 1000
+# seconds before the transactions that could not be fetched are
+# requested again
+TX_RETRY_INTERVAL = 60
+
+
+class AddressMonitor(ThreadJob):
+    '''Watches a large set of addresses for deposits, without a wallet.
+
+    The history of each address is kept in storage under 'watch_state',
+    as a list of [tx_hash, height].  Its status is computed from it, so
+    addresses whose status announced by the server did not change are
+    not asked for their history.  Addresses are subscribed in batches of
+    SUBSCRIBE_BATCH.
+
+    Deposits are reported with the 'deposit' network event, whose
+    argument is a dict with the address, tx_hash, height and amount (the
+    value of the outputs of the transaction to the address).  A deposit
+    is reported when its transaction is first seen, and again once it
+    is confirmed.  Transactions that could not be fetched are requested
+    again every TX_RETRY_INTERVAL seconds, so their deposits are not
+    lost once the history that lists them is saved.
+    '''
+
+    def __init__(self, network, storage):
+        self.network = network
+        self.storage = storage
+        # the state is changed in place, holding the storage lock
+        self.lock = storage.lock
+        self.state = storage.get('watch_state', {}, copy=False)
+        storage.put('watch_state', self.state, copy=False)
+        # addresses left to subscribe
+        self.pending = deque(sorted(self.state))
+        # address -> status announced, for histories requested
+        self.requested = {}
+        # tx hash -> list of (address, height) of the deposits waiting for it
+        self.requested_tx = {}
+        # tx hash -> deposits waiting for it, whose request failed
+        self.failed_tx = {}
+        self.last_retry = time.time()
+        self.last_save = time.time()
+
+    def add_addresses(self, addresses):
+        with self.lock:
+            added = [addr for addr in addresses if addr not in self.state]
+            for addr in added:
+                self.state[addr] = []
+            self.pending.extend(added)
+        self.storage.put('watch_state', self.state, copy=False)
+
+    def remove_addresses(self, addresses):
+        # servers cannot unsubscribe; their notifications are ignored
+        with self.lock:
+            removed = [addr for addr in addresses if self.state.pop(addr, None) is not None]
+        if removed:
+            self.storage.put('watch_state', self.state, copy=False)
+
+    def get_history(self, address):
+        with self.lock.read():
+            return [tuple(item) for item in self.state.get(address, [])]
+
+    def run(self):
+        '''Called from the network proxy thread main loop.'''
+        with self.lock:
+            batch = [self.pending.popleft() for i in range(min(SUBSCRIBE_BATCH, len(self.pending)))]
+        if batch:
+            self.network.send([('blockchain.address.subscribe', [addr]) for addr in batch],
+                              self.addr_subscription_response)
+        if self.failed_tx and time.time() - self.last_retry >= TX_RETRY_INTERVAL:
+            self.retry_transactions()
+        if time.time() - self.last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self.last_save = time.time()
+        # without a state file, the state is only kept in memory
+        if self.storage.path:
+            self.storage.write()
+
+    def addr_subscription_response(self, response):
+        if response.get('error'):
+            self.print_error("response error:", response)
+            return
+        addr = response['params'][0]
+        status = response['result']
+        with self.lock:
+            if addr not in self.state:
+                return
+            if addr in self.requested:
+                # checked when the history requested arrives
+                self.requested[addr] = status
+                return
+            if history_status(self.state[addr]) == status:
+                return
+            self.requested[addr] = status
+        self.network.send([('blockchain.address.get_history', [addr])], self.addr_history_response)
+
+    def addr_history_response(self, response):
+        params = response['params']
+        addr = params[0]
+        if response.get('error'):
+            self.print_error("response error:", response)
+            with self.lock:
+                self.requested.pop(addr, None)
+            return
+        hist = [[item['tx_hash'], item['height']] for item in response['result']]
+        with self.lock:
+            old = self.state.get(addr)
+            if old is None:
+                self.requested.pop(addr, None)
+                return
+            if history_status(hist) != self.requested.get(addr):
+                # the status changed since the request was sent
+                retry = True
+            else:
+                retry = False
+                self.requested.pop(addr)
+                known = dict(old)
+                self.state[addr] = hist
+        if retry:
+            self.network.send([('blockchain.address.get_history', [addr])], self.addr_history_response)
+            return
+        self.storage.put('watch_state', self.state, copy=False)
+        for tx_hash, height in hist:
+            if tx_hash not in known or (height > 0 and known[tx_hash] <= 0):
+                self.request_deposit(addr, tx_hash, height)
+
+    def request_deposit(self, addr, tx_hash, height):
+        self.request_deposits(tx_hash, [(addr, height)])
+
+    def request_deposits(self, tx_hash, deposits):
+        with self.lock:
+            waiting = self.requested_tx.setdefault(tx_hash, [])
+            sent = bool(waiting)
+            waiting.extend(deposits)
+            if sent:
+                return
+        self.network.send([('blockchain.transaction.get', [tx_hash])], self.tx_response)
+
+    def retry_transactions(self):
+        self.last_retry = time.time()
+        with self.lock:
+            failed, self.failed_tx = self.failed_tx, {}
+        for tx_hash, deposits in failed.items():
+            self.request_deposits(tx_hash, deposits)
+
+    def tx_response(self, response):
+        tx_hash = response['params'][0]
+        with self.lock:
+            waiting = self.requested_tx.pop(tx_hash, [])
+        if response.get('error'):
+            self.print_error("response error:", response)
+            self.tx_failed(tx_hash, waiting)
+            return
+        raw = response['result']
+        if hash_encode(Hash(raw.decode('hex'))) != tx_hash:
+            self.print_error("transaction does not match its hash", tx_hash)
+            self.tx_failed(tx_hash, waiting)
+            return
+        outputs = Transaction(raw).get_outputs()
+        for addr, height in waiting:
+            amount = sum(v for a, v in outputs if a == addr)
+            if amount:
+                self.network.trigger_callback('deposit', {
+                    'address': addr,
+                    'tx_hash': tx_hash,
+                    'height': height,
+                    'amount': amount,
+                })
+
+    def tx_failed(self, tx_hash, waiting):
+        with self.lock:
+            if not self.failed_tx:
+                self.last_retry = time.time()
+            self.failed_tx.setdefault(tx_hash, []).extend(waiting)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+# LBRYum - lightweight LBRYcrd client
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import time
+from functools import partial
+
+from util import ThreadJob
+
+# seconds between two looks at the queue
+CHECK_INTERVAL = 5
+# first retry delay, doubled after each attempt
+RETRY_INTERVAL = 30
+MAX_RETRY_INTERVAL = 30 * 60
+# attempts after which a transaction that did not show up is dropped
+MAX_ATTEMPTS = 10
+
+
+def is_rejected(tx_hash, response):
+    '''Whether the answer of a server to the broadcast of tx_hash
+    refuses the transaction.  Servers report the reason either as the
+    result or as an error.  A transaction the node already knows about
+    is not refused.'''
+    out = response.get('error') or response.get('result')
+    return out != tx_hash and 'already' not in str(out)
+
+
+class Broadcaster(ThreadJob):
+    '''The broadcaster retries sending the wallet's outgoing transactions
+    until they show up in the history of a wallet address, and drops
+    them from the queue once they are confirmed.  Transactions refused
+    by the main server, or still unseen after MAX_ATTEMPTS attempts,
+    are dropped too.
+
+    Retries are sent to the main interface and to every other
+    connected server, with exponential backoff.  The queue itself is
+    stored in the wallet (see Abstract_Wallet.add_pending_broadcast).
+    '''
+
+    def __init__(self, wallet, network):
+        self.wallet = wallet
+        self.network = network
+        self.next_check = 0
+
+    def retry_delay(self, attempts):
+        return min(MAX_RETRY_INTERVAL, RETRY_INTERVAL * 2 ** attempts)
+
+    def run(self):
+        '''Called from the network proxy thread main loop.'''
+        now = time.time()
+        if now < self.next_check:
+            return
+        self.next_check = now + CHECK_INTERVAL
+        for item in self.wallet.get_pending_broadcasts():
+            tx_hash = item['txid']
+            if item['seen']:
+                if not self.wallet.is_unconfirmed(tx_hash):
+                    self.print_error("broadcast confirmed", tx_hash)
+                    self.wallet.remove_pending_broadcast(tx_hash)
+                continue
+            if now < item['next_try'] or not self.network.interface:
+                continue
+            if item['attempts'] >= MAX_ATTEMPTS:
+                self.print_error("giving up broadcast", tx_hash)
+                self.wallet.remove_pending_broadcast(tx_hash)
+                continue
+            self.broadcast(tx_hash, item['tx'])
+            self.wallet.reschedule_broadcast(tx_hash, now + self.retry_delay(item['attempts']))
+
+    def broadcast(self, tx_hash, raw):
+        self.print_error("rebroadcasting", tx_hash)
+        params = [raw]
+        self.network.send([('blockchain.transaction.broadcast', params)],
+                          partial(self.on_broadcast, tx_hash))
+        # other servers are sent the transaction too, their answer is ignored
+        for interface in self.network.interfaces.values():
+            if interface != self.network.interface:
+                self.network.queue_request('blockchain.transaction.broadcast', params, interface)
+
+    def on_broadcast(self, tx_hash, response):
+        if is_rejected(tx_hash, response):
+            self.print_error("broadcast rejected:", tx_hash, response.get('error') or response.get('result'))
+            self.wallet.remove_pending_broadcast(tx_hash)
+        else:
+            self.print_error("broadcast result:", response.get('result'))
@@ -230,9 +230,9 @@ class CoinChooserOldestFirst(CoinChooserBase):
     def choose_buckets(self, buckets, sufficient_funds, penalty_func):
         '''Spend the oldest buckets first.'''
         # Unconfirmed coins are young, not old
-        adj_height = lambda height: 99999999 if height == 0 else height
-        buckets.sort(key=lambda b: max(adj_height(coin['height'])
-                                       for coin in b.coins))
+        adj_height = lambda coin: 99999999 if coin.get('unconfirmed', coin['height'] <= 0) \
+            else coin['height']
+        buckets.sort(key=lambda b: max(adj_height(coin) for coin in b.coins))
         selected = []
         for bucket in buckets:
             selected.append(bucket)
@@ -40,6 +40,7 @@ import paymentrequest
 from paymentrequest import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 import contacts
 from claims import verify_proof, InvalidProofError
+from wallet import BROADCAST_TIMEOUT
 
 
 log = logging.getLogger(__name__)
@@ -281,10 +282,29 @@ class Commands:
 
     @command('n')
     def broadcast(self, tx):
-        """Broadcast a transaction to the network. """
+        """Broadcast a transaction to the network. Returns the txid, or
+        {"txid": txid, "queued": true} if the server did not answer and the
+        wallet will send the transaction again."""
         t = Transaction(tx)
+        if self.wallet is not None and self.wallet.get_wallet_delta(t)[0]:
+            return self._broadcast(t)
         return self.network.synchronous_get(('blockchain.transaction.broadcast', [str(t)]))
 
+    def _broadcast(self, tx):
+        """Broadcast a wallet transaction.  It is queued in the wallet, so
+        that it is sent again until it shows up in the wallet history.
+
+        Returns the txid once the server accepts it, raises if the server
+        refuses it, and returns {'txid': txid, 'queued': True} if the
+        server did not answer within BROADCAST_TIMEOUT seconds."""
+        success, out = self.wallet.sendtx(tx, BROADCAST_TIMEOUT)
+        if success:
+            return out
+        tx_hash = tx.hash()
+        if tx_hash in self.wallet.pending_broadcasts:
+            return {'txid': tx_hash, 'queued': True}
+        raise BaseException(out[len('error: '):] if out.startswith('error: ') else out)
+
     @command('')
     def createmultisig(self, num, pubkeys):
         """Create multisig address"""
@@ -501,10 +521,10 @@ class Commands:
 
     @command('wpn')
     def paytoandsend(self, destination, amount, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False):
-        """Create and broadcast transaction. """
+        """Create and broadcast transaction. Returns the txid, see broadcast."""
         domain = [from_addr] if from_addr else None
         tx = self._mktx([(destination, amount)], tx_fee, change_addr, domain, nocheck, unsigned)
-        return self.network.synchronous_get(('blockchain.transaction.broadcast', [str(tx)]))
+        return self._broadcast(tx)
 
     @command('wp')
     def paytomany(self, outputs, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False):
@@ -513,19 +533,21 @@ class Commands:
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned)
         return tx.as_dict()
 
-    @command('wp')
+    @command('wpn')
     def paytomanyandsend(self, outputs, tx_fee=None, from_addr=None, change_addr=None, nocheck=False, unsigned=False):
-        """Create and broadcast a multi-output transaction. """
+        """Create and broadcast a multi-output transaction. Returns the txid, see broadcast."""
         domain = [from_addr] if from_addr else None
         tx = self._mktx(outputs, tx_fee, change_addr, domain, nocheck, unsigned)
-        return self.network.synchronous_get(('blockchain.transaction.broadcast', [str(tx)]))
+        return self._broadcast(tx)
 
     @command('w')
-    def history(self):
-        """Wallet history. Returns the transaction history of your wallet."""
-        balance = 0
+    def history(self, limit=None, offset=0, since_height=None, since_txid=None):
+        """Wallet history. Returns the transaction history of your wallet,
+        oldest first. Use limit and offset to page through it, and
+        since_height or since_txid to get only the transactions that came
+        after an earlier call."""
         out = []
-        for item in self.wallet.get_history():
+        for item in self.wallet.get_history_page(limit, offset, since_height, since_txid):
             tx_hash, conf, value, timestamp, balance = item
             try:
                 time_str = datetime.datetime.fromtimestamp(timestamp).isoformat(' ')[:-3]
@@ -538,10 +560,25 @@ class Commands:
                 'date':"%16s"%time_str,
                 'label':label,
                 'value':float(value)/COIN if value is not None else None,
+                'balance':float(balance)/COIN if balance is not None else None,
                 'confirmations':conf}
             )
         return out
 
+    @command('w')
+    def listpendingbroadcasts(self):
+        """List outgoing transactions that are rebroadcast until they confirm."""
+        out = []
+        for item in self.wallet.get_pending_broadcasts():
+            out.append({
+                'txid': item['txid'],
+                'attempts': item['attempts'],
+                'first_sent': item['first_sent'],
+                'next_try': item['next_try'],
+                'seen': item['seen'],
+            })
+        return out
+
     @command('w')
     def setlabel(self, key, label):
         """Assign a label to an item. Item may be a bitcoin address or a
@@ -812,8 +849,12 @@ class Commands:
         return self.network.synchronous_get(('blockchain.claimtrie.getclaimbyid', [claim_id]))
 
     @command('w')
-    def getnameclaims(self):
-        return self.wallet.get_name_claims()
+    def getnameclaims(self, name=None, claim_id=None, category=None, skip_spent=False):
+        """Return the claims, supports and updates of the wallet, optionally
+        only those of a name or claim id, of a category (claim, support or
+        update), or that are not spent."""
+        return self.wallet.get_name_claims(name=name, claim_id=claim_id, category=category,
+                                           include_spent=not skip_spent)
 
     @command('wp')
     def claimname(self, destination, amount, name, val, tx_fee=None, from_addr=None, change_addr=None,
@@ -1144,6 +1185,33 @@ class Commands:
                 return {'success':False,'reason':out}
         return {'success':True,'txid':tx.hash(),'tx':str(tx),'fee':str(Decimal(tx.get_fee())/COIN)}
 
+    @command('wpn')
+    def renewclaims(self, tx_fee=None):
+        """Renew the claims the wallet queued for renewal as they came close
+        to expiring. Each claim is updated with its name and value, and
+        keeps its amount minus the fee. The updates are sent by the
+        broadcaster; a claim stays queued, and is renewed again later,
+        until it is spent. A claim is not renewed again while its last
+        renewal is waiting to be broadcast. Renewals keep the address of
+        the claim."""
+        out = []
+        for claim in self.wallet.get_claim_renewals():
+            tx_hash = None
+            try:
+                result = self.update(claim['txid'], claim['nout'], claim['name'], claim['claim_id'],
+                                     claim['value'], None, broadcast=False, claim_addr=claim['address'],
+                                     tx_fee=tx_fee, change_addr=claim['address'])
+            except BaseException as e:
+                result = {'success': False, 'reason': str(e)}
+            if result['success']:
+                tx = Transaction(result['tx'])
+                tx_hash = tx.hash()
+                self.wallet.add_pending_broadcast(tx, time.time())
+            self.wallet.reschedule_claim_renewal('%s:%d' % (claim['txid'], claim['nout']), tx_hash)
+            result['claim_id'] = claim['claim_id']
+            out.append(result)
+        return out
+
 param_descriptions = {
     'privkey': 'Private key. Type \'?\' to get a prompt.',
     'destination': 'Bitcoin address, contact or alias',
@@ -1193,7 +1261,15 @@ command_options = {
     'exclude_claimtrietx':(None,"--exclude_claimtrietx", "Exclude claimtrie transactions"),
     'return_addr': (None, "--return_addr", "Return address where amounts in abandoned claimtrie transactions are returned."),
     'claim_addr':  (None, "--claim_addr",  "Address where claims are sent."),
-    'broadcast':   (None, "--broadcast",   "if True, broadcast the transaction")
+    'broadcast':   (None, "--broadcast",   "if True, broadcast the transaction"),
+    'limit':       (None, "--limit",       "Maximum number of items to return"),
+    'offset':      (None, "--offset",      "Number of items to skip"),
+    'since_height':(None, "--since_height", "Only return transactions at or above this height, and unconfirmed ones"),
+    'since_txid':  (None, "--since_txid",  "Only return transactions that come after this one"),
+    'name':        (None, "--name",        "Only return items of this name"),
+    'claim_id':    (None, "--claim_id",    "Only return items of this claim id"),
+    'category':    (None, "--category",    "Only return items of this category"),
+    'skip_spent':  (None, "--skip_spent",  "Do not return spent items"),
 }
 
 
@@ -1202,6 +1278,9 @@ json_loads = lambda x: json.loads(x, parse_float=lambda x: str(Decimal(x)))
 arg_types = {
     'num': int,
     'nbits': int,
+    'limit': int,
+    'offset': int,
+    'since_height': int,
     'entropy': long,
     'tx': json_loads,
     'pubkeys': json_loads,
@@ -1280,7 +1359,10 @@ def get_parser():
     add_network_options(parser_gui)
     # daemon
     parser_daemon = subparsers.add_parser('daemon', parents=[parent_parser], help="Run Daemon")
-    parser_daemon.add_argument("subcommand", choices=['start', 'status', 'stop'])
+    parser_daemon.add_argument("subcommand", choices=['start', 'status', 'stop', 'profile'])
+    parser_daemon.add_argument("profile_action", nargs='?', choices=['start', 'stop', 'reset', 'stats', 'dump'],
+                               help="profile: start or stop profiling, reset or show the statistics, "
+                                    "or write the cProfile data to pstats files")
     #parser_daemon.set_defaults(func=run_daemon)
     add_network_options(parser_daemon)
     # commands
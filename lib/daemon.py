@@ -17,12 +17,17 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 import ast, os
+import cProfile
+import threading
+import time
 
 import jsonrpclib
 from jsonrpclib.SimpleJSONRPCServer import SimpleJSONRPCServer, SimpleJSONRPCRequestHandler
 
-from util import json_decode, DaemonThread
+from util import json_decode, DaemonThread, ThreadJob
+from profiling import PROFILER
 from wallet import WalletStorage, Wallet
+from wallet_manager import WalletManager
 from wizard import WizardBase
 from commands import known_commands, Commands
 from simple_config import SimpleConfig
@@ -47,6 +52,63 @@ def get_daemon(config):
         pass
 
 
+class ThreadProfiler(ThreadJob):
+    '''Runs cProfile in the thread whose jobs it is added to, while
+    PROFILER is enabled.  cProfile only sees the thread that enables it,
+    so the profile is started, stopped and written from run().'''
+
+    def __init__(self, name):
+        self.name = name
+        self.profile = None
+        self.running = False
+        self.thread = None
+        self.lock = threading.Lock()
+        # (path, event) of the dumps asked for
+        self.dumps = []
+
+    def diagnostic_name(self):
+        return 'ThreadProfiler %s' % self.name
+
+    def run(self):
+        '''Called from the thread's main loop.'''
+        self.thread = threading.current_thread()
+        if PROFILER.enabled and not self.running:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            self.running = True
+        elif not PROFILER.enabled and self.running:
+            self.profile.disable()
+            self.running = False
+        with self.lock:
+            dumps, self.dumps = self.dumps, []
+        for path, done in dumps:
+            self.write(path)
+            done.set()
+
+    def write(self, path):
+        if self.profile is None:
+            return
+        # dump_stats stops the profile
+        self.profile.dump_stats(path)
+        if self.running:
+            self.profile.enable()
+        self.print_error("wrote", path)
+
+    def dump(self, path, timeout=10):
+        '''Write the profile collected so far to path, in the pstats
+        format.  Returns False if there is no profile or the thread did
+        not write it within timeout seconds.'''
+        if self.profile is None:
+            return False
+        if threading.current_thread() is self.thread:
+            self.write(path)
+            return True
+        done = threading.Event()
+        with self.lock:
+            self.dumps.append((path, done))
+        return done.wait(timeout)
+
+
 class RequestHandler(SimpleJSONRPCRequestHandler):
     def do_OPTIONS(self):
         self.send_response(200)
@@ -65,7 +127,8 @@ class Daemon(DaemonThread):
         self.config = config
         self.network = network
         self.gui = None
-        self.wallets = {}
+        self.wallets = WalletManager(network, config.get('max_wallets'),
+                                     config.get('max_wallet_transactions'))
         self.wallet = None
         self.cmd_runner = Commands(self.config, self.wallet, self.network)
         host = config.get('rpchost', 'localhost')
@@ -80,13 +143,20 @@ class Daemon(DaemonThread):
         self.server.register_function(self.ping, 'ping')
         self.server.register_function(self.run_daemon, 'daemon')
         self.server.register_function(self.run_gui, 'gui')
+        # cProfile of the daemon thread, which runs the commands, and of
+        # the network thread, which runs the wallet jobs and callbacks
+        self.thread_profilers = [ThreadProfiler('daemon')]
+        self.add_jobs(self.thread_profilers[:1])
+        if network:
+            self.thread_profilers.append(ThreadProfiler('network'))
+            network.add_jobs(self.thread_profilers[1:])
 
     def ping(self):
         return True
 
     def run_daemon(self, config):
         sub = config.get('subcommand')
-        assert sub in ['start', 'stop', 'status']
+        assert sub in ['start', 'stop', 'status', 'profile']
         if sub == 'start':
             response = "Daemon already running"
         elif sub == 'status':
@@ -100,12 +170,37 @@ class Daemon(DaemonThread):
                 'connected': self.network.is_connected(),
                 'auto_connect': p[4],
                 'wallets': dict([(k, w.is_up_to_date()) for k, w in self.wallets.items()]),
+                'evicted_wallets': len(self.wallets.watchers),
             }
         elif sub == 'stop':
             self.stop()
             response = "Daemon stopped"
+        elif sub == 'profile':
+            response = self.run_profile(config.get('profile_action') or 'stats')
         return response
 
+    def run_profile(self, action):
+        '''Start or stop profiling, return the statistics collected, or
+        write the cProfile data of each thread to pstats files.'''
+        if action == 'start':
+            PROFILER.start()
+        elif action == 'stop':
+            PROFILER.stop()
+        elif action == 'reset':
+            PROFILER.reset()
+        elif action == 'dump':
+            path = self.config.get('profile_dir', os.path.join(self.config.path, 'profiles'))
+            if not os.path.exists(path):
+                os.mkdir(path)
+            stamp = time.strftime('%Y%m%d-%H%M%S')
+            paths = []
+            for profiler in self.thread_profilers:
+                filename = os.path.join(path, '%s-%s.pstats' % (profiler.name, stamp))
+                if profiler.dump(filename):
+                    paths.append(filename)
+            return paths
+        return PROFILER.get_stats()
+
     def run_gui(self, config_options):
         config = SimpleConfig(config_options)
         if self.gui:
@@ -119,11 +214,13 @@ class Daemon(DaemonThread):
             response = "Error: Electrum is running in daemon mode. Please stop the daemon first."
         return response
 
-    def load_wallet(self, path, get_wizard=None):
-        if path in self.wallets:
-            wallet = self.wallets[path]
-        else:
-            storage = WalletStorage(path)
+    def load_wallet(self, path, get_wizard=None, pin=False):
+        '''Return the wallet at path, loading it if needed.  With pin, it
+        is kept loaded until self.wallets.unpin(path) is called.'''
+        wallet = self.wallets.get(path, pin)
+        if wallet is None:
+            storage = WalletStorage(path, self.config.get('wallet_storage'),
+                                    self.config.get('wallet_journal', False))
             if get_wizard:
                 if storage.file_exists:
                     wallet = Wallet(storage)
@@ -139,7 +236,7 @@ class Daemon(DaemonThread):
                 wallet = Wallet(storage)
                 wallet.start_threads(self.network)
             if wallet:
-                self.wallets[path] = wallet
+                self.wallets.add(path, wallet, pin)
         return wallet
 
     def run_cmdline(self, config_options):
@@ -147,7 +244,14 @@ class Daemon(DaemonThread):
         cmdname = config.get('cmd')
         cmd = known_commands[cmdname]
         path = config.get_wallet_path()
-        wallet = self.load_wallet(path) if cmd.requires_wallet else None
+        wallet = self.load_wallet(path, pin=True) if cmd.requires_wallet else None
+        try:
+            return self.run_command(config, config_options, cmd, wallet)
+        finally:
+            if wallet:
+                self.wallets.unpin(path)
+
+    def run_command(self, config, config_options, cmd, wallet):
         # arguments passed to function
         args = map(lambda x: config.get(x), cmd.params)
         # decode json arguments
@@ -161,12 +265,34 @@ class Daemon(DaemonThread):
         result = func(*args)
         return result
 
+    def renew_claims(self):
+        # wallets only queue renewals if claim_auto_renew is set; encrypted
+        # wallets need the renewclaims command to be run with a password.
+        # The updates are left to the broadcaster, so this does not wait
+        # for the network.
+        for path, wallet in self.wallets.items():
+            if not wallet.use_encryption and wallet.has_due_claim_renewals():
+                for result in Commands(self.config, wallet, self.network).renewclaims():
+                    self.print_error("renewed claim", result['claim_id'], result['success'],
+                                     result.get('reason', result.get('txid')))
+
+    def reload_active_wallet(self):
+        # evicted wallets with new activity are loaded one at a time to
+        # be synchronized, and evicted again once others are used
+        path = self.wallets.pop_active()
+        if path is not None:
+            self.print_error("reloading", path)
+            self.load_wallet(path)
+
     def run(self):
         while self.is_running():
             self.server.handle_request()
+            self.run_jobs()
+            self.reload_active_wallet()
+            self.wallets.evict()
+            self.renew_claims()
         os.unlink(lockfile(self.config))
 
     def stop(self):
-        for k, wallet in self.wallets.items():
-            wallet.stop_threads()
+        self.wallets.stop()
         DaemonThread.stop(self)
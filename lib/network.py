@@ -39,6 +39,8 @@ def is_online(host, ports):
 
 NODES_RETRY_INTERVAL = 60
 SERVER_RETRY_INTERVAL = 10
+# raw transactions kept in memory for every wallet of the process
+TX_CACHE_SIZE = 1000
 
 
 def parse_servers(result):
@@ -181,6 +183,8 @@ class Network(util.DaemonThread):
         # callbacks passed with subscriptions
         self.subscriptions = defaultdict(list)
         self.sub_cache = {}
+        # raw transactions fetched by any wallet, by hash
+        self.tx_cache = util.LRUCache(self.config.get('tx_cache_size', TX_CACHE_SIZE))
         # callbacks set by the GUI
         self.callbacks = defaultdict(list)
 
@@ -542,6 +546,8 @@ class Network(util.DaemonThread):
                 # add it to the list; avoids double-sends on reconnection
                 if method == 'blockchain.address.subscribe':
                     self.subscribed_addresses.add(params[0])
+                elif method == 'blockchain.transaction.get' and response.get('result'):
+                    self.cache_transaction(params[0], response['result'])
             else:
                 if not response:  # Closed remotely / misbehaving
                     self.connection_down(interface.server)
@@ -582,8 +588,8 @@ class Network(util.DaemonThread):
         for messages, callback in sends:
             for method, params in messages:
                 r = None
+                k = self.get_index(method, params)
                 if method.endswith('.subscribe'):
-                    k = self.get_index(method, params)
                     # add callback to list
                     l = self.subscriptions.get(k, [])
                     if callback not in l:
@@ -591,6 +597,10 @@ class Network(util.DaemonThread):
                     self.subscriptions[k] = l
                     # check cached response for subscriptions
                     r = self.sub_cache.get(k)
+                elif method == 'blockchain.transaction.get':
+                    raw = self.tx_cache.get(params[0])
+                    if raw is not None:
+                        r = {'method': method, 'params': params, 'result': raw.encode('hex')}
                 if r is not None:
                     util.print_error("cache hit", k)
                     callback(r)
@@ -598,6 +608,16 @@ class Network(util.DaemonThread):
                     message_id = self.queue_request(method, params)
                     self.unanswered_requests[message_id] = method, params, callback
 
+    def cache_transaction(self, tx_hash, result):
+        '''Keep a transaction received from a server for the other
+        wallets of the process, if it matches its hash.'''
+        try:
+            raw = result.decode('hex')
+        except (TypeError, AttributeError):
+            return
+        if hash_encode(Hash(raw)) == tx_hash:
+            self.tx_cache.put(tx_hash, raw)
+
     def unsubscribe(self, callback):
         '''Unsubscribe a callback to free object references to enable GC.'''
         # Note: we can't unsubscribe from the server, so if we receive
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# LBRYum - lightweight LBRYcrd client
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import copy
+import gc
+import threading
+import time
+from functools import wraps
+
+# upper bounds in seconds of the buckets of the timing histograms; the
+# last bucket holds the longer calls
+HISTOGRAM_BOUNDS = (0.001, 0.01, 0.1, 1, 10)
+
+
+class Profiler(object):
+    '''Statistics collected while profiling is enabled: the calls of the
+    functions decorated with profiled or util.profiler, and the time
+    spent waiting for named RWLocks.
+
+    For each function it keeps the number of calls, their total and
+    longest time, a histogram of their times (see HISTOGRAM_BOUNDS) and
+    the number of objects they allocated.  Python 2 cannot trace
+    allocations, so the latter counts the objects tracked by the garbage
+    collector, net of those freed, and is approximate: it includes other
+    threads, and misses objects taken from the interpreter's free lists.
+    '''
+
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = None
+        self.functions = {}
+        self.locks = {}
+
+    def start(self):
+        with self.lock:
+            if not self.enabled:
+                self.enabled = True
+                self.started = time.time()
+
+    def stop(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.functions = {}
+            self.locks = {}
+            self.started = time.time() if self.enabled else None
+
+    def record_call(self, name, elapsed, allocations):
+        with self.lock:
+            item = self.functions.get(name)
+            if item is None:
+                item = self.functions[name] = {
+                    'count': 0,
+                    'total': 0.,
+                    'max': 0.,
+                    'allocations': 0,
+                    'histogram': [0] * (len(HISTOGRAM_BOUNDS) + 1),
+                }
+            item['count'] += 1
+            item['total'] += elapsed
+            item['max'] = max(item['max'], elapsed)
+            item['allocations'] += allocations
+            item['histogram'][bisect.bisect_left(HISTOGRAM_BOUNDS, elapsed)] += 1
+
+    def record_wait(self, name, elapsed):
+        with self.lock:
+            item = self.locks.get(name)
+            if item is None:
+                item = self.locks[name] = {'count': 0, 'total': 0., 'max': 0.}
+            item['count'] += 1
+            item['total'] += elapsed
+            item['max'] = max(item['max'], elapsed)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'started': self.started,
+                'histogram_bounds': list(HISTOGRAM_BOUNDS),
+                'functions': copy.deepcopy(self.functions),
+                'locks': copy.deepcopy(self.locks),
+            }
+
+
+PROFILER = Profiler()
+
+
+def allocation_count():
+    return gc.get_count()[0]
+
+
+def allocations_since(count):
+    now = gc.get_count()[0]
+    if now >= count:
+        return now - count
+    # the youngest generation was collected meanwhile
+    return now + gc.get_threshold()[0] - count
+
+
+def function_name(func):
+    return '%s.%s' % (func.__module__, func.__name__)
+
+
+def profiled(func):
+    '''Decorator recording the calls of func in PROFILER while it is
+    enabled.  Unlike util.profiler, it prints nothing, so it suits
+    functions called often.'''
+    name = function_name(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not PROFILER.enabled:
+            return func(*args, **kwargs)
+        count = allocation_count()
+        t0 = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            PROFILER.record_call(name, time.time() - t0, allocations_since(count))
+    return wrapper
+
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#
+# LBRYum - lightweight LBRYcrd client
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import sqlite3
+
+from util import PrintError
+
+SQLITE_HEADER = 'SQLite format 3\x00'
+# kv rows marking that a table key is present in the wallet, even if empty
+TABLE_MARKER = '__table__'
+
+
+def is_sqlite_file(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    except IOError:
+        return False
+
+
+def _blob_value(row):
+    # rows written before transactions were stored as blobs hold hex text
+    if isinstance(row[1], str):
+        return row[0], row[1].decode('hex')
+    return row[0], str(row[1])
+
+
+def _json_row(key, value):
+    return key, json.dumps(value)
+
+
+def _json_value(row):
+    return row[0], json.loads(row[1])
+
+
+# Wallet keys stored one row per item instead of as a single JSON blob.
+# Each entry is (table, columns, encode, decode): encode maps an item of
+# the stored dict to a row, decode maps a row back to (key, value).
+TABLES = {
+    'transactions': ('transactions', ('tx_hash TEXT PRIMARY KEY', 'raw BLOB'),
+                     lambda k, v: (k, sqlite3.Binary(v)), _blob_value),
+    'verified_tx3': ('verified_tx', ('tx_hash TEXT PRIMARY KEY', 'height INTEGER',
+                                     'timestamp INTEGER', 'pos INTEGER'),
+                     lambda k, v: (k,) + tuple(v), lambda r: (r[0], [r[1], r[2], r[3]])),
+    'txi': ('txi', ('tx_hash TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'txo': ('txo', ('tx_hash TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'pruned_txo': ('pruned_txo', ('outpoint TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'addr_history': ('addr_history', ('address TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'claimtrie_transactions': ('claimtrie_transactions', ('outpoint TEXT PRIMARY KEY', 'value TEXT'),
+                               _json_row, _json_value),
+    'tx_addr_hist': ('tx_addr_hist', ('tx_hash TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'utxos': ('utxos', ('outpoint TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'spent_outpoints': ('spent_outpoints', ('outpoint TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'claims': ('claims', ('outpoint TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'labels': ('labels', ('key TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+    'watch_state': ('watch_state', ('address TEXT PRIMARY KEY', 'value TEXT'), _json_row, _json_value),
+}
+
+INDEXES = [
+    'CREATE INDEX IF NOT EXISTS verified_tx_height ON verified_tx (height)',
+]
+
+
+class SqliteWalletDB(PrintError):
+    '''SQLite file backing a WalletStorage.
+
+    The keys listed in TABLES are stored one row per item in indexed
+    tables, so that a write only touches the rows that changed.  Every
+    other key is stored as JSON in the kv table.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        # writes happen from whichever thread saves the wallet; access is
+        # serialized by the WalletStorage lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.text_factory = str
+        self.create_tables()
+
+    def diagnostic_name(self):
+        return 'SqliteWalletDB'
+
+    def create_tables(self):
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)')
+            for table, columns, encode, decode in TABLES.values():
+                self.conn.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (table, ', '.join(columns)))
+            for index in INDEXES:
+                self.conn.execute(index)
+
+    def load(self):
+        data = {}
+        tables = set()
+        for key, value in self.conn.execute('SELECT key, value FROM kv'):
+            if key.startswith(TABLE_MARKER):
+                tables.add(key[len(TABLE_MARKER):])
+            else:
+                data[key] = json.loads(value)
+        for key, (table, columns, encode, decode) in TABLES.items():
+            rows = self.conn.execute('SELECT * FROM %s' % table).fetchall()
+            if rows or key in tables:
+                data[key] = dict(decode(r) for r in rows)
+        return data
+
+    def is_table_value(self, key, value):
+        return key in TABLES and isinstance(value, dict)
+
+    def write(self, data, dirty_keys, dirty_rows):
+        '''Write the keys in dirty_keys and, for table keys, the items in
+        dirty_rows (a map from key to a set of item keys).'''
+        with self.conn:
+            for key in dirty_keys:
+                self._write_key(key, data.get(key))
+            for key, items in dirty_rows.items():
+                value = data.get(key)
+                if not self.is_table_value(key, value):
+                    self._write_key(key, value)
+                    continue
+                table, columns, encode, decode = TABLES[key]
+                deleted = [(k,) for k in items if k not in value]
+                rows = [encode(k, value[k]) for k in items if k in value]
+                if deleted:
+                    self.conn.executemany('DELETE FROM %s WHERE %s = ?' % (table, self._pk(key)), deleted)
+                if rows:
+                    self.conn.executemany('INSERT OR REPLACE INTO %s VALUES (%s)'
+                                          % (table, ', '.join('?' * len(rows[0]))), rows)
+
+    def import_data(self, data):
+        self.write(data, set(data.keys()), {})
+
+    def _pk(self, key):
+        return TABLES[key][1][0].split()[0]
+
+    def _write_key(self, key, value):
+        if key in TABLES:
+            table = TABLES[key][0]
+            self.conn.execute('DELETE FROM %s' % table)
+            self.conn.execute('DELETE FROM kv WHERE key IN (?, ?)', (key, TABLE_MARKER + key))
+            if value is None:
+                return
+            if self.is_table_value(key, value):
+                encode = TABLES[key][2]
+                rows = [encode(k, v) for k, v in value.items()]
+                if rows:
+                    self.conn.executemany('INSERT INTO %s VALUES (%s)'
+                                          % (table, ', '.join('?' * len(rows[0]))), rows)
+                self.conn.execute('INSERT INTO kv VALUES (?, ?)', (TABLE_MARKER + key, '1'))
+                return
+        if value is None:
+            self.conn.execute('DELETE FROM kv WHERE key = ?', (key,))
+        else:
+            self.conn.execute('INSERT OR REPLACE INTO kv VALUES (?, ?)', (key, json.dumps(value)))
+
+    def close(self):
+        self.conn.close()
@@ -33,6 +33,9 @@ class Synchronizer(ThreadJob):
     data of any transactions the wallet doesn't have.
 
     External interface: __init__() and add() member functions.
+
+    Address generation only runs when something it depends on has
+    changed: a new address, a new address history, or a new header.
     '''
 
     def __init__(self, wallet, network):
@@ -44,6 +47,9 @@ class Synchronizer(ThreadJob):
         self.requested_histories = {}
         self.requested_addrs = set()
         self.lock = Lock()
+        # Set when the wallet may need new addresses.  Access with self.lock.
+        self.wallet_changed = True
+        self.local_height = None
         self.initialize()
 
     def parse_response(self, response):
@@ -63,6 +69,7 @@ class Synchronizer(ThreadJob):
         '''This can be called from the proxy or GUI threads.'''
         with self.lock:
             self.new_addresses.add(address)
+            self.wallet_changed = True
 
     def subscribe_to_addresses(self, addresses):
         if addresses:
@@ -108,6 +115,8 @@ class Synchronizer(ThreadJob):
         else:
             # Store received history
             self.wallet.receive_history_callback(addr, hist)
+            with self.lock:
+                self.wallet_changed = True
             # Request transactions we don't have
             self.request_missing_txs(hist)
         # Remove request; this allows up_to_date to be True
@@ -166,8 +175,15 @@ class Synchronizer(ThreadJob):
 
     def run(self):
         '''Called from the network proxy thread main loop.'''
-        # 1. Create new addresses
-        self.wallet.synchronize()
+        # 1. Create new addresses.  The age of addresses depends on the
+        # local height, so a new header may also require new addresses.
+        lh = self.network.get_local_height()
+        with self.lock:
+            changed = self.wallet_changed or lh != self.local_height
+            self.wallet_changed = False
+        self.local_height = lh
+        if changed:
+            self.wallet.synchronize()
 
         # 2. Subscribe to new addresses
         with self.lock:
@@ -3,6 +3,13 @@ import unittest
 from lib import account
 from lib import wallet
 
+
+def make_storage(data):
+    storage = wallet.WalletStorage(None)
+    for key, value in data.items():
+        storage.put(key, value)
+    return storage
+
 class Test_Account(unittest.TestCase):
 
     def test_bip32_account(self):
@@ -46,11 +53,11 @@ class Test_Account(unittest.TestCase):
                           ('bScaWvgzAzFXzAcVgDDARfo9RFhdrm4pVc', v['receiving'][0]))
 
         xprv = 'xprv9s21ZrQH143K2eGb6FZ81nLW44cyy7mrAiqg4VB4pQKDrmizjc1pSuynnpeiaMPdZxvrfvdBi5oqFi9hmsV7MrsVquKkruQ7TJPCfVuPSdw'
-        storage = dict(
+        storage = make_storage(dict(
             master_public_keys={0: a.xpub},
             master_private_keys={0: xprv},
             wallet_type='standard'
-        )
+        ))
         w = wallet.BIP32_Wallet(storage)
         self.assertEquals(a.get_private_key(sequence=[0, 0], wallet=w, password=None),
                           ['KxuBFG13CPUBwPAUWvZSQ3mjNNjHoDghfxnax6RbwS3Rw8tqSzCk'])
@@ -103,10 +110,10 @@ class Test_Account(unittest.TestCase):
         with self.assertRaises(account.InvalidPassword):
             a.check_seed('1' * len(seed))
 
-        storage = {
+        storage = make_storage({
             'seed': '00000000000000000000000000000000',
             'wallet_type': 'old'
-        }
+        })
         w = wallet.OldWallet(storage)
         privkey = a.get_private_key(sequence=[0, 0], wallet=w, password=None)
         self.assertEquals(privkey, ['5Khs7w6fBkogoj1v71Mdt4g8m5kaEyRaortmK56YckgTubgnrhz'])
@@ -121,3 +128,13 @@ class Test_Account(unittest.TestCase):
                 mpk, seq = a.parse_xpubkey(pubkey)
                 self.assertEquals(mpk, v['mpk'])
                 self.assertEquals(seq, [for_change, n])
+
+    def test_imported_account_addresses(self):
+        a = account.ImportedAccount({'imported': {'b': [None, None], 'c': [None, None]}})
+        a.add('a', None, None, None)
+        a.add('d', None, None, None)
+        a.add('a', None, None, None)
+        self.assertEqual(['a', 'b', 'c', 'd'], a.get_addresses(0))
+        a.remove('c')
+        self.assertEqual(['a', 'b', 'd'], a.get_addresses(0))
+        self.assertEqual([], a.get_addresses(1))
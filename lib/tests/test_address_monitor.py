@@ -0,0 +1,128 @@
+import unittest
+
+from lib.address_monitor import AddressMonitor, SUBSCRIBE_BATCH
+from lib.transaction import Transaction
+from lib.wallet import WalletStorage, history_status
+from lib.tests import test_wallet
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.sent = []
+        self.events = []
+
+    def send(self, messages, callback):
+        self.sent.append((messages, callback))
+
+    def trigger_callback(self, event, *args):
+        self.events.append((event,) + args)
+
+    def pop_sent(self, method):
+        sent = [(params, callback) for messages, callback in self.sent
+                for m, params in messages if m == method]
+        self.sent = [(messages, callback) for messages, callback in self.sent
+                     if not any(m == method for m, params in messages)]
+        return sent
+
+
+class TestAddressMonitor(unittest.TestCase):
+
+    raw_tx = test_wallet.TestLazyTransactions.raw_tx
+
+    def setUp(self):
+        self.network = FakeNetwork()
+        self.storage = WalletStorage(None)
+        self.monitor = AddressMonitor(self.network, self.storage)
+        tx = Transaction(self.raw_tx)
+        self.tx_hash = tx.hash()
+        self.addr, self.amount = tx.get_outputs()[0]
+
+    def notify(self, addr, hist):
+        self.monitor.addr_subscription_response({'params': [addr], 'result': history_status(hist)})
+
+    def answer_histories(self, hist):
+        for params, callback in self.network.pop_sent('blockchain.address.get_history'):
+            callback({'params': params,
+                      'result': [{'tx_hash': h, 'height': height} for h, height in hist]})
+
+    def answer_transactions(self):
+        for params, callback in self.network.pop_sent('blockchain.transaction.get'):
+            callback({'params': params, 'result': self.raw_tx})
+
+    def test_subscriptions_are_batched(self):
+        self.monitor.add_addresses(['a%d' % i for i in range(SUBSCRIBE_BATCH + 1)])
+        self.monitor.run()
+        self.assertEqual(SUBSCRIBE_BATCH, len(self.network.pop_sent('blockchain.address.subscribe')))
+        self.monitor.run()
+        self.assertEqual(1, len(self.network.pop_sent('blockchain.address.subscribe')))
+        self.monitor.run()
+        self.assertEqual([], self.network.sent)
+
+    def test_unchanged_status_skips_history(self):
+        self.monitor.add_addresses([self.addr])
+        self.notify(self.addr, [])
+        self.assertEqual([], self.network.sent)
+
+    def test_deposits_are_reported(self):
+        self.monitor.add_addresses([self.addr, 'other'])
+        hist = [(self.tx_hash, 0)]
+        self.notify(self.addr, hist)
+        self.answer_histories(hist)
+        self.answer_transactions()
+        deposit = {'address': self.addr, 'tx_hash': self.tx_hash, 'height': 0, 'amount': self.amount}
+        self.assertEqual([('deposit', deposit)], self.network.events)
+        self.assertEqual(hist, self.monitor.get_history(self.addr))
+        # the same status is not requested again
+        self.notify(self.addr, hist)
+        self.assertEqual([], self.network.sent)
+        # the deposit is reported again once confirmed
+        hist = [(self.tx_hash, 100)]
+        self.notify(self.addr, hist)
+        self.answer_histories(hist)
+        self.answer_transactions()
+        deposit = dict(deposit, height=100)
+        self.assertEqual(('deposit', deposit), self.network.events[-1])
+        self.assertEqual(2, len(self.network.events))
+
+    def test_changed_status_is_requested_again(self):
+        self.monitor.add_addresses([self.addr])
+        self.notify(self.addr, [(self.tx_hash, 0)])
+        self.notify(self.addr, [(self.tx_hash, 100)])
+        self.answer_histories([(self.tx_hash, 0)])
+        self.assertEqual([], self.monitor.get_history(self.addr))
+        self.answer_histories([(self.tx_hash, 100)])
+        self.assertEqual([(self.tx_hash, 100)], self.monitor.get_history(self.addr))
+
+    def test_state_is_kept(self):
+        self.monitor.add_addresses([self.addr])
+        self.notify(self.addr, [(self.tx_hash, 100)])
+        self.answer_histories([(self.tx_hash, 100)])
+        monitor = AddressMonitor(FakeNetwork(), self.storage)
+        self.assertEqual([(self.tx_hash, 100)], monitor.get_history(self.addr))
+        monitor.remove_addresses([self.addr])
+        monitor.addr_subscription_response({'params': [self.addr], 'result': 'x'})
+        self.assertEqual([], monitor.network.sent)
+
+    def test_failed_transactions_are_requested_again(self):
+        self.monitor.add_addresses([self.addr])
+        hist = [(self.tx_hash, 0)]
+        self.notify(self.addr, hist)
+        self.answer_histories(hist)
+        for params, callback in self.network.pop_sent('blockchain.transaction.get'):
+            callback({'params': params, 'error': 'unknown transaction'})
+        self.assertEqual([], self.network.events)
+        self.assertEqual(hist, self.monitor.get_history(self.addr))
+        self.monitor.run()
+        self.assertEqual([], self.network.pop_sent('blockchain.transaction.get'))
+        self.monitor.last_retry = 0
+        self.monitor.run()
+        self.answer_transactions()
+        deposit = {'address': self.addr, 'tx_hash': self.tx_hash, 'height': 0, 'amount': self.amount}
+        self.assertEqual([('deposit', deposit)], self.network.events)
+        self.assertEqual({}, self.monitor.failed_tx)
+
+    def test_save_without_path(self):
+        self.monitor.add_addresses([self.addr])
+        self.monitor.save()
+        self.assertFalse(self.storage.file_exists)
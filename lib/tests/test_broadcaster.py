@@ -0,0 +1,134 @@
+import shutil
+import tempfile
+import unittest
+import os
+
+from lib.wallet import WalletStorage, NewWallet
+from lib.broadcaster import Broadcaster, MAX_ATTEMPTS
+
+
+class FakeTransaction(object):
+
+    def hash(self):
+        return 'aa' * 32
+
+    def __str__(self):
+        return '0100'
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.interface = 'main'
+        self.interfaces = {'main': 'main', 'other': 'other'}
+        self.sent = []
+        self.queued = []
+
+    def send(self, messages, callback):
+        self.sent.extend(messages)
+        self.callback = callback
+
+    def queue_request(self, method, params, interface):
+        self.queued.append((method, params, interface))
+
+
+class TestBroadcaster(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+        self.storage = WalletStorage(os.path.join(self.user_dir, "somewallet"))
+        self.wallet = NewWallet(self.storage)
+        self.network = FakeNetwork()
+        self.broadcaster = Broadcaster(self.wallet, self.network)
+        self.tx = FakeTransaction()
+        self.tx_hash = self.tx.hash()
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+
+    def run_broadcaster(self):
+        self.broadcaster.next_check = 0
+        self.broadcaster.run()
+
+    def test_retry_until_seen_then_confirmed(self):
+        self.wallet.add_pending_broadcast(self.tx)
+        self.assertIn(self.tx_hash, self.storage.get('pending_broadcasts'))
+        # not due yet
+        self.run_broadcaster()
+        self.assertEqual([], self.network.sent)
+        self.wallet.pending_broadcasts[self.tx_hash]['next_try'] = 0
+        self.run_broadcaster()
+        self.assertEqual([('blockchain.transaction.broadcast', ['0100'])], self.network.sent)
+        self.assertEqual([('blockchain.transaction.broadcast', ['0100'], 'other')], self.network.queued)
+        item, = self.wallet.get_pending_broadcasts()
+        self.assertEqual(1, item['attempts'])
+        self.assertFalse(item['seen'])
+        # seen unconfirmed: keep without retrying
+        self.wallet.receive_history_callback('addr', [(self.tx_hash, 0)])
+        self.wallet.pending_broadcasts[self.tx_hash]['next_try'] = 0
+        self.run_broadcaster()
+        self.assertEqual(1, len(self.network.sent))
+        self.assertTrue(self.wallet.get_pending_broadcasts()[0]['seen'])
+        # confirmed: dropped
+        self.wallet.receive_history_callback('addr', [(self.tx_hash, 10)])
+        self.run_broadcaster()
+        self.assertEqual([], self.wallet.get_pending_broadcasts())
+
+    def answer(self, response):
+        self.wallet.network = self.network
+        self.wallet.send_tx(self.tx)
+        self.wallet.on_broadcast(self.tx_hash, response)
+
+    def test_rejected_tx_is_not_retried(self):
+        self.answer({'result': 'bad-txns'})
+        self.assertEqual((False, 'error: bad-txns'), self.wallet.receive_tx(self.tx_hash, self.tx))
+        self.assertEqual([], self.wallet.get_pending_broadcasts())
+
+    def test_unanswered_tx_stays_queued(self):
+        self.wallet.network = self.network
+        self.assertEqual((False, 'error: no answer from the server, the transaction will be sent again'),
+                         self.wallet.sendtx(self.tx, 0))
+        self.assertEqual([self.tx_hash], [item['txid'] for item in self.wallet.get_pending_broadcasts()])
+
+    def test_error_answer_is_a_rejection(self):
+        self.answer({'error': {'code': -26, 'message': 'txn-mempool-conflict'}})
+        ok, out = self.wallet.receive_tx(self.tx_hash, self.tx)
+        self.assertFalse(ok)
+        self.assertIn('txn-mempool-conflict', out)
+        self.assertEqual([], self.wallet.get_pending_broadcasts())
+
+    def test_known_tx_is_not_rejected(self):
+        self.answer({'error': 'txn-already-in-mempool'})
+        self.assertEqual((True, self.tx_hash), self.wallet.receive_tx(self.tx_hash, self.tx))
+        self.assertEqual(1, len(self.wallet.get_pending_broadcasts()))
+
+    def test_retry_rejected_by_server_is_dropped(self):
+        self.wallet.add_pending_broadcast(self.tx, 0)
+        self.run_broadcaster()
+        self.network.callback({'result': 'bad-txns-inputs-spent'})
+        self.assertEqual([], self.wallet.get_pending_broadcasts())
+
+    def test_retries_stop_after_max_attempts(self):
+        self.wallet.add_pending_broadcast(self.tx, 0)
+        for i in range(MAX_ATTEMPTS):
+            self.wallet.pending_broadcasts[self.tx_hash]['next_try'] = 0
+            self.run_broadcaster()
+        self.assertEqual(MAX_ATTEMPTS, len(self.network.sent))
+        self.assertEqual(1, len(self.wallet.get_pending_broadcasts()))
+        self.wallet.pending_broadcasts[self.tx_hash]['next_try'] = 0
+        self.run_broadcaster()
+        self.assertEqual(MAX_ATTEMPTS, len(self.network.sent))
+        self.assertEqual([], self.wallet.get_pending_broadcasts())
+
+    def test_late_answer_is_ignored(self):
+        self.wallet.network = self.network
+        self.wallet.sendtx(self.tx, 0)
+        # a new transaction is not woken by the answer to the first one
+        other = FakeTransaction()
+        other.hash = lambda: 'bb' * 32
+        self.wallet.send_tx(other)
+        self.wallet.on_broadcast(self.tx_hash, {'result': self.tx_hash})
+        self.assertEqual((False, 'error: no answer from the server, the transaction will be sent again'),
+                         self.wallet.receive_tx('bb' * 32, other))
+        self.assertEqual(['aa' * 32, 'bb' * 32],
+                         sorted(item['txid'] for item in self.wallet.get_pending_broadcasts()))
@@ -17,6 +17,19 @@ class MocNetwork(object):
     pass
 
 
+class MocTransaction(object):
+    def hash(self):
+        return 'aa' * 32
+
+
+class MocSendWallet(object):
+    def __init__(self, answer, queued):
+        self.answer = answer
+        self.pending_broadcasts = {'aa' * 32: {}} if queued else {}
+    def sendtx(self, tx, timeout=None):
+        return self.answer
+
+
 class MocCommands(commands.Commands):
     def __init__(self,wallet,network):
         self.wallet = wallet
@@ -46,6 +59,19 @@ class Test_Commands(unittest.TestCase):
         self.assertEqual(False, out['success'])
         self.assertEqual('Not enough funds', out['reason'])
 
+    def test_broadcast_result(self):
+        tx = MocTransaction()
+        cmds = MocCommands(MocSendWallet((True, 'aa' * 32), True), MocNetwork())
+        self.assertEqual('aa' * 32, cmds._broadcast(tx))
+        # no answer, the wallet sends the transaction again
+        cmds = MocCommands(MocSendWallet((False, 'error: no answer'), True), MocNetwork())
+        self.assertEqual({'txid': 'aa' * 32, 'queued': True}, cmds._broadcast(tx))
+        # refused by the server
+        cmds = MocCommands(MocSendWallet((False, 'error: bad-txns'), False), MocNetwork())
+        with self.assertRaises(BaseException) as cm:
+            cmds._broadcast(tx)
+        self.assertEqual('bad-txns', str(cm.exception))
+
     def test_format_lbrycrd_keys(self):
         a = {'test': 1,
          'nOut': 1}
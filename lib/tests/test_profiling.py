@@ -0,0 +1,85 @@
+import os
+import pstats
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from lib.daemon import ThreadProfiler
+from lib.profiling import PROFILER, profiled
+from lib.util import RWLock
+
+
+class Item(object):
+    pass
+
+
+@profiled
+def work(n):
+    return [Item() for i in range(n)]
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        PROFILER.reset()
+
+    def tearDown(self):
+        PROFILER.stop()
+        PROFILER.reset()
+
+    def test_calls_are_recorded_while_enabled(self):
+        work(10)
+        self.assertEqual({}, PROFILER.get_stats()['functions'])
+        PROFILER.start()
+        work(10)
+        work(10)
+        stats = PROFILER.get_stats()
+        item = stats['functions'][__name__ + '.work']
+        self.assertEqual(2, item['count'])
+        self.assertEqual(2, sum(item['histogram']))
+        self.assertEqual(len(stats['histogram_bounds']) + 1, len(item['histogram']))
+        self.assertTrue(item['allocations'] > 0)
+        self.assertTrue(stats['enabled'])
+
+    def test_lock_wait_is_recorded(self):
+        lock = RWLock('test')
+        PROFILER.start()
+        with lock:
+            with lock.read():
+                pass
+        self.assertEqual(2, PROFILER.get_stats()['locks']['test']['count'])
+
+
+class TestThreadProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stop = threading.Event()
+        self.profiler = ThreadProfiler('test')
+
+    def tearDown(self):
+        self.stop.set()
+        PROFILER.stop()
+        PROFILER.reset()
+        shutil.rmtree(self.dir)
+
+    def loop(self):
+        while not self.stop.is_set():
+            self.profiler.run()
+            work(10)
+
+    def test_dump_from_another_thread(self):
+        path = os.path.join(self.dir, 'test.pstats')
+        self.assertFalse(self.profiler.dump(path))
+        PROFILER.start()
+        t = threading.Thread(target=self.loop)
+        t.start()
+        while not self.profiler.running:
+            time.sleep(0.01)
+        self.assertTrue(self.profiler.dump(path))
+        self.stop.set()
+        t.join()
+        functions = [func for filename, line, func in pstats.Stats(path).stats]
+        self.assertIn('work', functions)
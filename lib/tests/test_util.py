@@ -1,5 +1,6 @@
+import threading
 import unittest
-from lib.util import format_satoshis, parse_URI
+from lib.util import format_satoshis, parse_URI, RWLock, LRUCache
 
 
 class TestUtil(unittest.TestCase):
@@ -71,3 +72,87 @@ class TestUtil(unittest.TestCase):
     def test_parse_URI_parameter_polution(self):
         self.assertRaises(Exception, parse_URI,
                           'bitcoin:bFnNVhPUNRWiA6Y2hbd1KBAMgQBrFsc5u3?amount=0.0003&label=test&amount=30.0')
+
+
+class TestRWLock(unittest.TestCase):
+
+    def run_thread(self, target):
+        t = threading.Thread(target=target)
+        t.daemon = True
+        t.start()
+        return t
+
+    def test_readers_share_the_lock(self):
+        lock = RWLock()
+        inside = threading.Event()
+        with lock.read():
+            self.run_thread(lambda: lock.read().__enter__() or inside.set())
+            self.assertTrue(inside.wait(5))
+
+    def test_writer_waits_for_readers(self):
+        lock = RWLock()
+        acquired = threading.Event()
+
+        def write():
+            with lock:
+                acquired.set()
+        with lock.read():
+            t = self.run_thread(write)
+            self.assertFalse(acquired.wait(0.2))
+        t.join(5)
+        self.assertTrue(acquired.is_set())
+
+    def test_waiting_writer_blocks_new_readers(self):
+        lock = RWLock()
+        read = threading.Event()
+        done_writing = threading.Event()
+
+        def read_lock():
+            with lock.read():
+                read.set()
+
+        def write():
+            with lock:
+                done_writing.wait(5)
+        with lock.read():
+            self.run_thread(write)
+            while not lock.waiting_writers:
+                pass
+            t = self.run_thread(read_lock)
+            self.assertFalse(read.wait(0.2))
+            # threads already holding the lock are not blocked
+            with lock.read():
+                pass
+        self.assertFalse(read.wait(0.2))
+        done_writing.set()
+        t.join(5)
+        self.assertTrue(read.is_set())
+
+    def test_writer_is_reentrant(self):
+        lock = RWLock()
+        with lock:
+            with lock:
+                with lock.read():
+                    pass
+        self.assertIsNone(lock.writer)
+        self.assertEqual({}, lock.readers)
+
+    def test_reader_cannot_write(self):
+        lock = RWLock()
+        with lock.read():
+            self.assertRaises(RuntimeError, lock.acquire)
+        self.assertRaises(RuntimeError, lock.release_read)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_is_dropped(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(2, len(cache))
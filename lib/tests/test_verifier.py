@@ -0,0 +1,130 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.verifier import SPV
+from lib.wallet import NewWallet, WalletStorage
+
+
+TX_HASH = 'ab' * 32
+SIBLINGS = ['cd' * 32, 'ef' * 32]
+
+
+class FakeNetwork(object):
+
+    def __init__(self, height, headers, config=None):
+        self.height = height
+        self.headers = headers
+        self.config = config or {}
+        self.events = []
+
+    def get_local_height(self):
+        return self.height
+
+    def get_header(self, height):
+        return self.headers.get(height)
+
+    def trigger_callback(self, event, *args):
+        self.events.append((event,) + args)
+
+
+class FakeWallet(object):
+
+    def __init__(self):
+        self.verified_tx = {}
+        self.unverified_tx = {}
+        self.merkle_branches = {}
+
+    def get_unverified_txs(self):
+        return self.unverified_tx
+
+    def get_merkle_branch(self, tx_hash):
+        return self.merkle_branches.get(tx_hash)
+
+    def get_merkle_branch_txs(self):
+        return self.merkle_branches.keys()
+
+    def add_verified_tx(self, tx_hash, info, merkle_branch=None):
+        self.unverified_tx.pop(tx_hash, None)
+        self.verified_tx[tx_hash] = info
+        if merkle_branch is not None:
+            self.merkle_branches[tx_hash] = (info[2], merkle_branch)
+        else:
+            self.merkle_branches.pop(tx_hash, None)
+
+    def unverify_tx(self, tx_hash):
+        info = self.verified_tx.pop(tx_hash)
+        self.unverified_tx[tx_hash] = info[0]
+
+
+class Test_SPV(unittest.TestCase):
+
+    def setUp(self):
+        self.wallet = FakeWallet()
+        root = SPV(FakeNetwork(0, {}), FakeWallet()).hash_merkle_root(SIBLINGS, TX_HASH, 2)
+        self.headers = {10: {'merkle_root': root, 'timestamp': 1234}}
+
+    def test_persist_branch_on_verify(self):
+        network = FakeNetwork(10, self.headers, {'persist_merkle_branches': True})
+        spv = SPV(network, self.wallet)
+        spv.verify_merkle({'params': [TX_HASH, 10],
+                           'result': {'block_height': 10, 'pos': 2, 'merkle': SIBLINGS}})
+        self.assertEqual((10, 1234, 2), self.wallet.verified_tx[TX_HASH])
+        self.assertEqual((2, SIBLINGS), self.wallet.merkle_branches[TX_HASH])
+
+    def test_verify_from_stored_branch_without_network(self):
+        self.wallet.merkle_branches[TX_HASH] = (2, SIBLINGS)
+        self.wallet.unverified_tx[TX_HASH] = 10
+        network = FakeNetwork(10, self.headers)
+        network.send = lambda *args: self.fail("should not hit the network")
+        SPV(network, self.wallet).run()
+        self.assertEqual((10, 1234, 2), self.wallet.verified_tx[TX_HASH])
+
+    def test_reverify_unverifies_on_header_mismatch(self):
+        self.wallet.verified_tx[TX_HASH] = (10, 1234, 2)
+        self.wallet.merkle_branches[TX_HASH] = (2, SIBLINGS)
+        self.headers[10] = {'merkle_root': '00' * 32, 'timestamp': 1234}
+        network = FakeNetwork(10, self.headers)
+        sent = []
+        network.send = lambda messages, callback: sent.extend(messages)
+        SPV(network, self.wallet).run()
+        self.assertNotIn(TX_HASH, self.wallet.verified_tx)
+        self.assertEqual([('blockchain.transaction.get_merkle', [TX_HASH, 10])], sent)
+
+    def test_reorg_reverifies_from_stored_branch(self):
+        user_dir = tempfile.mkdtemp()
+        try:
+            wallet = NewWallet(WalletStorage(os.path.join(user_dir, 'somewallet')))
+            network = FakeNetwork(10, self.headers)
+            network.send = lambda *args: self.fail("should not hit the network")
+            wallet.network = network
+            wallet.add_verified_tx(TX_HASH, (10, 1234, 2), SIBLINGS)
+            spv = SPV(network, wallet)
+            spv.run()
+            # the block at height 10 was replaced by one with the same transactions
+            self.headers[10] = dict(self.headers[10], timestamp=1300)
+            network.height = 12
+            spv.undo_verifications(10)
+            self.assertNotIn(TX_HASH, wallet.verified_tx)
+            spv.run()
+            self.assertEqual((10, 1300, 2), wallet.verified_tx[TX_HASH])
+            self.assertEqual((2, SIBLINGS), wallet.get_merkle_branch(TX_HASH))
+        finally:
+            shutil.rmtree(user_dir)
+
+    def test_requests_only_on_events(self):
+        self.wallet.unverified_tx[TX_HASH] = 11
+        network = FakeNetwork(10, self.headers)
+        sent = []
+        network.send = lambda messages, callback: sent.extend(messages)
+        spv = SPV(network, self.wallet)
+        spv.run()
+        spv.run()
+        self.assertEqual([], sent)
+        self.assertEqual([(11, TX_HASH)], spv.waiting)
+        # a new header releases the waiting transaction
+        network.height = 11
+        spv.run()
+        spv.run()
+        self.assertEqual([('blockchain.transaction.get_merkle', [TX_HASH, 11])], sent)
@@ -1,12 +1,15 @@
 import shutil
 import tempfile
+import threading
 import sys
 import unittest
 import os
 import json
 
 from StringIO import StringIO
-from lib.wallet import WalletStorage, NewWallet
+from lib.lbrycrd import TYPE_ADDRESS, TYPE_CLAIM, TYPE_SUPPORT, EXPIRATION_BLOCKS, SecretToASecret
+from lib.transaction import Transaction
+from lib.wallet import WalletStorage, NewWallet, Imported_Wallet
 
 
 class FakeSynchronizer(object):
@@ -66,6 +69,207 @@ class TestWalletStorage(WalletTestCase):
         self.assertEqual(some_dict, json.loads(contents))
 
 
+class TestSqliteWalletStorage(WalletTestCase):
+
+    def test_write_and_read_back(self):
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        storage.put("a", "b")
+        storage.put("transactions", {"aa": "0100", "bb": "0200"})
+        storage.put("verified_tx3", {"aa": (10, 1000, 1)})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("sqlite", storage.backend)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual({"aa": "0100", "bb": "0200"}, storage.get("transactions"))
+        self.assertEqual({"aa": [10, 1000, 1]}, storage.get("verified_tx3"))
+
+    def test_only_changed_rows_are_written(self):
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        storage.put("transactions", {"aa": "0100", "bb": "0200"})
+        storage.write()
+        storage.put("transactions", {"aa": "0100", "cc": "0300"})
+        self.assertEqual({"transactions": set(["bb", "cc"])}, storage.dirty_rows)
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"aa": "0100", "cc": "0300"}, storage.get("transactions"))
+
+    def test_json_wallet_is_converted(self):
+        with open(self.wallet_path, "w") as f:
+            f.write(json.dumps({"a": "b", "labels": {"x": "y"}}))
+
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        self.assertTrue(os.path.exists(self.wallet_path + '.json.bak'))
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("sqlite", storage.backend)
+        self.assertEqual("b", storage.get("a"))
+        self.assertEqual({"x": "y"}, storage.get("labels"))
+
+
+class TestSharedValues(WalletTestCase):
+
+    def test_shared_value_is_not_copied(self):
+        storage = WalletStorage(self.wallet_path)
+        txi = {"aa": {}}
+        storage.put("txi", txi, copy=False)
+        self.assertIs(txi, storage.get("txi", copy=False))
+        self.assertIsNot(txi, storage.get("txi"))
+
+    def test_changes_in_place_are_written(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.put("txi", {"aa": {}})
+        storage.write()
+
+        storage = WalletStorage(self.wallet_path)
+        txi = storage.get("txi", {}, copy=False)
+        with storage.lock:
+            txi["bb"] = {}
+        storage.put("txi", txi, copy=False)
+        storage.write()
+        with open(self.wallet_path) as f:
+            self.assertEqual({"aa": {}, "bb": {}}, json.load(f)["txi"])
+
+    def test_touched_rows_are_written(self):
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        storage.put("txi", {"aa": {}})
+        storage.write()
+
+        txi = storage.get("txi", {}, copy=False)
+        with storage.lock:
+            txi["bb"] = {}
+        storage.touch("txi", "bb")
+        storage.put("txi", txi, copy=False)
+        self.assertEqual({"txi": set(["bb"])}, storage.dirty_rows)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"aa": {}, "bb": {}}, storage.get("txi"))
+
+    def test_wallet_reports_changed_rows(self):
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        wallet = NewWallet(storage)
+        wallet.set_label('x', 'y')
+        wallet.transactions['aa'] = FakeTransaction([], [1000], 10)
+        wallet.save_transactions()
+        storage.collect_changes()
+        self.assertEqual(set(['x']), storage.dirty_rows['labels'])
+        self.assertEqual(set(['aa']), storage.dirty_rows['transactions'])
+        storage.write()
+        wallet.set_label('x', None)
+        storage.collect_changes()
+        self.assertEqual({'labels': set(['x'])}, storage.dirty_rows)
+
+    def test_shared_dicts_record_their_changes(self):
+        storage = WalletStorage(self.wallet_path, 'sqlite')
+        storage.put("txi", {"aa": {}, "bb": {}})
+        storage.write()
+
+        txi = storage.get("txi", {}, copy=False)
+        with storage.lock:
+            txi["cc"] = {}
+            txi.pop("aa")
+            txi.setdefault("bb", {})["addr"] = []
+        storage.put("txi", txi, copy=False)
+        storage.collect_changes()
+        self.assertEqual({"txi": set(["aa", "bb", "cc"])}, storage.dirty_rows)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"bb": {"addr": []}, "cc": {}}, storage.get("txi"))
+
+    def test_default_is_shared(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.write()
+        labels = storage.get("labels", {}, copy=False)
+        with storage.lock:
+            labels["x"] = "y"
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"x": "y"}, storage.get("labels"))
+
+    def test_shared_dicts_are_changed_holding_the_lock(self):
+        storage = WalletStorage(self.wallet_path)
+        txi = storage.get("txi", {}, copy=False)
+        self.assertRaises(RuntimeError, txi.__setitem__, "aa", {})
+        self.assertRaises(RuntimeError, txi.pop, "aa", None)
+        with storage.lock.read():
+            self.assertRaises(RuntimeError, txi.update, {"aa": {}})
+        with storage.lock:
+            txi["aa"] = {}
+        self.assertEqual({"aa": {}}, txi)
+        # copies are not shared
+        copied = storage.get("txi")
+        copied["bb"] = {}
+        self.assertEqual(dict, type(copied))
+
+    def test_wallet_changes_shared_dicts_holding_the_lock(self):
+        wallet = NewWallet(WalletStorage(self.wallet_path))
+        wallet.network = FakeNetwork(100)
+        wallet.set_label('x', 'y')
+        wallet.receive_history_callback('addr', [('aa', 10)])
+        wallet.add_verified_tx('aa', (10, 1000, 0))
+        wallet.undo_verifications(10)
+        self.assertEqual({'x': 'y'}, wallet.labels)
+        self.assertEqual({'aa': ['addr']}, wallet.tx_addr_hist)
+
+
+class TestWalletJournal(WalletTestCase):
+
+    def setUp(self):
+        super(TestWalletJournal, self).setUp()
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put("a", "b")
+        storage.put("transactions", {"aa": "0100", "bb": "0200"})
+        storage.write()
+        self.journal_path = self.wallet_path + '.journal'
+
+    def test_changes_are_appended_and_replayed(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put("transactions", {"aa": "0100", "cc": "0300"})
+        storage.put("a", None)
+        storage.write()
+        with open(self.journal_path) as f:
+            self.assertEqual(3, len(f.readlines()))
+
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual({"aa": "0100", "cc": "0300"}, storage.get("transactions"))
+        self.assertEqual(None, storage.get("a"))
+
+    def test_truncated_record_is_ignored(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put("a", "c")
+        storage.write()
+        with open(self.journal_path, "a") as f:
+            f.write('{"key": "a", "val')
+
+        storage = WalletStorage(self.wallet_path, journal=True)
+        self.assertEqual("c", storage.get("a"))
+        storage.put("d", "e")
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("e", storage.get("d"))
+
+    def test_compact_removes_journal(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put("a", "c")
+        storage.write()
+        storage.compact()
+        self.assertFalse(os.path.exists(self.journal_path))
+        with open(self.wallet_path) as f:
+            self.assertEqual("c", json.load(f)["a"])
+
+    def test_failed_append_keeps_changes(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put("a", "c")
+        os.mkdir(self.journal_path)
+        self.assertRaises(IOError, storage.write)
+        self.assertTrue(storage.modified)
+        self.assertEqual(set(["a"]), storage.dirty_keys)
+        os.rmdir(self.journal_path)
+        storage.write()
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual("c", storage.get("a"))
+
+
 class TestNewWallet(WalletTestCase):
 
     seed_text = "travel nowhere air position hill peace suffer parent beautiful rise blood power home crumble teach"
@@ -108,3 +312,680 @@ class TestNewWallet(WalletTestCase):
         new_password = "secret2"
         self.wallet.update_password(self.password, new_password)
         self.wallet.get_seed(new_password)
+
+    def check_address_index(self, wallet):
+        for acc_id, account in wallet.accounts.items():
+            for for_change in [0, 1]:
+                for n, address in enumerate(account.get_addresses(for_change)):
+                    self.assertTrue(wallet.is_mine(address))
+                    self.assertEqual((acc_id, (for_change, n)), wallet.get_address_index(address))
+
+    def test_address_index(self):
+        self.wallet.synchronize()
+        self.wallet.create_new_address(for_change=1)
+        self.check_address_index(self.wallet)
+        self.assertFalse(self.wallet.is_mine(self.import_key_address))
+
+        self.storage.write()
+        self.check_address_index(NewWallet(WalletStorage(self.wallet_path)))
+
+    def test_imported_address_index(self):
+        # imported in another order than their sorted one
+        wallet = Imported_Wallet(WalletStorage(os.path.join(self.user_dir, "imported")))
+        for i in [1, 2, 3]:
+            wallet.import_key(SecretToASecret(chr(i) * 32, True), None)
+        self.check_address_index(wallet)
+        wallet.delete_imported_key('bPphJHGWRpgP8tUhJF617EyXpPjtE9xzp5')
+        self.assertFalse(wallet.is_mine('bPphJHGWRpgP8tUhJF617EyXpPjtE9xzp5'))
+        self.check_address_index(wallet)
+
+
+class FakeNetwork(object):
+
+    def __init__(self, height):
+        self.height = height
+        self.events = []
+
+    def get_local_height(self):
+        return self.height
+
+    def trigger_callback(self, event, *args):
+        self.events.append((event,) + args)
+
+
+class TestVerifiedTransactions(WalletTestCase):
+
+    def setUp(self):
+        super(TestVerifiedTransactions, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        self.wallet.network = FakeNetwork(100)
+
+    def test_undo_verifications_above_fork(self):
+        for i, height in enumerate([10, 50, 50, 70, 90]):
+            self.wallet.add_verified_tx('tx%d' % i, (height, 1000 + i, i))
+        undone = self.wallet.undo_verifications(50)
+        self.assertEqual(['tx1', 'tx2', 'tx3', 'tx4'], undone)
+        self.assertEqual(['tx0'], self.wallet.verified_tx.keys())
+        self.assertEqual({'tx1': 50, 'tx2': 50, 'tx3': 70, 'tx4': 90}, self.wallet.unverified_tx)
+        self.assertEqual([(10, 0, 'tx0')], self.wallet.verified_tx_index)
+        self.assertEqual({'tx0': (10, 1000, 0)}, self.storage.get('verified_tx3'))
+
+    def test_reverified_tx_is_reindexed(self):
+        self.assertEqual([], self.wallet.get_verified_tx_index())
+        self.wallet.add_verified_tx('tx', (10, 1000, 3))
+        self.wallet.add_verified_tx('tx', (20, 2000, 1))
+        self.assertEqual([(20, 1, 'tx')], self.wallet.verified_tx_index)
+        self.assertEqual([], self.wallet.undo_verifications(21))
+        self.assertEqual(['tx'], self.wallet.undo_verifications(20))
+
+    def test_undo_verifications_keeps_merkle_branches(self):
+        self.wallet.add_verified_tx('tx0', (10, 1000, 0), ['00' * 32])
+        self.wallet.add_verified_tx('tx1', (60, 2000, 0), ['11' * 32])
+        self.wallet.undo_verifications(50)
+        self.assertEqual((0, ['11' * 32]), self.wallet.get_merkle_branch('tx1'))
+        self.assertEqual(['tx0', 'tx1'], sorted(self.storage.get('merkle_branches').keys()))
+        # a transaction verified without a branch drops the stored one
+        self.wallet.add_verified_tx('tx1', (61, 2000, 0))
+        self.assertEqual(['tx0'], self.wallet.get_merkle_branch_txs())
+
+
+class TestScheduledSaves(WalletTestCase):
+
+    def setUp(self):
+        super(TestScheduledSaves, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.wallet = NewWallet(self.storage)
+        self.wallet.network = FakeNetwork(100)
+        self.wallet.save_max_changes = 3
+
+    def add_tx(self, tx_hash):
+        self.wallet.transactions[tx_hash] = Transaction('00')
+        self.wallet.schedule_save()
+
+    def test_changes_are_coalesced(self):
+        self.add_tx('aa')
+        self.add_tx('bb')
+        self.assertEqual({}, self.storage.get('transactions', {}))
+        self.add_tx('cc')
+        self.assertEqual(['aa', 'bb', 'cc'], sorted(self.storage.get('transactions')))
+        self.assertEqual(0, self.wallet.unsaved_changes)
+
+    def test_changes_are_saved_after_interval(self):
+        self.add_tx('aa')
+        self.wallet.save_if_due()
+        self.assertEqual({}, self.storage.get('transactions', {}))
+        self.wallet.last_save -= self.wallet.save_interval
+        self.wallet.save_if_due()
+        self.assertEqual(['aa'], self.storage.get('transactions').keys())
+
+    def test_write_saves_pending_changes(self):
+        with self.storage.lock:
+            self.wallet.txi['aa'] = {}
+        self.add_tx('aa')
+        self.storage.write()
+        self.assertEqual(0, self.wallet.unsaved_changes)
+        storage = WalletStorage(self.wallet_path)
+        self.assertEqual(['aa'], storage.get('transactions').keys())
+        self.assertEqual({'aa': {}}, storage.get('txi'))
+
+
+class FakeTransaction(object):
+
+    def __init__(self, inputs, values, size, address=None):
+        self._inputs = [{'prevout_hash': h, 'prevout_n': n, 'address': address} for h, n in inputs]
+        self._outputs = [(TYPE_ADDRESS if address else 0, address, v) for v in values]
+        self.size = size
+
+    def deserialize(self):
+        pass
+
+    def inputs(self):
+        return self._inputs
+
+    def outputs(self):
+        return self._outputs
+
+    def output_value(self):
+        return sum(v for t, a, v in self._outputs)
+
+    def get_outputs(self):
+        return [(a, v) for t, a, v in self._outputs]
+
+    def raw_bytes(self):
+        return '\x00' * self.size
+
+    def __str__(self):
+        return '00' * self.size
+
+
+class TestUnconfirmedTransactions(WalletTestCase):
+
+    def setUp(self):
+        super(TestUnconfirmedTransactions, self).setUp()
+        self.wallet = NewWallet(WalletStorage(self.wallet_path))
+
+    def test_history_updates_index(self):
+        self.wallet.receive_history_callback('addr', [('a', 5), ('b', 0), ('c', -1)])
+        self.assertEqual(set(['b', 'c']), set(self.wallet.get_unconfirmed_txs()))
+        self.wallet.receive_history_callback('addr', [('a', 5), ('b', 6), ('c', 0)])
+        self.assertEqual(['c'], self.wallet.get_unconfirmed_txs())
+        self.assertEqual(0, self.wallet.get_unconfirmed_info('c')['height'])
+        self.assertEqual(None, self.wallet.get_unconfirmed_info('b'))
+
+    def test_fee_and_parents(self):
+        self.wallet.receive_history_callback('addr', [('a', 5), ('b', 0), ('c', 0)])
+        self.wallet.transactions['a'] = FakeTransaction([], [10000], 100)
+        self.wallet.transactions['b'] = FakeTransaction([('a', 0)], [6000, 3000], 250)
+        self.wallet.transactions['c'] = FakeTransaction([('b', 1)], [2500], 200)
+        info = self.wallet.get_unconfirmed_info('b')
+        self.assertEqual(1000, info['fee'])
+        self.assertEqual(4000, info['fee_rate'])
+        self.assertEqual(set(), info['parents'])
+        self.assertEqual(set(['b']), self.wallet.get_unconfirmed_parents('c'))
+        self.assertEqual(set(['b']), self.wallet.get_unconfirmed_ancestors('c'))
+
+
+class FundedWalletTestCase(WalletTestCase):
+
+    def setUp(self):
+        super(FundedWalletTestCase, self).setUp()
+        self.wallet = NewWallet(WalletStorage(self.wallet_path))
+        self.wallet.add_seed(TestNewWallet.seed_text, None)
+        self.wallet.create_master_keys(None)
+        self.wallet.create_main_account()
+        self.wallet.synchronize()
+        self.addr = self.wallet.addresses(False)[0]
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0)])
+        self.wallet.receive_tx_callback('a', FakeTransaction([('f', 0)], [10000, 5000], 100, self.addr), 10)
+        self.wallet.receive_tx_callback('b', FakeTransaction([('a', 0)], [6000], 100, self.addr), 0)
+
+
+class TestUtxoIndex(FundedWalletTestCase):
+
+    def get_coins(self):
+        return sorted((c['prevout_hash'], c['prevout_n'], c['value'], c['height'])
+                      for c in self.wallet.get_spendable_coins())
+
+    def test_spent_outputs_are_removed(self):
+        self.assertEqual([('a', 1, 5000, 10), ('b', 0, 6000, 0)], self.get_coins())
+        self.assertEqual({'a:1': (10, 5000, False), 'b:0': (0, 6000, False)},
+                         self.wallet.get_addr_utxo(self.addr))
+
+    def test_height_follows_history(self):
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 11)])
+        self.assertEqual([('a', 1, 5000, 10), ('b', 0, 6000, 11)], self.get_coins())
+
+    def test_removed_transaction_restores_coins(self):
+        self.wallet.receive_history_callback(self.addr, [('a', 10)])
+        self.assertEqual([('a', 0, 10000, 10), ('a', 1, 5000, 10)], self.get_coins())
+
+    def test_index_is_rebuilt_on_load(self):
+        self.wallet.storage.write()
+        wallet = NewWallet(WalletStorage(self.wallet_path))
+        self.assertEqual(self.wallet.utxos, wallet.utxos)
+
+    def test_frozen_addresses_are_excluded(self):
+        self.wallet.set_frozen_state([self.addr], True)
+        self.assertEqual([], self.wallet.get_spendable_coins())
+        self.assertEqual(2, len(self.wallet.get_spendable_coins(exclude_frozen=False)))
+
+    def test_unconfirmed_coins(self):
+        coins = self.wallet.get_spendable_coins()
+        self.assertEqual([('a', False), ('b', True)],
+                         sorted((c['prevout_hash'], c['unconfirmed']) for c in coins))
+        coins = self.wallet.get_spendable_coins(confirmed_only=True)
+        self.assertEqual(['a'], [c['prevout_hash'] for c in coins])
+
+    def test_unconfirmed_fee_deficit(self):
+        # b pays 4000 for 100 bytes
+        self.assertEqual(1000, self.wallet.get_unconfirmed_fee_deficit(['b'], 50000))
+        self.assertEqual(0, self.wallet.get_unconfirmed_fee_deficit(['b'], 40000))
+        self.assertEqual(0, self.wallet.get_unconfirmed_fee_deficit(['a'], 50000))
+
+
+class TestBalanceCache(FundedWalletTestCase):
+
+    def test_balance_is_cached(self):
+        self.assertEqual((15000, -4000, 0), self.wallet.get_balance())
+        self.assertEqual((15000, -4000, 0, None), self.wallet.addr_balances[(self.addr, False)])
+        self.assertIn((('wallet',), False), self.wallet.balance_totals)
+
+    def test_account_and_wallet_totals_are_kept_apart(self):
+        change = self.wallet.accounts['0'].get_addresses(1)[0]
+        self.wallet.receive_history_callback(change, [('c', 12)])
+        self.wallet.receive_tx_callback('c', FakeTransaction([('g', 0)], [7000], 100, change), 12)
+        # the account total of all accounts leaves out the change addresses
+        self.assertEqual((15000, -4000, 0), self.wallet.get_account_balance(None))
+        self.assertEqual((22000, -4000, 0), self.wallet.get_balance())
+        self.assertEqual((15000, -4000, 0), self.wallet.get_account_balance(None))
+
+    def test_history_change_invalidates_address(self):
+        self.wallet.get_balance()
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 11)])
+        self.assertNotIn((self.addr, False), self.wallet.addr_balances)
+        self.assertEqual((11000, 0, 0), self.wallet.get_balance())
+
+    def test_coinbase_maturity_expires_cache(self):
+        network = FakeNetwork(50)
+        self.wallet.network = network
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 11), ('cb', 20)])
+        tx = FakeTransaction([], [7000], 100, self.addr)
+        tx._inputs = [{'is_coinbase': True, 'address': None}]
+        self.wallet.receive_tx_callback('cb', tx, 20)
+        self.assertEqual((11000, 0, 7000), self.wallet.get_balance())
+        network.height = 119
+        self.assertEqual((11000, 0, 7000), self.wallet.get_balance())
+        network.height = 120
+        self.assertEqual((18000, 0, 0), self.wallet.get_balance())
+
+
+class TestRemoveTransaction(FundedWalletTestCase):
+
+    def test_spends_of_removed_tx_are_pruned(self):
+        self.wallet.remove_transaction('a')
+        self.assertEqual({}, self.wallet.txi['b'])
+        self.assertEqual({'a:0': 'b'}, self.wallet.pruned_txo)
+        self.assertEqual({'a:0': 'b'}, self.wallet.spent_outpoints)
+
+        self.wallet.add_transaction('a', self.wallet.transactions['a'])
+        self.assertEqual({self.addr: [('a:0', 10000)]}, self.wallet.txi['b'])
+        self.assertEqual({'f:0': 'a'}, self.wallet.pruned_txo)
+
+    def test_removed_spender_releases_outpoints(self):
+        self.wallet.remove_transaction('b')
+        self.assertNotIn('b', self.wallet.txi)
+        self.assertEqual({'f:0': 'a'}, self.wallet.spent_outpoints)
+        self.assertIn('a:0', self.wallet.utxos)
+
+
+class TestLazyTransactions(WalletTestCase):
+
+    raw_tx = ('01000000012a5c9a94fcde98f5581cd00162c60a13936ceb75389ea65bf38633b424eb403100000000'
+              '6c493046022100a82bbc57a0136751e5433f41cf000b3f1a99c6744775e76ec764fb78c54ee100022100'
+              'f9e80b7de89de861dc6fb0c1429d5da72c2b6b2ee2406bc9bfb1beedd729d985012102e61d176da16edd'
+              '1d258a200ad9759ef63adf8e14cd97f53227bae35cdb84d2f6ffffffff0140420f00000000001976a914'
+              '230ac37834073a42146f11ef8414ae929feaafc388ac00000000')
+
+    def setUp(self):
+        super(TestLazyTransactions, self).setUp()
+        self.storage = WalletStorage(self.wallet_path)
+        self.storage.put('transactions', {'t': self.raw_tx.decode('hex')})
+        self.storage.put('txo', {'t': {}})
+
+    def test_claim_index_is_rebuilt_once(self):
+        wallet = NewWallet(self.storage)
+        self.assertIsNotNone(wallet.transactions['t']._inputs)
+        self.assertTrue(self.storage.get('claimtrie_index_complete'))
+        wallet = NewWallet(self.storage)
+        self.assertIsNone(wallet.transactions['t']._inputs)
+
+    def test_warm_up_parses_transactions(self):
+        self.storage.put('claimtrie_index_complete', True)
+        wallet = NewWallet(self.storage)
+        tx = wallet.transactions['t']
+        self.assertIsNone(tx._inputs)
+        self.assertFalse(wallet.warm_up_transactions(10))
+        self.assertIsNotNone(tx._inputs)
+        self.assertEqual(1, len(tx.outputs()))
+
+
+class TestDerivedIndexes(FundedWalletTestCase):
+
+    def reload(self):
+        self.wallet.storage.write()
+        return NewWallet(WalletStorage(self.wallet_path))
+
+    def test_indexes_are_saved_and_loaded(self):
+        wallet = self.reload()
+        self.assertTrue(wallet.derived_indexes_saved)
+        self.assertEqual({'a': [self.addr], 'b': [self.addr]}, wallet.tx_addr_hist)
+        self.assertEqual(self.wallet.addresses(True), wallet.addresses(True))
+        self.assertEqual(6, len(wallet.unverified_indexes))
+        self.assertEqual(self.wallet.utxos, wallet.utxos)
+        self.assertEqual(self.wallet.spent_outpoints, wallet.spent_outpoints)
+        self.assertEqual(self.wallet.addr_utxos, wallet.addr_utxos)
+        self.assertEqual({'b': 0}, dict((k, v['height']) for k, v in wallet.unconfirmed_tx.items()))
+        self.assertEqual(self.wallet.unconfirmed_tx['b']['first_seen'],
+                         wallet.unconfirmed_tx['b']['first_seen'])
+        self.assertIsNone(wallet.verified_tx_index)
+
+    def test_saved_indexes_are_verified(self):
+        storage = self.wallet.storage
+        addresses = storage.get('account_addresses')
+        addresses['0'][0][0] = 'bogus'
+        storage.put('account_addresses', addresses)
+        storage.put('tx_addr_hist', {'a': [self.addr], 'c': [self.addr]})
+        wallet = self.reload()
+        self.assertTrue(wallet.is_mine('bogus'))
+        while wallet.verify_derived_indexes():
+            pass
+        self.assertFalse(wallet.is_mine('bogus'))
+        self.assertTrue(wallet.is_mine(self.addr))
+        self.assertEqual({'a': [self.addr], 'b': [self.addr]}, wallet.tx_addr_hist)
+        self.assertEqual(self.addr, wallet.storage.get('account_addresses')['0'][0][0])
+
+    def test_saved_utxo_index_is_verified(self):
+        storage = self.wallet.storage
+        storage.put('utxos', {'a:1': [self.addr, 5000, 10, False, 0]})
+        storage.put('spent_outpoints', {})
+        storage.put('unconfirmed_txs', {'c': [0, 1]})
+        wallet = self.reload()
+        self.assertEqual(['a:1'], wallet.utxos.keys())
+        while wallet.verify_derived_indexes():
+            pass
+        self.assertEqual(self.wallet.utxos, wallet.utxos)
+        self.assertEqual(self.wallet.spent_outpoints, wallet.spent_outpoints)
+        self.assertEqual(['b'], wallet.unconfirmed_tx.keys())
+        wallet.storage.write()
+        self.assertEqual(['a:1', 'b:0'], sorted(WalletStorage(self.wallet_path).get('utxos')))
+
+    def test_other_version_is_rebuilt(self):
+        self.wallet.storage.put('derived_index_version', 0)
+        self.wallet.storage.put('tx_addr_hist', {})
+        wallet = self.reload()
+        self.assertFalse(wallet.derived_indexes_saved)
+        self.assertEqual([], wallet.unverified_indexes)
+        self.assertEqual({'a': [self.addr], 'b': [self.addr]}, wallet.tx_addr_hist)
+
+
+class TestBinaryTransactions(WalletTestCase):
+
+    raw_tx = TestLazyTransactions.raw_tx
+
+    def check_round_trip(self, storage):
+        storage.put('transactions', {'t': self.raw_tx.decode('hex')})
+        storage.write()
+        self.assertEqual({'t': self.raw_tx.decode('hex')},
+                         WalletStorage(self.wallet_path).get('transactions'))
+
+    def test_json_file_holds_hex(self):
+        self.check_round_trip(WalletStorage(self.wallet_path))
+        with open(self.wallet_path) as f:
+            self.assertEqual({'t': self.raw_tx}, json.load(f)['transactions'])
+
+    def test_journal_round_trip(self):
+        storage = WalletStorage(self.wallet_path, journal=True)
+        storage.put('labels', {})
+        storage.write()
+        self.check_round_trip(storage)
+        self.assertTrue(os.path.exists(storage.journal_path))
+
+    def test_sqlite_round_trip(self):
+        self.check_round_trip(WalletStorage(self.wallet_path, backend='sqlite'))
+
+    def test_transaction_keeps_bytes(self):
+        tx = Transaction(self.raw_tx)
+        self.assertEqual(self.raw_tx.decode('hex'), tx.raw_bytes())
+        self.assertEqual(self.raw_tx, tx.raw)
+        self.assertEqual(self.raw_tx, str(tx))
+        self.assertEqual(Transaction.from_bytes(tx.raw_bytes()).hash(), tx.hash())
+        self.assertEqual(1, len(Transaction.from_bytes(tx.raw_bytes()).outputs()))
+
+
+class TestHistoryIndex(FundedWalletTestCase):
+
+    def rows(self, **kwargs):
+        return [(tx_hash, delta, balance) for tx_hash, conf, delta, timestamp, balance
+                in self.wallet.get_history_page(**kwargs)]
+
+    def test_matches_full_history(self):
+        self.wallet.network = FakeNetwork(100)
+        self.assertEqual(self.wallet.get_history(), self.wallet.get_history_page())
+        self.assertEqual([('a', None, 15000), ('b', -4000, 11000)], self.rows())
+
+    def test_pagination(self):
+        self.assertEqual([('a', None, 15000)], self.rows(limit=1))
+        self.assertEqual([('b', -4000, 11000)], self.rows(offset=1))
+        self.assertEqual([('b', -4000, 11000)], self.rows(since_txid='a'))
+        self.assertEqual([], self.rows(since_txid='b'))
+        self.assertEqual([('b', -4000, 11000)], self.rows(since_height=11))
+        self.assertRaises(BaseException, self.rows, since_txid='c')
+
+    def test_rows_follow_changes(self):
+        self.wallet.get_history_page()
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0), ('c', 0)])
+        self.wallet.receive_tx_callback('c', FakeTransaction([('b', 0)], [1000], 100, self.addr), 0)
+        self.assertEqual([('c', -5000, 6000)], self.rows(since_txid='b'))
+        # c confirms before b, so it moves ahead of it
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0), ('c', 12)])
+        self.assertEqual(['a', 'c', 'b'], [row[0] for row in self.rows()])
+        self.wallet.receive_history_callback(self.addr, [('a', 10)])
+        self.assertEqual([('a', None, 15000)], self.rows())
+
+
+class TestWalletDeltas(FundedWalletTestCase):
+
+    def test_deltas(self):
+        deltas = self.wallet.get_wallet_deltas(['a', 'b'])
+        # 'a' spends an output the wallet does not know
+        self.assertEqual((True, True, 0, None), deltas['a'])
+        self.assertEqual((True, True, -4000, -4000), deltas['b'])
+        self.assertEqual(deltas['b'], self.wallet.get_wallet_delta(self.wallet.transactions['b']))
+
+    def test_cache_follows_spent_outputs(self):
+        self.wallet.get_wallet_deltas(['a', 'b'])
+        self.assertIn('b', self.wallet.wallet_deltas)
+        self.wallet.remove_transaction('a')
+        self.assertNotIn('b', self.wallet.wallet_deltas)
+        self.assertEqual((True, True, 0, None), self.wallet.get_wallet_deltas(['b'])['b'])
+        self.wallet.add_transaction('a', self.wallet.transactions['a'])
+        self.assertEqual((True, True, -4000, -4000), self.wallet.get_wallet_deltas(['b'])['b'])
+
+    def test_history_uses_cache(self):
+        # 'a' spends a pruned output, so its delta is unknown
+        self.assertEqual([('a', None, 15000), ('b', -4000, 11000)],
+                         [(row[0], row[2], row[4]) for row in self.wallet.get_history_page()])
+        self.assertEqual(['b'], self.wallet.wallet_deltas.keys())
+        self.wallet.wallet_deltas['b'] = (True, True, -3000, None)
+        self.assertEqual(-3000, self.wallet.get_history([self.addr])[1][2])
+
+    def test_new_addresses_clear_cache(self):
+        self.wallet.get_wallet_deltas(['a'])
+        self.wallet.create_new_address(for_change=0)
+        self.assertEqual({}, self.wallet.wallet_deltas)
+
+
+class TestClaimRegistry(FundedWalletTestCase):
+
+    claim_tx = 'cc' * 32
+
+    def setUp(self):
+        super(TestClaimRegistry, self).setUp()
+        hist = [('a', 10), ('b', 0), (self.claim_tx, 20)]
+        self.wallet.receive_history_callback(self.addr, hist)
+        tx = FakeTransaction([('b', 0)], [], 100, self.addr)
+        tx._outputs = [(TYPE_ADDRESS | TYPE_CLAIM, (('name1', 'value'), self.addr), 4000),
+                       (TYPE_ADDRESS | TYPE_SUPPORT, (('name2', '\x01' * 20), self.addr), 1000)]
+        self.wallet.receive_tx_callback(self.claim_tx, tx, 20)
+
+    def test_claims_are_indexed(self):
+        claims = self.wallet.get_name_claims()
+        self.assertEqual(['claim', 'support'], [c['category'] for c in claims])
+        claim, support = claims
+        self.assertEqual(('name1', 'value', '0.00004', 20), (claim['name'], claim['value'],
+                                                             claim['amount'], claim['height']))
+        self.assertEqual('01' * 20, support['claim_id'])
+        self.assertEqual([claim], self.wallet.get_name_claims(claim_id=claim['claim_id']))
+        self.assertEqual([support], self.wallet.get_name_claims(name='name2'))
+        self.assertEqual([support], self.wallet.get_name_claims(category='support'))
+        self.assertEqual([], self.wallet.get_name_claims(domain=['bogus']))
+        self.assertEqual([], self.wallet.get_name_claims(expires_before=20 + EXPIRATION_BLOCKS))
+        self.assertEqual(2, len(self.wallet.get_name_claims(expires_before=21 + EXPIRATION_BLOCKS)))
+
+    def test_spent_and_removed_claims(self):
+        spend = FakeTransaction([(self.claim_tx, 1)], [900], 100, self.addr)
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0), (self.claim_tx, 20), ('d', 0)])
+        self.wallet.receive_tx_callback('d', spend, 0)
+        self.assertEqual([False, True], [c['is_spent'] for c in self.wallet.get_name_claims()])
+        self.assertEqual(['claim'], [c['category'] for c in self.wallet.get_name_claims(include_spent=False)])
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0)])
+        self.assertEqual([], self.wallet.get_name_claims())
+        self.assertEqual({}, self.wallet.claims_by_name)
+        self.assertEqual([], self.wallet.claim_expirations)
+
+    def test_height_updates_expiration(self):
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0), (self.claim_tx, 25)])
+        self.assertEqual([25 + EXPIRATION_BLOCKS] * 2, [h for h, ser in self.wallet.claim_expirations])
+
+    def test_claims_are_saved(self):
+        self.wallet.storage.write()
+        wallet = NewWallet(WalletStorage(self.wallet_path))
+        wallet.network = self.wallet.network
+        self.assertEqual(self.wallet.get_name_claims(), wallet.get_name_claims())
+        self.assertEqual(self.wallet.claim_expirations, wallet.claim_expirations)
+        self.assertEqual(self.wallet.claims_by_name, wallet.claims_by_name)
+        # the claim transaction was not parsed
+        self.assertIsInstance(dict.get(wallet.transactions, self.claim_tx), str)
+
+
+class TestClaimExpirations(TestClaimRegistry):
+
+    def setUp(self):
+        super(TestClaimExpirations, self).setUp()
+        self.network = FakeNetwork(100)
+        self.wallet.network = self.network
+        self.wallet.claim_expiring_blocks = 10
+        self.expiration = 20 + EXPIRATION_BLOCKS
+        self.wallet.check_claim_expirations(100)
+
+    def events(self):
+        events = [(e, c['category']) for e, c in self.network.events if e.startswith('claim_')]
+        self.network.events = []
+        return events
+
+    def test_events(self):
+        self.wallet.check_claim_expirations(self.expiration - 11)
+        self.assertEqual([], self.events())
+        self.wallet.check_claim_expirations(self.expiration - 10)
+        self.assertEqual([('claim_expiring', 'claim'), ('claim_expiring', 'support')], self.events())
+        self.wallet.check_claim_expirations(self.expiration - 1)
+        self.assertEqual([], self.events())
+        self.wallet.check_claim_expirations(self.expiration + 5)
+        self.assertEqual([('claim_expired', 'claim'), ('claim_expired', 'support')], self.events())
+        # a reorg does not report them again
+        self.wallet.check_claim_expirations(self.expiration - 2)
+        self.wallet.check_claim_expirations(self.expiration + 6)
+        self.assertEqual([], self.events())
+        self.assertEqual(self.expiration + 6, self.wallet.storage.get('claim_expiry_height'))
+
+    def test_spent_claims_are_skipped(self):
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0), (self.claim_tx, 20), ('d', 0)])
+        self.wallet.receive_tx_callback('d', FakeTransaction([(self.claim_tx, 1)], [900], 100, self.addr), 0)
+        self.wallet.check_claim_expirations(self.expiration)
+        self.assertEqual([('claim_expired', 'claim')], self.events())
+
+    def test_renewals_are_queued(self):
+        self.wallet.claim_auto_renew = True
+        self.wallet.check_claim_expirations(self.expiration - 5)
+        self.wallet.check_claim_expirations(self.expiration - 4)
+        self.assertEqual(['claim'], [c['category'] for c in self.wallet.get_claim_renewals()])
+        self.assertEqual({self.claim_tx + ':0': 0}, self.wallet.storage.get('claim_renewals'))
+
+    def test_first_check_reports_expiring_claims(self):
+        self.wallet.claim_expiry_height = None
+        self.wallet.claim_auto_renew = True
+        self.wallet.check_claim_expirations(self.expiration - 5)
+        self.assertEqual([('claim_expiring', 'claim'), ('claim_expiring', 'support')], self.events())
+        self.assertTrue(self.wallet.has_due_claim_renewals())
+
+    def test_renewals_stay_queued_until_spent(self):
+        self.wallet.claim_auto_renew = True
+        self.wallet.check_claim_expirations(self.expiration - 5)
+        self.wallet.reschedule_claim_renewal(self.claim_tx + ':0')
+        self.assertFalse(self.wallet.has_due_claim_renewals())
+        self.assertEqual([], self.wallet.get_claim_renewals())
+        self.wallet.claim_renewals[self.claim_tx + ':0'] = 0
+        self.assertEqual(1, len(self.wallet.get_claim_renewals()))
+        self.wallet.receive_history_callback(self.addr, [('a', 10), ('b', 0), (self.claim_tx, 20), ('d', 0)])
+        self.wallet.receive_tx_callback('d', FakeTransaction([(self.claim_tx, 0)], [900], 100, self.addr), 0)
+        self.assertEqual([], self.wallet.get_claim_renewals())
+        self.assertEqual({}, self.wallet.claim_renewals)
+
+    def test_queued_renewal_is_not_sent_again(self):
+        ser = self.claim_tx + ':0'
+        self.wallet.claim_auto_renew = True
+        self.wallet.check_claim_expirations(self.expiration - 5)
+        renewal = FakeTransaction([(self.claim_tx, 0)], [900], 100, self.addr)
+        renewal.hash = lambda: 'tx'
+        self.wallet.add_pending_broadcast(renewal, 0)
+        self.wallet.reschedule_claim_renewal(ser, 'tx')
+        self.wallet.claim_renewals[ser] = 0
+        self.assertFalse(self.wallet.has_due_claim_renewals())
+        self.assertEqual([], self.wallet.get_claim_renewals())
+        # the renewal was dropped by the broadcaster
+        self.wallet.remove_pending_broadcast('tx')
+        self.assertTrue(self.wallet.has_due_claim_renewals())
+        self.assertEqual([ser], ['%s:%d' % (c['txid'], c['nout']) for c in self.wallet.get_claim_renewals()])
+
+
+class TestCompactRecords(FundedWalletTestCase):
+
+    def reload(self):
+        self.wallet.storage.write()
+        return NewWallet(WalletStorage(self.wallet_path))
+
+    def test_loaded_data_is_compact(self):
+        wallet = self.reload()
+        self.assertEqual([str], list(set(map(type, wallet.history.keys() + wallet.txi.keys() + wallet.txo.keys()))))
+        self.assertEqual([('a', 10), ('b', 0)], wallet.history[self.addr])
+        self.assertEqual([(0, 10000, False), (1, 5000, False)], wallet.txo['a'][self.addr])
+        self.assertEqual([('a:0', 10000)], wallet.txi['b'][self.addr])
+        self.assertIs(type(wallet.txi['b'][self.addr][0][0]), str)
+        self.assertIs(wallet.history[self.addr][0][0], wallet.txo.keys()[wallet.txo.keys().index('a')])
+
+    def test_file_layout_is_unchanged(self):
+        self.wallet.storage.write()
+        with open(self.wallet_path) as f:
+            saved = json.load(f)
+        wallet = NewWallet(WalletStorage(self.wallet_path))
+        wallet.save_transactions(write=True)
+        with open(self.wallet_path) as f:
+            resaved = json.load(f)
+        for key in ['addr_history', 'txi', 'txo', 'pruned_txo', 'tx_addr_hist', 'transactions']:
+            self.assertEqual(saved[key], resaved[key])
+
+
+class TestConcurrentReads(FundedWalletTestCase):
+
+    def test_reads_during_sync(self):
+        wallet = self.wallet
+        wallet.network = FakeNetwork(1000)
+        stop = threading.Event()
+        errors = []
+        reads = []
+
+        def read():
+            try:
+                n = 0
+                while not stop.is_set():
+                    coins = [c[0] for c in wallet.get_utxos()]
+                    self.assertEqual(len(set(coins)), len(coins))
+                    wallet.get_balance()
+                    wallet.get_history_page(limit=10)
+                    wallet.get_addr_io(self.addr)
+                    wallet.get_confirmations('a')
+                    wallet.get_name_claims()
+                    n += 1
+                reads.append(n)
+            except Exception as e:
+                errors.append(e)
+        readers = [threading.Thread(target=read) for i in range(4)]
+        for t in readers:
+            t.start()
+        hist = [('a', 10), ('b', 0)]
+        prev = 'b'
+        for i in range(200):
+            tx_hash = 't%d' % i
+            hist.append((tx_hash, 11 + i))
+            wallet.receive_history_callback(self.addr, list(hist))
+            wallet.receive_tx_callback(tx_hash, FakeTransaction([(prev, 0)], [6000], 100, self.addr), 11 + i)
+            wallet.add_verified_tx(tx_hash, (11 + i, 0, 0))
+            prev = tx_hash
+        stop.set()
+        for t in readers:
+            t.join()
+        self.assertEqual([], errors)
+        self.assertEqual(4, len(reads))
+        self.assertEqual([5000, 6000], sorted(c[2] for c in wallet.get_utxos()))
+        self.assertEqual(len(hist), len(wallet.get_history_page()))
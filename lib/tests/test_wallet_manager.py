@@ -0,0 +1,142 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from lib.broadcaster import Broadcaster
+from lib.wallet import NewWallet, WalletStorage
+from lib.wallet_manager import WalletManager
+from lib.tests.test_broadcaster import FakeTransaction
+
+
+class FakeNetwork(object):
+
+    def __init__(self):
+        self.subscriptions = {}
+
+    def send(self, messages, callback):
+        for method, params in messages:
+            self.subscriptions.setdefault(params[0], []).append(callback)
+
+    def unsubscribe(self, callback):
+        for callbacks in self.subscriptions.values():
+            if callback in callbacks:
+                callbacks.remove(callback)
+
+    def notify(self, addr, status):
+        for callback in list(self.subscriptions.get(addr, [])):
+            callback({'params': [addr], 'result': status})
+
+
+class FakeWallet(object):
+
+    def __init__(self, name, num_txs=1, pending=False):
+        self.history = {name + '_addr': [('t', 1)]}
+        self.transactions = dict(('%s%d' % (name, i), None) for i in range(num_txs))
+        self.pending = pending
+        self.stopped = False
+
+    def addresses(self, include_change):
+        return self.history.keys()
+
+    def get_address_history(self, addr):
+        return self.history.get(addr, [])
+
+    def get_status(self, h):
+        return 'status:%r' % (h,) if h else None
+
+    def get_pending_broadcasts(self):
+        return [{'txid': 't'}] if self.pending else []
+
+    def stop_threads(self):
+        self.stopped = True
+
+
+class TestWalletManager(unittest.TestCase):
+
+    def setUp(self):
+        self.network = FakeNetwork()
+
+    def test_least_recently_used_is_evicted(self):
+        manager = WalletManager(self.network, max_wallets=2)
+        a, b, c = FakeWallet('a'), FakeWallet('b'), FakeWallet('c')
+        manager.add('a', a)
+        manager.add('b', b)
+        self.assertIs(a, manager.get('a'))
+        manager.add('c', c)
+        self.assertEqual(['a', 'c'], [path for path, w in manager.items()])
+        self.assertTrue(b.stopped)
+        self.assertFalse(a.stopped)
+        self.assertIsNone(manager.get('b'))
+
+    def test_transaction_limit(self):
+        manager = WalletManager(self.network, max_transactions=10)
+        manager.add('a', FakeWallet('a', 6))
+        manager.add('b', FakeWallet('b', 3))
+        self.assertEqual(2, len(manager))
+        manager.add('c', FakeWallet('c', 3))
+        self.assertEqual(['b', 'c'], [path for path, w in manager.items()])
+
+    def test_pending_broadcasts_are_kept(self):
+        manager = WalletManager(self.network, max_wallets=1)
+        manager.add('a', FakeWallet('a', pending=True))
+        manager.add('b', FakeWallet('b'))
+        self.assertEqual(['a', 'b'], [path for path, w in manager.items()])
+        manager.add('c', FakeWallet('c'))
+        self.assertEqual(['a', 'c'], [path for path, w in manager.items()])
+
+    def test_pinned_wallets_are_kept(self):
+        manager = WalletManager(self.network, max_wallets=1)
+        a = FakeWallet('a')
+        manager.add('a', a, pin=True)
+        self.assertIs(a, manager.get('a', pin=True))
+        manager.add('b', FakeWallet('b'))
+        self.assertEqual(['a', 'b'], [path for path, w in manager.items()])
+        manager.unpin('a')
+        self.assertFalse(a.stopped)
+        manager.get('b')
+        manager.unpin('a')
+        self.assertTrue(a.stopped)
+        self.assertEqual(['b'], [path for path, w in manager.items()])
+
+    def test_rejected_broadcast_allows_eviction(self):
+        user_dir = tempfile.mkdtemp()
+        try:
+            wallet = NewWallet(WalletStorage(os.path.join(user_dir, 'somewallet')))
+            tx = FakeTransaction()
+            wallet.add_pending_broadcast(tx)
+            manager = WalletManager(self.network, max_wallets=1)
+            manager.add('a', wallet)
+            manager.add('b', FakeWallet('b'))
+            self.assertEqual(['a', 'b'], [path for path, w in manager.items()])
+            Broadcaster(wallet, None).on_broadcast(tx.hash(), {'result': 'bad-txns-inputs-spent'})
+            manager.evict()
+            self.assertEqual(['b'], [path for path, w in manager.items()])
+        finally:
+            shutil.rmtree(user_dir)
+
+    def test_watcher_reports_activity(self):
+        manager = WalletManager(self.network, max_wallets=1)
+        a = FakeWallet('a')
+        manager.add('a', a)
+        manager.add('b', FakeWallet('b'))
+        self.network.notify('a_addr', a.get_status(a.history['a_addr']))
+        self.assertIsNone(manager.pop_active())
+        self.network.notify('a_addr', 'new status')
+        self.network.notify('a_addr', 'newer status')
+        self.assertEqual('a', manager.pop_active())
+        self.assertIsNone(manager.pop_active())
+        # loading the wallet again releases its watcher
+        manager.add('a', FakeWallet('a'))
+        self.assertNotIn('a', manager.watchers)
+        self.assertEqual(['b'], manager.watchers.keys())
+        self.assertEqual([], self.network.subscriptions['a_addr'])
+
+    def test_stop(self):
+        manager = WalletManager(self.network, max_wallets=1)
+        a, b = FakeWallet('a'), FakeWallet('b')
+        manager.add('a', a)
+        manager.add('b', b)
+        manager.stop()
+        self.assertTrue(b.stopped)
+        self.assertEqual([], self.network.subscriptions['a_addr'])
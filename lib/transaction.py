@@ -545,8 +545,12 @@ def parse_output(vds, i):
 
 
 def deserialize(raw):
+    return deserialize_bytes(raw.decode('hex'))
+
+
+def deserialize_bytes(data):
     vds = BCDataStream()
-    vds.write(raw.decode('hex'))
+    vds.write(data)
     d = {}
     start = vds.read_cursor
     d['version'] = vds.read_int32()
@@ -562,10 +566,10 @@ def push_script(x):
     return op_push(len(x)/2) + x
 
 
-class Transaction:
+class Transaction(object):
 
     def __str__(self):
-        if self.raw is None:
+        if self._raw is None:
             self.raw = self.serialize()
         return self.raw
 
@@ -581,6 +585,26 @@ class Transaction:
         self._inputs = None
         self._outputs = None
 
+    # The serialized transaction is kept as bytes; raw gives it in hex.
+    @property
+    def raw(self):
+        return self._raw.encode('hex') if self._raw is not None else None
+
+    @raw.setter
+    def raw(self, raw):
+        self._raw = raw.decode('hex') if raw else None
+
+    @classmethod
+    def from_bytes(klass, data):
+        self = klass(None)
+        self._raw = data
+        return self
+
+    def raw_bytes(self):
+        if self._raw is None:
+            self.raw = self.serialize()
+        return self._raw
+
     def update(self, raw):
         self.raw = raw
         self._inputs = None
@@ -627,14 +651,16 @@ class Transaction:
 
 
     def deserialize(self):
-        if self.raw is None:
+        if self._raw is None:
             self.raw = self.serialize()
         if self._inputs is not None:
             return
-        d = deserialize(self.raw)
-        self._inputs = d['inputs']
+        d = deserialize_bytes(self._raw)
+        # _inputs is set last: other threads take it as the sign that the
+        # transaction is parsed
         self._outputs = [(x['type'], x['address'], x['value']) for x in d['outputs']]
         self.locktime = d['lockTime']
+        self._inputs = d['inputs']
         return d
 
     @classmethod
@@ -827,7 +853,7 @@ class Transaction:
         return self.serialize(for_sig = i)
 
     def hash(self):
-        return Hash(self.raw.decode('hex') )[::-1].encode('hex')
+        return Hash(self.raw_bytes())[::-1].encode('hex')
 
     def add_inputs(self, inputs):
         self._inputs.extend(inputs)
@@ -968,7 +994,7 @@ class Transaction:
         return (addr in self.get_output_addresses()) or (addr in (tx.get("address") for tx in self.inputs()))
 
     def as_dict(self):
-        if self.raw is None:
+        if self._raw is None:
             self.raw = self.serialize()
         self.deserialize()
         out = {
@@ -1,15 +1,18 @@
 import os, sys, re, json
 import platform
 import shutil
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import traceback
 import urlparse
 import urllib
 import threading
+import thread
 import logging
+from contextlib import contextmanager
 from i18n import _
+from profiling import PROFILER, allocation_count, allocations_since, function_name
 
 log = logging.getLogger("lbryum")
 
@@ -127,6 +130,137 @@ class DaemonThread(threading.Thread, PrintError):
             self.running = False
 
 
+class LRUCache(object):
+    """A dict of at most size items, dropping the least recently used
+    item first.  Safe to use from several threads."""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is None:
+                return default
+            self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class RWLock(object):
+    """A reader-writer lock.  Used as a context manager it is held
+    exclusively and is reentrant, like threading.RLock; read() returns a
+    context manager that holds it shared with other readers.
+
+    Waiting writers go first: new readers wait for them, except threads
+    that already hold the lock, which may take it again in either mode.
+    A thread holding the lock shared must not take it exclusively, as two
+    such threads would wait for each other forever.
+
+    While profiling is enabled, the time spent acquiring the lock is
+    recorded under name.
+    """
+
+    def __init__(self, name='RWLock'):
+        self.name = name
+        self.cond = threading.Condition(threading.Lock())
+        self.writer = None
+        self.write_count = 0
+        self.waiting_writers = 0
+        # thread ident -> number of nested read acquisitions
+        self.readers = {}
+
+    def acquire(self):
+        if not PROFILER.enabled:
+            return self._acquire()
+        t0 = time.time()
+        self._acquire()
+        PROFILER.record_wait(self.name, time.time() - t0)
+
+    def _acquire(self):
+        me = thread.get_ident()
+        with self.cond:
+            if self.writer == me:
+                self.write_count += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("cannot take a read lock exclusively")
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or self.readers:
+                    self.cond.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.write_count = 1
+
+    def release(self):
+        with self.cond:
+            if self.writer != thread.get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self.write_count -= 1
+            if not self.write_count:
+                self.writer = None
+                self.cond.notify_all()
+
+    def acquire_read(self):
+        if not PROFILER.enabled:
+            return self._acquire_read()
+        t0 = time.time()
+        self._acquire_read()
+        PROFILER.record_wait(self.name, time.time() - t0)
+
+    def _acquire_read(self):
+        me = thread.get_ident()
+        with self.cond:
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers:
+                    self.cond.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = thread.get_ident()
+        with self.cond:
+            count = self.readers.get(me)
+            if not count:
+                raise RuntimeError("cannot release un-acquired lock")
+            if count > 1:
+                self.readers[me] = count - 1
+                return
+            del self.readers[me]
+            if not self.readers:
+                self.cond.notify_all()
+
+    def is_owned(self):
+        '''Whether the current thread holds the lock exclusively.'''
+        return self.writer == thread.get_ident()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *args):
+        self.release()
+
+
 
 is_verbose = False
 def set_verbosity(b):
@@ -162,14 +296,18 @@ def json_decode(x):
     except:
         return x
 
-# decorator that prints execution time
+# decorator that prints execution time, and records it while profiling
+# is enabled (see profiling.PROFILER)
 def profiler(func):
     def do_profile(func, args, kw_args):
         n = func.func_name
+        count = allocation_count()
         t0 = time.time()
         o = func(*args, **kw_args)
         t = time.time() - t0
         print_error("[profiler]", n, "%.4f"%t)
+        if PROFILER.enabled:
+            PROFILER.record_call(function_name(func), t, allocations_since(count))
         return o
     return lambda *args, **kw_args: do_profile(func, args, kw_args)
 
@@ -17,31 +17,83 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 
+import heapq
+from threading import Lock
+
 from util import ThreadJob
 from lbrycrd import *
 
 
 class SPV(ThreadJob):
-    """ Simple Payment Verification """
+    """ Simple Payment Verification
+
+    The verifier does no work on idle loop ticks: it only looks at
+    transactions the wallet reports through add(), and at transactions
+    waiting for headers when the local height changes.
+    """
 
     def __init__(self, network, wallet):
         self.wallet = wallet
         self.network = network
+        self.lock = Lock()
+        # Tx hashes to look at on the next run.  Access with self.lock.
+        self.pending = set(wallet.get_unverified_txs())
+        # Heap of (tx_height, tx_hash) waiting for the header at tx_height
+        self.waiting = []
+        self.local_height = None
         # Keyed by tx hash.  Value is None if the merkle branch was
         # requested, and the merkle root once it has been verified
         self.merkle_roots = {}
+        # If set, merkle branches are stored in the wallet so that
+        # transactions can be verified again against local headers
+        self.persist_branches = network.config.get('persist_merkle_branches', False)
+        # Stored branches not yet checked against our local headers
+        self.reverify_pending = set()
+        self.reverify_merkle_branches()
+
+    def reverify_merkle_branches(self):
+        '''Check every stored merkle branch against the local headers
+        again, e.g. after the headers file was rebuilt or restored.'''
+        self.reverify_pending = set(self.wallet.get_merkle_branch_txs())
+        self.local_height = None
+
+    def add(self, tx_hash):
+        '''Called by the wallet when tx_hash is added to, or its height
+        changes in, the unverified map.'''
+        with self.lock:
+            self.pending.add(tx_hash)
 
     def run(self):
         lh = self.network.get_local_height()
+        new_headers = lh != self.local_height
+        self.local_height = lh
+        if new_headers:
+            if self.reverify_pending:
+                self.reverify_stored_branches(lh)
+            while self.waiting and self.waiting[0][0] <= lh:
+                tx_height, tx_hash = heapq.heappop(self.waiting)
+                self.add(tx_hash)
+        with self.lock:
+            pending = self.pending
+            self.pending = set()
+        if not pending:
+            return
         unverified = self.wallet.get_unverified_txs()
-        for tx_hash, tx_height in unverified.items():
+        for tx_hash in pending:
+            tx_height = unverified.get(tx_hash)
+            if tx_height is None or tx_hash in self.merkle_roots:
+                continue
             # do not request merkle branch before headers are available
-            if tx_hash not in self.merkle_roots and tx_height <= lh:
-                request = ('blockchain.transaction.get_merkle',
-                           [tx_hash, tx_height])
-                self.network.send([request], self.verify_merkle)
-                self.print_error('requested merkle', tx_hash)
-                self.merkle_roots[tx_hash] = None
+            if tx_height > lh:
+                heapq.heappush(self.waiting, (tx_height, tx_hash))
+                continue
+            if self.verify_stored_branch(tx_hash, tx_height):
+                continue
+            request = ('blockchain.transaction.get_merkle',
+                       [tx_hash, tx_height])
+            self.network.send([request], self.verify_merkle)
+            self.print_error('requested merkle', tx_hash)
+            self.merkle_roots[tx_hash] = None
 
     def verify_merkle(self, r):
         if r.get('error'):
@@ -67,7 +119,48 @@ class SPV(ThreadJob):
         # we passed all the tests
         self.merkle_roots[tx_hash] = merkle_root
         self.print_error("verified %s" % tx_hash)
-        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos))
+        branch = merkle['merkle'] if self.persist_branches else None
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos), branch)
+
+    def check_stored_branch(self, tx_hash, tx_height):
+        '''Returns the local header if the stored merkle branch of tx_hash
+        connects it to the header at tx_height, otherwise None.'''
+        item = self.wallet.get_merkle_branch(tx_hash)
+        if item is None:
+            return None
+        pos, merkle_s = item
+        header = self.network.get_header(tx_height)
+        if not header or header.get('merkle_root') != self.hash_merkle_root(merkle_s, tx_hash, pos):
+            return None
+        return header
+
+    def verify_stored_branch(self, tx_hash, tx_height):
+        '''Verify an unverified transaction without network access.'''
+        header = self.check_stored_branch(tx_hash, tx_height)
+        if header is None:
+            return False
+        pos, merkle_s = self.wallet.get_merkle_branch(tx_hash)
+        self.merkle_roots[tx_hash] = header.get('merkle_root')
+        self.print_error("verified %s from stored branch" % tx_hash)
+        self.wallet.add_verified_tx(tx_hash, (tx_height, header.get('timestamp'), pos), merkle_s)
+        return True
+
+    def reverify_stored_branches(self, lh):
+        for tx_hash in list(self.reverify_pending):
+            info = self.wallet.verified_tx.get(tx_hash)
+            if info is None:
+                self.reverify_pending.discard(tx_hash)
+                continue
+            tx_height = info[0]
+            # wait until headers are available
+            if tx_height > lh:
+                continue
+            self.reverify_pending.discard(tx_hash)
+            if self.check_stored_branch(tx_hash, tx_height) is None:
+                self.print_error("stored branch does not match local header", tx_hash)
+                self.merkle_roots.pop(tx_hash, None)
+                self.wallet.unverify_tx(tx_hash)
+                self.add(tx_hash)
 
 
     def hash_merkle_root(self, merkle_s, target_hash, pos):
@@ -79,7 +172,11 @@ class SPV(ThreadJob):
 
 
     def undo_verifications(self, height):
+        '''Verify the transactions at or above height again, from their
+        stored merkle branch if it matches the new header.'''
         tx_hashes = self.wallet.undo_verifications(height)
         for tx_hash in tx_hashes:
             self.print_error("redoing", tx_hash)
             self.merkle_roots.pop(tx_hash, None)
+            self.reverify_pending.discard(tx_hash)
+            self.add(tx_hash)
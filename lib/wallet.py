@@ -19,18 +19,21 @@
 import os
 import hashlib
 import ast
+import bisect
 import threading
 import random
 import time
 import json
 import copy
+from copy import deepcopy
 import re
 from functools import partial
 from unicodedata import normalize
 from decimal import Decimal
 from i18n import _
 
-from util import NotEnoughFunds, PrintError, profiler
+from util import NotEnoughFunds, PrintError, ThreadJob, RWLock, profiler
+from profiling import profiled
 
 from lbrycrd import *
 from account import *
@@ -42,27 +45,246 @@ import lbrycrd
 from coinchooser import COIN_CHOOSERS
 from synchronizer import Synchronizer
 from verifier import SPV
+from broadcaster import Broadcaster, RETRY_INTERVAL, is_rejected
 from mnemonic import Mnemonic
+from sqlite_storage import SqliteWalletDB, is_sqlite_file, TABLES as SQLITE_TABLES
 
 import paymentrequest
 
 # internal ID for imported account
 IMPORTED_ACCOUNT = '/x'
 
+# Keys whose values map names to raw bytes.  They are held as bytes in
+# memory and hex encoded in the JSON file and the journal.
+BINARY_KEYS = set(['transactions'])
+
+# the journal is folded into the wallet file once it grows past this size
+JOURNAL_COMPACT_SIZE = 1024 * 1024
+
+# transaction changes are saved to storage after this many seconds, or
+# after this many changes, whichever comes first
+SAVE_INTERVAL = 10
+SAVE_MAX_CHANGES = 100
+
+# claims are reported as expiring this many blocks (about a week) before
+# they expire
+CLAIM_EXPIRING_BLOCKS = 4032
+
+# seconds before a claim queued for renewal is renewed again, if it is not
+# spent by then by its renewal
+CLAIM_RENEWAL_RETRY = 600
+
+# seconds sendtx waits for the server to answer a broadcast; a transaction
+# without answer stays queued for the broadcaster
+BROADCAST_TIMEOUT = 30
+
+# Version of the derived indexes saved with the wallet (account addresses,
+# tx_addr_hist, the utxo, claim and unconfirmed indexes).  Saved indexes
+# of another version are rebuilt.
+DERIVED_INDEX_VERSION = 3
+
+
+def encode_binary(key, value):
+    if key in BINARY_KEYS and isinstance(value, dict):
+        return dict((k, v.encode('hex')) for k, v in value.iteritems())
+    return value
+
+
+def decode_binary(key, value):
+    if key in BINARY_KEYS and isinstance(value, dict):
+        return dict((k, v.decode('hex')) for k, v in value.iteritems())
+    return value
+
+
+def history_status(h):
+    """The status of an address history, as announced by servers."""
+    if not h:
+        return None
+    status = ''
+    for tx_hash, height in h:
+        status += tx_hash + ':%d:' % height
+    return hashlib.sha256( status ).digest().encode('hex')
+
+
+def intern_str(s):
+    # tx hashes, addresses and outpoints are ascii; JSON gives them as
+    # unicode, which takes four bytes per character
+    return intern(str(s))
+
+
+def compact_history(hist):
+    return [(intern_str(tx_hash), height) for tx_hash, height in hist]
+
+
+def compact_items(compact_item):
+    return lambda d: dict((intern_str(addr), map(compact_item, l)) for addr, l in d.iteritems())
+
+
+# Compact form of the items of the transaction data shared with the
+# storage: strings are interned byte strings and records are tuples.
+# The JSON layout is unchanged, so it is used only in memory.
+COMPACT_VALUES = {
+    'addr_history': compact_history,
+    'txi': compact_items(lambda (ser, v): (intern_str(ser), v)),
+    'txo': compact_items(tuple),
+    'pruned_txo': intern_str,
+    'utxos': lambda item: (intern_str(item[0]),) + tuple(item[1:]),
+    'spent_outpoints': intern_str,
+    'claims': lambda item: dict((str(k), str(v) if isinstance(v, unicode) else v)
+                                for k, v in item.iteritems()),
+    'tx_addr_hist': lambda addrs: map(intern_str, addrs),
+    'verified_tx3': tuple,
+    'claimtrie_transactions': lambda v: v,
+    'transactions': lambda v: v,
+}
+
+
+def compact_value(key, value):
+    """Replace in place the items of the dict value of a key of
+    COMPACT_VALUES with their compact form.  The dict itself is kept as
+    it is shared with the storage."""
+    compact = COMPACT_VALUES[key]
+    items = value.items()
+    # the items are equal to the stored ones, so a StoredDict need not
+    # record them as changed
+    dict.clear(value)
+    for k, v in items:
+        dict.__setitem__(value, intern_str(k), compact(v))
+    return value
+
+
+class StoredDict(dict):
+    """The value of a table key shared with a WalletStorage.  It records
+    the items set or removed at its top level, so that the storage
+    writes only those.  Items changed in place below the top level are
+    reported with WalletStorage.touch, except those reached through
+    setdefault, which records its key.  Once shared, it may only be
+    changed by a thread holding the storage lock exclusively."""
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed = set()
+        # the lock of the storage, once shared with it
+        self.lock = None
+
+    def __deepcopy__(self, memo):
+        # copies are not shared with the storage
+        return deepcopy(dict(self), memo)
+
+    def check_lock(self):
+        if self.lock is not None and not self.lock.is_owned():
+            raise RuntimeError("stored dict changed without holding the storage lock")
+
+    # each change is recorded after it is made, so that the storage,
+    # which takes the changed keys and then reads the items holding its
+    # lock, sees it made
+
+    def __setitem__(self, key, value):
+        self.check_lock()
+        dict.__setitem__(self, key, value)
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        self.check_lock()
+        dict.__delitem__(self, key)
+        self.changed.add(key)
+
+    def pop(self, key, *default):
+        self.check_lock()
+        value = dict.pop(self, key, *default)
+        self.changed.add(key)
+        return value
+
+    def popitem(self):
+        self.check_lock()
+        key, value = dict.popitem(self)
+        self.changed.add(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        self.check_lock()
+        value = dict.setdefault(self, key, default)
+        self.changed.add(key)
+        return value
+
+    def update(self, *args, **kwargs):
+        self.check_lock()
+        items = dict(*args, **kwargs)
+        dict.update(self, items)
+        self.changed.update(items)
+
+    def clear(self):
+        self.check_lock()
+        keys = self.keys()
+        dict.clear(self)
+        self.changed.update(keys)
+
+    def take_changed(self):
+        changed, self.changed = self.changed, set()
+        return changed
+
+
+class TransactionMap(dict):
+    """The transactions of a wallet by hash.  Those loaded from storage
+    are held as raw bytes and made Transactions when first read, so that
+    opening a wallet does not go through each of them."""
+
+    def __getitem__(self, tx_hash):
+        tx = dict.__getitem__(self, tx_hash)
+        if isinstance(tx, str):
+            tx = Transaction.from_bytes(tx)
+            dict.__setitem__(self, tx_hash, tx)
+        return tx
+
+    def get(self, tx_hash, default=None):
+        if tx_hash in self:
+            return self[tx_hash]
+        return default
+
+    def pop(self, tx_hash, *default):
+        if tx_hash in self:
+            tx = self[tx_hash]
+            dict.__delitem__(self, tx_hash)
+            return tx
+        return dict.pop(self, tx_hash, *default)
+
+
 class WalletStorage(PrintError):
 
-    def __init__(self, path):
-        self.lock = threading.RLock()
+    def __init__(self, path, backend=None, journal=False):
+        self.lock = RWLock('storage')
+        # serializes the writes to the files, which happen outside self.lock
+        self.write_lock = threading.Lock()
         self.data = {}
         self.path = path
+        self.backend = backend or 'json'
+        self.db = None
+        self.journal = journal
+        self.journal_path = path + '.journal' if path else None
+        # called holding self.lock before each write, so that the owner
+        # of the storage can put the changes it holds back
+        self.before_write = None
         self.file_exists = False
         self.modified = False
+        # keys to rewrite completely, and changed items of table keys,
+        # for the sqlite backend and the journal
+        self.dirty_keys = set()
+        self.dirty_rows = {}
+        # keys whose value is shared with the wallet instead of copied
+        self.shared = set()
         self.print_error("wallet path", self.path)
         if self.path:
             self.read(self.path)
 
     def read(self, path):
         """Read the contents of the wallet file."""
+        if is_sqlite_file(self.path):
+            self.db = SqliteWalletDB(self.path)
+            self.data = self.db.load()
+            self.track_tables()
+            self.backend = 'sqlite'
+            self.file_exists = True
+            return
         try:
             with open(self.path, "r") as f:
                 data = f.read()
@@ -91,40 +313,300 @@ class WalletStorage(PrintError):
                     self.print_error('Failed to convert label to json format', key)
                     continue
                 self.data[key] = value
+        for key in BINARY_KEYS:
+            if key in self.data:
+                self.data[key] = decode_binary(key, self.data[key])
         self.file_exists = True
-
-    def get(self, key, default=None):
+        self.replay_journal()
+        self.track_tables()
+        if self.backend == 'sqlite':
+            self.migrate_to_sqlite()
+
+    def replay_journal(self):
+        """Apply the changes appended to the journal since the wallet
+        file was last written in full."""
+        try:
+            with open(self.journal_path, "r") as f:
+                lines = f.readlines()
+        except IOError:
+            return
+        offset = 0
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # a torn write at the end of the journal; cut it off so
+                # that later appends start on a fresh line
+                self.print_error("ignoring truncated journal record")
+                with open(self.journal_path, "r+") as f:
+                    f.truncate(offset)
+                break
+            offset += len(line)
+            key = record['key']
+            if 'item' in record:
+                d = self.data.setdefault(key, {})
+                if record.get('deleted'):
+                    d.pop(record['item'], None)
+                elif key in BINARY_KEYS:
+                    d[record['item']] = record['value'].decode('hex')
+                else:
+                    d[record['item']] = record['value']
+            elif record['value'] is None:
+                self.data.pop(key, None)
+            else:
+                self.data[key] = decode_binary(key, record['value'])
+        self.print_error("replayed %d journal records" % len(lines))
+
+    def track_tables(self):
+        for key in SQLITE_TABLES:
+            if type(self.data.get(key)) is dict:
+                self.data[key] = StoredDict(self.data[key])
+
+    def migrate_to_sqlite(self):
+        """Convert a JSON wallet file to sqlite, keeping the original
+        file as a backup next to it."""
+        self.print_error("converting wallet file to sqlite")
+        temp_path = self.path + '.sqlite.tmp'
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        db = SqliteWalletDB(temp_path)
+        db.import_data(self.data)
+        db.close()
+        if 'ANDROID_DATA' not in os.environ:
+            os.chmod(temp_path, os.stat(self.path).st_mode)
+        os.rename(self.path, self.path + '.json.bak')
+        os.rename(temp_path, self.path)
+        self.db = SqliteWalletDB(self.path)
+
+    def get(self, key, default=None, copy=True):
+        """Return a copy of the value stored under key.
+
+        With copy=False the stored object itself is returned and becomes
+        shared with the caller; a dict default is stored for sharing.
+        Table keys are shared as StoredDicts, which record their changed
+        items; items changed below their top level are reported with
+        touch().  Changes are saved with put(key, value, copy=False).
+        Shared values may only be changed while holding self.lock
+        exclusively; a StoredDict changed at its top level without it
+        raises RuntimeError.  Readers that need a stable snapshot take
+        the default copy.
+        """
         with self.lock:
             v = self.data.get(key)
             if v is None:
                 v = default
+                if not copy and isinstance(v, dict):
+                    v = self.data[key] = StoredDict(v) if key in SQLITE_TABLES else v
+                    self.share(key, v)
+            elif copy:
+                v = deepcopy(v)
             else:
-                v = copy.deepcopy(v)
+                self.share(key, v)
         return v
 
-    def put(self, key, value):
+    def share(self, key, value):
+        self.shared.add(key)
+        if isinstance(value, StoredDict):
+            value.lock = self.lock
+
+    def put(self, key, value, copy=True):
+        """Store value under key.
+
+        With copy=False the storage takes value as it is, without
+        validating or copying it, and shares it with the caller (see
+        get).
+        """
+        if not copy or (value is not None and value is self.data.get(key)):
+            self.put_shared(key, value)
+            return
         try:
             json.dumps(key)
-            json.dumps(value)
+            json.dumps(encode_binary(key, value))
         except:
             self.print_error("json error: cannot save", key)
             return
         with self.lock:
+            self.shared.discard(key)
+            old = self.data.get(key)
             if value is not None:
-                if self.data.get(key) != value:
+                if old != value:
                     self.modified = True
-                    self.data[key] = copy.deepcopy(value)
+                    value = deepcopy(value)
+                    if key in SQLITE_TABLES and type(value) is dict:
+                        value = StoredDict(value)
+                    self.data[key] = value
+                    self.set_dirty(key, old, value)
             elif key in self.data:
                 self.modified = True
                 self.data.pop(key)
+                self.set_dirty(key, old, value)
+
+    def put_shared(self, key, value):
+        with self.lock:
+            old = self.data.get(key)
+            if value is None:
+                self.put(key, None)
+            elif value is old:
+                # changed in place; a StoredDict records the changed items,
+                # other values are written in full
+                self.modified = True
+                self.share(key, value)
+                if not isinstance(value, StoredDict) and (self.backend == 'sqlite' or self.journal):
+                    self.dirty_rows.pop(key, None)
+                    self.dirty_keys.add(key)
+            else:
+                if old != value:
+                    self.modified = True
+                    self.set_dirty(key, old, value)
+                self.data[key] = value
+                self.share(key, value)
+
+    def touch(self, key, *items):
+        """Report that items of the shared dict stored under key were
+        changed in place below its top level."""
+        if self.backend != 'sqlite' and not self.journal:
+            return
+        with self.lock:
+            if key not in self.dirty_keys:
+                self.dirty_rows.setdefault(key, set()).update(items)
+
+    def set_dirty(self, key, old, new):
+        """Record what changed in key, so that the sqlite backend only
+        rewrites the affected rows and the journal only logs them.
+
+        This diffs the whole old and new values of table keys, and is
+        the fallback for values replaced by another object.  Values
+        changed often are shared instead, and their changed items
+        reported with touch()."""
+        if self.backend != 'sqlite' and not self.journal:
+            return
+        if key in self.dirty_keys:
+            return
+        if old is None:
+            old = {}
+        if key in SQLITE_TABLES and isinstance(old, dict) and isinstance(new, dict):
+            changed = set(k for k, v in new.iteritems() if old.get(k) != v)
+            changed.update(k for k in old if k not in new)
+            self.dirty_rows.setdefault(key, set()).update(changed)
+        else:
+            self.dirty_rows.pop(key, None)
+            self.dirty_keys.add(key)
 
     def write(self):
         if threading.currentThread().isDaemon():
             self.print_error('warning: daemon thread cannot write wallet')
             return
-        if not self.modified:
+        with self.write_lock:
+            with self.lock:
+                if self.before_write is not None:
+                    self.before_write()
+                self.collect_changes()
+            if not self.modified:
+                return
+            if self.backend == 'sqlite':
+                self.write_sqlite()
+                return
+            if self.journal and os.path.exists(self.path):
+                self.write_journal()
+                return
+            self.write_json()
+
+    def compact(self):
+        """Fold the journal into the wallet file."""
+        if threading.currentThread().isDaemon():
+            self.print_error('warning: daemon thread cannot write wallet')
             return
-        s = json.dumps(self.data, indent=4, sort_keys=True)
+        with self.write_lock:
+            if self.journal_path and os.path.exists(self.journal_path):
+                self.write_json()
+
+    def collect_changes(self):
+        """Record the items changed in the shared StoredDicts.  Called
+        with self.lock held."""
+        for key in self.shared:
+            value = self.data.get(key)
+            if not isinstance(value, StoredDict) or not value.changed:
+                continue
+            changed = value.take_changed()
+            self.modified = True
+            if (self.backend == 'sqlite' or self.journal) and key not in self.dirty_keys:
+                self.dirty_rows.setdefault(key, set()).update(changed)
+
+    def take_changes(self):
+        """Return the changes recorded so far, and start recording anew.
+        Called with self.lock held."""
+        changes = self.dirty_keys, self.dirty_rows
+        self.dirty_keys = set()
+        self.dirty_rows = {}
+        self.modified = False
+        return changes
+
+    def restore_changes(self, changes):
+        """Record again the changes of a write that failed."""
+        dirty_keys, dirty_rows = changes
+        with self.lock:
+            self.modified = True
+            self.dirty_keys |= dirty_keys
+            for key, items in dirty_rows.iteritems():
+                if key not in self.dirty_keys:
+                    self.dirty_rows.setdefault(key, set()).update(items)
+            for key in self.dirty_keys:
+                self.dirty_rows.pop(key, None)
+
+    # The write methods below are called with self.write_lock held.  The
+    # changes they write are taken from the dirty sets while holding
+    # self.lock, and recorded again if the write fails, so that changes
+    # made meanwhile are neither lost nor written twice.
+
+    def write_journal(self):
+        with self.lock:
+            records = []
+            for key in self.dirty_keys:
+                records.append({'key': key, 'value': encode_binary(key, self.data.get(key))})
+            for key, items in self.dirty_rows.iteritems():
+                value = self.data.get(key, {})
+                for item in items:
+                    if item in value:
+                        v = value[item].encode('hex') if key in BINARY_KEYS else value[item]
+                        records.append({'key': key, 'item': item, 'value': v})
+                    else:
+                        records.append({'key': key, 'item': item, 'deleted': True})
+            s = ''.join(json.dumps(r) + '\n' for r in records)
+            changes = self.take_changes()
+        try:
+            with open(self.journal_path, "a") as f:
+                f.write(s)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+        except:
+            self.restore_changes(changes)
+            raise
+        if size > JOURNAL_COMPACT_SIZE:
+            self.write_json()
+
+    def write_json(self):
+        with self.lock:
+            # shared values may be changed by threads that do not hold
+            # self.lock; dict() copies their top level atomically
+            data = dict((k, dict(v) if k in self.shared else v) for k, v in self.data.iteritems())
+            for key in BINARY_KEYS:
+                if key in data:
+                    data[key] = encode_binary(key, data[key])
+            s = json.dumps(data, indent=4, sort_keys=True)
+            changes = self.take_changes()
+        try:
+            self.replace_file(s)
+        except:
+            self.restore_changes(changes)
+            raise
+        # the journal is only removed once the full file is in place, so
+        # a crash in between replays changes that are already applied;
+        # appends to it wait for self.write_lock
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def replace_file(self, s):
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w") as f:
             f.write(s)
@@ -143,7 +625,71 @@ class WalletStorage(PrintError):
         if 'ANDROID_DATA' not in os.environ:
             import stat
             os.chmod(self.path, mode)
-        self.modified = False
+
+    def write_sqlite(self):
+        with self.lock:
+            if self.db is None:
+                self.db = SqliteWalletDB(self.path)
+                if 'ANDROID_DATA' not in os.environ:
+                    import stat
+                    os.chmod(self.path, stat.S_IREAD | stat.S_IWRITE)
+                self.db.import_data(self.data)
+            else:
+                self.db.write(self.data, self.dirty_keys, self.dirty_rows)
+            self.take_changes()
+
+
+class WalletSaver(ThreadJob):
+    """Saves coalesced transaction changes of a wallet to its storage."""
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+
+    def run(self):
+        self.wallet.save_if_due()
+
+
+class TransactionWarmup(ThreadJob):
+    """Parses the transactions of a wallet in the background, a batch at
+    a time, so that they are ready when first used."""
+
+    BATCH_SIZE = 100
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.done = False
+
+    def run(self):
+        if not self.done:
+            self.done = not self.wallet.warm_up_transactions(self.BATCH_SIZE)
+
+
+class IndexVerifier(ThreadJob):
+    """Checks the derived indexes a wallet loaded from storage against
+    the data they were derived from, one step at a time."""
+
+    def __init__(self, wallet):
+        self.wallet = wallet
+        self.done = False
+
+    def run(self):
+        if not self.done:
+            self.done = not self.wallet.verify_derived_indexes()
+
+
+class ClaimExpiryMonitor(ThreadJob):
+    """Reports the wallet claims that are about to expire or expired
+    as new headers arrive."""
+
+    def __init__(self, wallet, network):
+        self.wallet = wallet
+        self.network = network
+
+    def run(self):
+        height = self.network.get_local_height()
+        last = self.wallet.claim_expiry_height
+        if last is None or height > last:
+            self.wallet.check_claim_expirations(height)
 
 
 class Abstract_Wallet(PrintError):
@@ -159,30 +705,90 @@ class Abstract_Wallet(PrintError):
         self.network = None
         self.electrum_version = LBRYUM_VERSION
         self.gap_limit_for_change = 6 # constant
-        # saved fields
+        # saved fields.  Those read with copy=False are shared with the
+        # storage, and changed holding self.transaction_lock (the storage
+        # lock); use set_label to change labels.
         self.seed_version          = storage.get('seed_version', NEW_SEED_VERSION)
         self.use_change            = storage.get('use_change',True)
         self.multiple_change       = storage.get('multiple_change', False)
 
         self.use_encryption        = storage.get('use_encryption', False)
         self.seed                  = storage.get('seed', '')               # encrypted
-        self.labels                = storage.get('labels', {})
+        self.labels                = storage.get('labels', {}, copy=False)
         self.frozen_addresses      = set(storage.get('frozen_addresses',[]))
         self.stored_height         = storage.get('stored_height', 0)       # last known height (for offline mode)
-        self.history               = storage.get('addr_history',{})        # address -> list(txid, height)
+        # large values below are shared with the storage rather than copied
+        self.history               = compact_value('addr_history', storage.get('addr_history', {}, copy=False))  # address -> list(txid, height)
 
-        # This attribute is set when wallet.start_threads is called.
+        # These attributes are set when wallet.start_threads is called.
         self.synchronizer = None
+        self.broadcaster = None
+        self.saver = None
+        self.warmup = None
+        # hashes of transactions left for TransactionWarmup to parse
+        self.unparsed_txs = None
+        # changes to transaction data not yet saved to storage
+        self.unsaved_changes = 0
+        self.last_save = time.time()
+        self.save_interval = SAVE_INTERVAL
+        self.save_max_changes = SAVE_MAX_CHANGES
+        # Cached balances.  addr_balances maps (address, exclude_claimtrietx)
+        # to (c, u, x, valid_below); balance_totals holds the same for the
+        # whole wallet (key ('wallet',)) and for accounts (key ('account',
+        # acc_id)), whose domains differ.  Entries are dropped by
+        # invalidate_balances, or expire when an immature coinbase output
+        # matures at height valid_below.
+        self.addr_balances = {}
+        self.balance_totals = {}
+        self.balance_generation = 0
+        # History index for get_history_page: (txpos, tx_hash) rows of the
+        # whole wallet in the order of get_txpos, the delta and position
+        # of each row, and for the first rows the running sum of known
+        # deltas and count of unknown ones.  Rows of the transactions in
+        # history_dirty are placed again on the next query, and the whole
+        # index once history_rebuild is set.  Access with self.history_lock.
+        self.history_rows = []
+        self.history_deltas = {}
+        self.history_pos = {}
+        self.history_sums = []
+        self.history_dirty = set()
+        self.history_rebuild = True
+        self.history_lock = threading.Lock()
+        # tx hash -> get_wallet_delta of wallet transactions, see
+        # get_wallet_deltas
+        self.wallet_deltas = {}
+        # Height up to which claim expirations were reported, see
+        # check_claim_expirations, and the claims queued for renewal, as
+        # a map from outpoint to the time of the next attempt, and the
+        # hash of the last renewal sent for each of them.  Access both
+        # with self.transaction_lock.
+        self.claim_expiry_height = storage.get('claim_expiry_height')
+        self.claim_expiring_blocks = CLAIM_EXPIRING_BLOCKS
+        self.claim_auto_renew = False
+        self.claim_renewals = storage.get('claim_renewals', {})
+        self.claim_renewal_txs = storage.get('claim_renewal_txs', {})
+        self.claim_monitor = None
 
         # imported_keys is deprecated. The GUI should call convert_imported_keys
         self.imported_keys = self.storage.get('imported_keys',{})
 
+        # Derived indexes saved by this version are loaded as they are and
+        # checked later by verify_derived_indexes.
+        self.derived_indexes_saved = storage.get('derived_index_version') == DERIVED_INDEX_VERSION
+        self.unverified_indexes = []
+        self.index_verifier = None
+
         self.load_accounts()
         self.load_transactions()
         self.build_reverse_history()
+        self.build_unconfirmed_index()
+        self.build_utxo_index()
 
         # load requests
         self.receive_requests = self.storage.get('payment_requests', {})
+        # Outgoing transactions retried by the broadcaster until they are
+        # confirmed.  Maps tx hash to a dict.  Access with self.lock.
+        self.pending_broadcasts = self.storage.get('pending_broadcasts', {})
 
         # spv
         self.verifier = None
@@ -190,17 +796,57 @@ class Abstract_Wallet(PrintError):
         # height.  Access is not contended so no lock is needed.
         self.unverified_tx = {}
         # Verified transactions.  Each value is a (height, timestamp, block_pos) tuple.  Access with self.lock.
-        self.verified_tx   = storage.get('verified_tx3',{})
+        self.verified_tx   = compact_value('verified_tx3', storage.get('verified_tx3', {}, copy=False))
+        # Verified transactions as (height, block_pos, tx_hash) tuples, kept
+        # sorted so that reorgs and ordering by position do not need to scan
+        # every transaction.  None until first used, see
+        # get_verified_tx_index.  Access with self.lock.
+        self.verified_tx_index = None
+        # Merkle branches of verified transactions, stored only if the
+        # verifier is configured to persist them.  Maps tx hash to a
+        # (block_pos, concatenated branch hashes) pair.  Access with self.lock.
+        self.merkle_branches = storage.get('merkle_branches', {})
 
         # there is a difference between wallet.up_to_date and interface.is_up_to_date()
         # interface.is_up_to_date() returns true when all requests have been answered and processed
         # wallet.up_to_date is true when the wallet is synchronized (stronger requirement)
         self.up_to_date = False
-        self.lock = threading.Lock()
-        self.transaction_lock = threading.Lock()
-        self.tx_event = threading.Event()
-
-        self.check_history()
+        # Concurrency model.  The wallet is used at once by the network
+        # thread (synchronizer and verifier callbacks), daemon RPC threads
+        # and the GUI.  Its state is guarded by two reader-writer locks,
+        # always taken in this order:
+        #  - self.lock guards the history, the verified and pending
+        #    transactions and the merkle branches;
+        #  - self.transaction_lock guards txi, txo, pruned_txo and the
+        #    utxo and claim indexes.  txi and txo lists are changed in
+        #    place while shared with the storage, so it is the storage lock.
+        # Callbacks that change the wallet hold the locks exclusively
+        # (with lock:), while queries hold them shared (with lock.read():)
+        # and run in parallel with each other.  A query must not call a
+        # method that changes the wallet while holding a lock shared.
+        # Caches (balances, history index, wallet deltas) are filled by
+        # queries outside the locks and discarded by writers through
+        # their invalidate_* methods.
+        self.lock = RWLock('wallet')
+        self.transaction_lock = self.storage.lock
+        self.storage.before_write = self.flush_transactions
+        # tx hash -> answer to its broadcast by send_tx, see wait_tx
+        self.tx_waiters = {}
+        self.tx_waiters_lock = threading.Lock()
+
+        if self.derived_indexes_saved:
+            self.unverified_indexes = [self.verify_account_addresses,
+                                       self.verify_reverse_history,
+                                       self.remove_unreferenced_transactions,
+                                       self.check_history,
+                                       self.verify_utxo_index,
+                                       self.verify_unconfirmed_index]
+        else:
+            self.remove_unreferenced_transactions()
+            self.check_history()
+            if self.accounts:
+                self.save_accounts()
+            self.storage.put('derived_index_version', DERIVED_INDEX_VERSION)
 
         # save wallet type the first time
         if self.storage.get('wallet_type') is None:
@@ -218,73 +864,518 @@ class Abstract_Wallet(PrintError):
 
     @profiler
     def load_transactions(self):
-        self.txi = self.storage.get('txi', {})
-        self.txo = self.storage.get('txo', {})
-        self.pruned_txo = self.storage.get('pruned_txo', {})
-        tx_list = self.storage.get('transactions', {})
-        self.claimtrie_transactions = self.storage.get('claimtrie_transactions',{})
-        self.transactions = {}
-        for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
-            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None and (tx_hash not in self.pruned_txo.values()):
+        self.txi = compact_value('txi', self.storage.get('txi', {}, copy=False))
+        self.txo = compact_value('txo', self.storage.get('txo', {}, copy=False))
+        self.pruned_txo = compact_value('pruned_txo', self.storage.get('pruned_txo', {}, copy=False))
+        # raw transactions as saved; save_transactions brings them up to date
+        self.raw_transactions = tx_list = compact_value('transactions',
+                                                        self.storage.get('transactions', {}, copy=False))
+        self.claimtrie_transactions = compact_value('claimtrie_transactions',
+                                                    self.storage.get('claimtrie_transactions', {}, copy=False))
+        # transactions are parsed on first use; wallets saved before the
+        # claim index was kept up to date have it rebuilt once
+        self.transactions = TransactionMap(tx_list)
+        if not self.storage.get('claimtrie_index_complete', False):
+            with self.storage.lock:
+                for tx_hash in tx_list.keys():
+                    tx = self.transactions[tx_hash]
+                    # add to claimtrie transactions if its a claimtrie transaction
+                    for n,txout in enumerate(tx.outputs()):
+                        if txout[0] & (TYPE_CLAIM | TYPE_UPDATE | TYPE_SUPPORT):
+                            self.claimtrie_transactions[tx_hash+':'+str(n)] = txout[0]
+            self.storage.put('claimtrie_index_complete', True)
+
+    def remove_unreferenced_transactions(self):
+        with self.transaction_lock:
+            pruned_spenders = set(self.pruned_txo.values())
+            unreferenced = [tx_hash for tx_hash in self.transactions.keys()
+                            if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None
+                            and tx_hash not in pruned_spenders]
+            for tx_hash in unreferenced:
                 self.print_error("removing unreferenced tx", tx_hash)
                 self.transactions.pop(tx_hash)
+        if unreferenced:
+            self.schedule_save()
+
+    def warm_up_transactions(self, n):
+        """Parse up to n transactions that were not used since the wallet
+        was opened.  Returns False once every transaction is parsed."""
+        if self.unparsed_txs is None:
+            self.unparsed_txs = self.transactions.keys()
+        while n > 0 and self.unparsed_txs:
+            tx = self.transactions.get(self.unparsed_txs.pop())
+            if tx is not None:
+                tx.deserialize()
+                n -= 1
+        return bool(self.unparsed_txs)
+
+    def schedule_save(self):
+        """Record a change to the transaction data.  Changes are saved
+        together once enough of them accumulate or save_interval seconds
+        pass, and when the wallet threads stop.  Without a network they
+        are saved at once."""
+        self.unsaved_changes += 1
+        if self.network is None or self.unsaved_changes >= self.save_max_changes:
+            self.save_transactions()
 
-            # add to claimtrie transactions if its a claimtrie transaction
-            tx.deserialize()
-            for n,txout in enumerate(tx.outputs()):
-                if txout[0] & (TYPE_CLAIM | TYPE_UPDATE | TYPE_SUPPORT):
-                    self.claimtrie_transactions[tx_hash+':'+str(n)] = txout[0]
-
-
+    def save_if_due(self):
+        if self.unsaved_changes and time.time() - self.last_save >= self.save_interval:
+            self.save_transactions()
 
+    def flush_transactions(self):
+        """Called by the storage before it writes: the indexes shared
+        with it are changed in place, so the transactions they refer to
+        are put with them."""
+        if self.unsaved_changes:
+            self.save_transactions()
 
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            self.storage.put('pruned_txo', self.pruned_txo)
-            self.storage.put('addr_history', self.history)
-            self.storage.put('claimtrie_transactions',self.claimtrie_transactions)
+            self.unsaved_changes = 0
+            self.last_save = time.time()
+            added = set(self.transactions) - set(self.raw_transactions)
+            removed = set(self.raw_transactions) - set(self.transactions)
+            for k in added:
+                self.raw_transactions[k] = self.transactions[k].raw_bytes()
+            for k in removed:
+                self.raw_transactions.pop(k)
+            self.storage.put('transactions', self.raw_transactions, copy=False)
+            self.storage.put('txi', self.txi, copy=False)
+            self.storage.put('txo', self.txo, copy=False)
+            self.storage.put('pruned_txo', self.pruned_txo, copy=False)
+            self.storage.put('addr_history', self.history, copy=False)
+            self.storage.put('claimtrie_transactions', self.claimtrie_transactions, copy=False)
+            self.storage.put('tx_addr_hist', self.tx_addr_hist, copy=False)
+            self.storage.put('utxos', self.utxos, copy=False)
+            self.storage.put('spent_outpoints', self.spent_outpoints, copy=False)
+            self.storage.put('claims', self.claims, copy=False)
             if write:
                 self.storage.write()
 
     def clear_history(self):
         with self.transaction_lock:
-            self.txi = {}
-            self.txo = {}
-            self.pruned_txo = {}
+            self.txi = StoredDict()
+            self.txo = StoredDict()
+            self.pruned_txo = StoredDict()
+            self.utxos = StoredDict()
+            self.spent_outpoints = StoredDict()
+            self.addr_utxos = {}
         self.save_transactions()
         with self.lock:
-            self.history = {}
-            self.tx_addr_hist = {}
+            self.history = StoredDict()
+            self.tx_addr_hist = StoredDict()
+            self.storage.put('tx_addr_hist', self.tx_addr_hist, copy=False)
+            self.unconfirmed_tx = {}
+            self.save_unconfirmed_index()
+        with self.transaction_lock:
+            self.reset_claim_index()
+            self.storage.put('claims', self.claims, copy=False)
+        self.invalidate_balances()
+        self.invalidate_history()
+        self.invalidate_wallet_deltas()
 
     @profiler
     def build_reverse_history(self):
-        self.tx_addr_hist = {}
+        # tx hash -> list of the wallet addresses in whose history it is
+        saved = self.storage.get('tx_addr_hist', copy=False) if self.derived_indexes_saved else None
+        if saved is not None:
+            self.tx_addr_hist = compact_value('tx_addr_hist', saved)
+            return
+        self.tx_addr_hist = self.compute_reverse_history()
+        self.storage.put('tx_addr_hist', self.tx_addr_hist, copy=False)
+
+    def compute_reverse_history(self):
+        tx_addr_hist = StoredDict()
         for addr, hist in self.history.items():
             for tx_hash, h in hist:
-                s = self.tx_addr_hist.get(tx_hash, set())
-                s.add(addr)
-                self.tx_addr_hist[tx_hash] = s
+                s = tx_addr_hist.setdefault(tx_hash, [])
+                if addr not in s:
+                    s.append(addr)
+        return tx_addr_hist
+
+    def verify_derived_indexes(self):
+        """Run the next check of the derived indexes loaded from storage.
+        Returns False once every check ran."""
+        if self.unverified_indexes:
+            self.unverified_indexes.pop(0)()
+        return bool(self.unverified_indexes)
+
+    def verify_account_addresses(self):
+        changed = []
+        with self.lock:
+            for acc_id, account in self.accounts.items():
+                if isinstance(account, ImportedAccount):
+                    continue
+                for for_change in [0, 1]:
+                    pubkeys = account.change_pubkeys if for_change else account.receiving_pubkeys
+                    addresses = map(account.pubkeys_to_address, pubkeys)
+                    if addresses != account.get_addresses(for_change):
+                        if for_change:
+                            account.change_addresses = addresses
+                        else:
+                            account.receiving_addresses = addresses
+                        if acc_id not in changed:
+                            changed.append(acc_id)
+            for acc_id in changed:
+                self.print_error("saved addresses do not match account", acc_id)
+                self.reindex_account(acc_id)
+        if changed:
+            self.invalidate_balances()
+            self.invalidate_history()
+            self.save_accounts()
+
+    def verify_reverse_history(self):
+        with self.lock, self.transaction_lock:
+            tx_addr_hist = self.compute_reverse_history()
+            stale = [tx_hash for tx_hash in set(tx_addr_hist) | set(self.tx_addr_hist)
+                     if set(tx_addr_hist.get(tx_hash, [])) != set(self.tx_addr_hist.get(tx_hash, []))]
+            for tx_hash in stale:
+                if tx_hash in tx_addr_hist:
+                    self.tx_addr_hist[tx_hash] = tx_addr_hist[tx_hash]
+                else:
+                    self.tx_addr_hist.pop(tx_hash)
+        if stale:
+            self.print_error("rebuilt saved tx_addr_hist entries:", len(stale))
+            self.schedule_save()
+
+    @profiler
+    def build_utxo_index(self):
+        # the utxo and claim indexes are saved with the wallet
+        saved = saved_spent = saved_claims = None
+        if self.derived_indexes_saved:
+            saved = self.storage.get('utxos', copy=False)
+            saved_spent = self.storage.get('spent_outpoints', copy=False)
+            saved_claims = self.storage.get('claims', copy=False)
+        if saved is None or saved_spent is None or saved_claims is None:
+            self.compute_utxo_index()
+            self.storage.put('utxos', self.utxos, copy=False)
+            self.storage.put('spent_outpoints', self.spent_outpoints, copy=False)
+            self.storage.put('claims', self.claims, copy=False)
+            return
+        self.utxos = compact_value('utxos', saved)
+        self.spent_outpoints = compact_value('spent_outpoints', saved_spent)
+        self.addr_utxos = {}
+        for ser, item in self.utxos.iteritems():
+            self.addr_utxos.setdefault(item[0], set()).add(ser)
+        self.reset_claim_index()
+        self.claims = compact_value('claims', saved_claims)
+        for ser, item in self.claims.iteritems():
+            self.index_claim(ser, item)
+            if item['height'] > 0:
+                self.claim_expirations.append((item['height'] + lbrycrd.EXPIRATION_BLOCKS, ser))
+        self.claim_expirations.sort()
+
+    def compute_utxo_index(self):
+        # Unspent outputs of wallet addresses.  Maps outpoint to an
+        # (address, value, height, is_coinbase, claim_type) tuple, where
+        # claim_type holds the claim, support and update bits of the
+        # output type.  Access with self.transaction_lock.
+        self.utxos = StoredDict()
+        # Outpoints spent by wallet transactions, mapped to the spending tx.
+        # Covers both txi and pruned_txo, so that remove_transaction finds
+        # the spends of a transaction without scanning them.
+        self.spent_outpoints = StoredDict(self.pruned_txo)
+        # address -> set of its unspent outpoints
+        self.addr_utxos = {}
+        self.reset_claim_index()
+        for tx_hash, d in self.txi.items():
+            for addr, l in d.items():
+                for ser, v in l:
+                    self.spent_outpoints[ser] = tx_hash
+        for addr, hist in self.history.items():
+            for tx_hash, height in hist:
+                self.add_utxos(tx_hash, addr, height)
+        # the storage diffs them with the values they replace
+        self.utxos.take_changed()
+        self.spent_outpoints.take_changed()
+        self.claims.take_changed()
+
+    def reset_claim_index(self):
+        # Claim, support and update outputs of wallet addresses, spent or
+        # not.  Maps outpoint to a dict with the fields of get_name_claims
+        # that do not depend on the chain height, and the height; the name
+        # and value are hex encoded, as claims are saved with the wallet.
+        # claims_by_id and claims_by_name map claim ids and names to sets
+        # of outpoints, and claim_expirations holds sorted
+        # (expiration_height, outpoint) pairs of confirmed claims.  Access
+        # with self.transaction_lock.
+        self.claims = StoredDict()
+        self.claims_by_id = {}
+        self.claims_by_name = {}
+        self.claim_expirations = []
+
+    def verify_utxo_index(self):
+        with self.lock:
+            with self.transaction_lock:
+                saved = self.utxos, self.spent_outpoints, self.claims
+                self.compute_utxo_index()
+                stale = saved != (self.utxos, self.spent_outpoints, self.claims)
+                if stale:
+                    self.storage.put('utxos', self.utxos, copy=False)
+                    self.storage.put('spent_outpoints', self.spent_outpoints, copy=False)
+                    self.storage.put('claims', self.claims, copy=False)
+                else:
+                    self.utxos, self.spent_outpoints, self.claims = saved
+        if stale:
+            self.print_error("rebuilt saved utxo index")
+            self.invalidate_balances()
+            self.schedule_save()
+
+    def add_utxos(self, tx_hash, address, height):
+        """Index the unspent outputs and the claims of tx_hash to address,
+        or update their height."""
+        for n, v, is_cb in self.txo.get(tx_hash, {}).get(address, []):
+            ser = tx_hash + ':%d' % n
+            claim_type = self.claimtrie_transactions.get(ser, 0) & (TYPE_CLAIM | TYPE_SUPPORT | TYPE_UPDATE)
+            if claim_type:
+                self.add_claim(ser, address, v, height)
+            if ser in self.spent_outpoints:
+                continue
+            self.utxos[ser] = (address, v, height, is_cb, claim_type)
+            self.addr_utxos.setdefault(address, set()).add(ser)
+
+    def remove_utxo(self, ser):
+        item = self.utxos.pop(ser, None)
+        if item is not None:
+            address = item[0]
+            self.addr_utxos[address].discard(ser)
+            if not self.addr_utxos[address]:
+                self.addr_utxos.pop(address)
+
+    def add_claim(self, ser, address, value, height):
+        item = self.claims.get(ser)
+        if item is None:
+            item = self.parse_claim(ser, address, value)
+            if item is None:
+                return
+            self.claims[ser] = item
+            self.index_claim(ser, item)
+        if item['height'] != height:
+            self.unindex_claim_expiration(ser, item)
+            # replaced rather than changed in place, so that the saved
+            # claims record it
+            self.claims[ser] = dict(item, height=height)
+            if height > 0:
+                bisect.insort(self.claim_expirations, (height + lbrycrd.EXPIRATION_BLOCKS, ser))
+
+    def parse_claim(self, ser, address, value):
+        tx_hash, n = ser.split(':')
+        tx = self.transactions.get(tx_hash)
+        if tx is None:
+            return
+        _type, dest, v = tx.outputs()[int(n)]
+        item = {'txid': tx_hash, 'nout': int(n), 'address': address, 'amount': value}
+        if _type & TYPE_CLAIM:
+            item['category'] = 'claim'
+            name, claim_value = dest[0]
+            claim_id = lbrycrd.claim_id_hash(rev_hex(tx_hash).decode('hex'), int(n))
+        elif _type & TYPE_SUPPORT:
+            item['category'] = 'support'
+            name, claim_id = dest[0]
+            claim_value = None
+        else:
+            item['category'] = 'update'
+            name, claim_id, claim_value = dest[0]
+        item['name'] = name.encode('hex')
+        if claim_value is not None:
+            item['value'] = claim_value.encode('hex')
+        item['claim_id'] = lbrycrd.encode_claim_id_hex(claim_id)
+        item['height'] = None
+        return item
+
+    def index_claim(self, ser, item):
+        self.claims_by_id.setdefault(item['claim_id'], set()).add(ser)
+        self.claims_by_name.setdefault(item['name'].decode('hex'), set()).add(ser)
+
+    def unindex_claim_expiration(self, ser, item):
+        if item['height'] > 0:
+            pair = (item['height'] + lbrycrd.EXPIRATION_BLOCKS, ser)
+            i = bisect.bisect_left(self.claim_expirations, pair)
+            if i < len(self.claim_expirations) and self.claim_expirations[i] == pair:
+                del self.claim_expirations[i]
+
+    def remove_claim(self, ser):
+        item = self.claims.pop(ser, None)
+        if item is None:
+            return
+        self.unindex_claim_expiration(ser, item)
+        for index, key in [(self.claims_by_id, item['claim_id']), (self.claims_by_name, item['name'].decode('hex'))]:
+            index[key].discard(ser)
+            if not index[key]:
+                index.pop(key)
+
+    def get_history_height(self, address, tx_hash):
+        for h, height in self.history.get(address, []):
+            if h == tx_hash:
+                return height
+
+    @profiled
+    def get_utxos(self, domain=None, exclude_frozen=False, mature_only=False, claims=None):
+        """Return the unspent outputs of the wallet as a list of
+        (outpoint, address, value, height, is_coinbase, claim_type)
+        tuples.  claims selects claimtrie outputs (True), plain coins
+        (False) or both (None)."""
+        local_height = self.get_local_height()
+        with self.transaction_lock.read():
+            if domain is None:
+                outpoints = self.utxos.keys()
+            else:
+                outpoints = [ser for addr in set(domain) for ser in self.addr_utxos.get(addr, ())]
+            result = []
+            for ser in outpoints:
+                address, value, height, is_cb, claim_type = self.utxos[ser]
+                if exclude_frozen and address in self.frozen_addresses:
+                    continue
+                if mature_only and is_cb and height + COINBASE_MATURITY > local_height:
+                    continue
+                if claims is not None and bool(claim_type) != claims:
+                    continue
+                result.append((ser, address, value, height, is_cb, claim_type))
+        return result
+
+    @profiler
+    def build_unconfirmed_index(self):
+        # Unconfirmed transactions of the address histories.  Maps tx hash
+        # to a dict with 'height' (0 or -1) and 'first_seen'; 'fee' and
+        # 'size' are filled in lazily once the transaction is known.  The
+        # heights and first_seen are saved with the wallet.
+        self.unconfirmed_tx = {}
+        saved = self.storage.get('unconfirmed_txs') if self.derived_indexes_saved else None
+        if saved is None:
+            self.unconfirmed_tx = self.compute_unconfirmed_index()
+            self.save_unconfirmed_index()
+            return
+        for tx_hash, (height, first_seen) in saved.iteritems():
+            self.unconfirmed_tx[intern_str(tx_hash)] = {'height': height, 'first_seen': first_seen}
+
+    def compute_unconfirmed_index(self):
+        unconfirmed_tx = {}
+        now = int(time.time())
+        for addr, hist in self.history.items():
+            for tx_hash, height in hist:
+                if height <= 0:
+                    item = self.unconfirmed_tx.get(tx_hash)
+                    unconfirmed_tx[tx_hash] = {'height': height,
+                                               'first_seen': item['first_seen'] if item else now}
+        return unconfirmed_tx
+
+    def verify_unconfirmed_index(self):
+        with self.lock:
+            unconfirmed_tx = self.compute_unconfirmed_index()
+            heights = lambda d: dict((tx_hash, item['height']) for tx_hash, item in d.iteritems())
+            stale = heights(unconfirmed_tx) != heights(self.unconfirmed_tx)
+            if stale:
+                self.unconfirmed_tx = unconfirmed_tx
+                self.save_unconfirmed_index()
+        if stale:
+            self.print_error("rebuilt saved unconfirmed index")
+
+    def save_unconfirmed_index(self):
+        saved = dict((k, [v['height'], v['first_seen']]) for k, v in self.unconfirmed_tx.items())
+        self.storage.put('unconfirmed_txs', saved)
+
+    def update_unconfirmed_tx(self, tx_hash, height):
+        '''Track tx_hash in the unconfirmed index while its height is 0 or
+        -1.  Returns True if the index changed.'''
+        item = self.unconfirmed_tx.get(tx_hash)
+        if height is None or height > 0:
+            return self.unconfirmed_tx.pop(tx_hash, None) is not None
+        if item is None:
+            self.unconfirmed_tx[tx_hash] = {'height': height, 'first_seen': int(time.time())}
+            return True
+        if item['height'] == height:
+            return False
+        item['height'] = height
+        return True
+
+    def is_unconfirmed(self, tx_hash):
+        return tx_hash in self.unconfirmed_tx
+
+    def get_unconfirmed_txs(self):
+        '''Returns the hashes of unconfirmed wallet transactions'''
+        return self.unconfirmed_tx.keys()
+
+    def get_unconfirmed_parents(self, tx_hash):
+        '''Returns the unconfirmed transactions tx_hash spends from'''
+        tx = self.transactions.get(tx_hash)
+        if tx is None:
+            return set()
+        return set(txin['prevout_hash'] for txin in tx.inputs()
+                   if not txin.get('is_coinbase') and txin['prevout_hash'] in self.unconfirmed_tx)
+
+    def get_unconfirmed_ancestors(self, tx_hash):
+        '''Returns the chain of unconfirmed transactions tx_hash depends on'''
+        ancestors = set()
+        todo = [tx_hash]
+        while todo:
+            for parent in self.get_unconfirmed_parents(todo.pop()):
+                if parent not in ancestors:
+                    ancestors.add(parent)
+                    todo.append(parent)
+        return ancestors
+
+    def get_unconfirmed_info(self, tx_hash):
+        '''Returns a dict with height, first_seen, fee, size, fee_rate (per
+        kB) and the unconfirmed parents of tx_hash, or None if tx_hash
+        is not unconfirmed.  Fee and fee_rate are None if the value of
+        an input is unknown.'''
+        item = self.unconfirmed_tx.get(tx_hash)
+        if item is None:
+            return None
+        tx = self.transactions.get(tx_hash)
+        if tx is not None and item.get('fee') is None:
+            item['size'] = len(tx.raw_bytes())
+            item['fee'] = self.get_tx_input_value(tx)
+            if item['fee'] is not None:
+                item['fee'] -= tx.output_value()
+        out = dict(item)
+        fee, size = out.get('fee'), out.get('size')
+        out['fee_rate'] = fee * 1000 / size if fee is not None and size else None
+        out['parents'] = self.get_unconfirmed_parents(tx_hash)
+        return out
+
+    def get_tx_input_value(self, tx):
+        '''Sum of the values spent by tx, or None if a previous transaction
+        is not in the wallet.'''
+        v = 0
+        for txin in tx.inputs():
+            if txin.get('is_coinbase'):
+                return None
+            prev_tx = self.transactions.get(txin['prevout_hash'])
+            if prev_tx is None:
+                return None
+            v += prev_tx.outputs()[txin['prevout_n']][2]
+        return v
+
+    def get_unconfirmed_fee_deficit(self, tx_hashes, fee_per_kb):
+        '''Fee that the unconfirmed transactions among tx_hashes and their
+        unconfirmed ancestors lack to pay fee_per_kb.  Transactions whose
+        fee is unknown are not counted.'''
+        txs = set(tx_hash for tx_hash in tx_hashes if tx_hash in self.unconfirmed_tx)
+        for tx_hash in list(txs):
+            txs |= self.get_unconfirmed_ancestors(tx_hash)
+        deficit = 0
+        for tx_hash in txs:
+            info = self.get_unconfirmed_info(tx_hash)
+            if info is None or info['fee'] is None or not info['size']:
+                continue
+            deficit += max(0, info['size'] * fee_per_kb / 1000 - info['fee'])
+        return deficit
 
     @profiler
     def check_history(self):
         save = False
+        pruned_spenders = set(self.pruned_txo.values())
         for addr, hist in self.history.items():
             if not self.is_mine(addr):
-                self.history.pop(addr)
+                with self.transaction_lock:
+                    self.history.pop(addr)
                 save = True
                 continue
 
             for tx_hash, tx_height in hist:
-                if tx_hash in self.pruned_txo.values() or self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in pruned_spenders or self.txi.get(tx_hash) or self.txo.get(tx_hash):
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
@@ -318,18 +1409,69 @@ class Abstract_Wallet(PrintError):
         for k, v in d.items():
             if self.wallet_type == 'old' and k in [0, '0']:
                 v['mpk'] = self.storage.get('master_public_key')
-                self.accounts['0'] = OldAccount(v)
+                self.accounts['0'] = OldAccount(self.with_saved_addresses('0', v))
             elif v.get('imported'):
                 self.accounts[k] = ImportedAccount(v)
             elif v.get('xpub'):
-                self.accounts[k] = BIP32_Account(v)
+                self.accounts[k] = BIP32_Account(self.with_saved_addresses(k, v))
             elif v.get('pending'):
                 removed = True
             else:
                 self.print_error("cannot load account", v)
+        self.build_address_index()
         if removed:
             self.save_accounts()
 
+    def with_saved_addresses(self, acc_id, v):
+        """Add the addresses saved for an account to its stored data, so
+        that the account does not derive them again from its pubkeys."""
+        if not self.derived_indexes_saved:
+            return v
+        addresses = self.storage.get('account_addresses', {}, copy=False).get(acc_id)
+        if addresses is None:
+            return v
+        return dict(v, receiving_addresses=addresses[0], change_addresses=addresses[1])
+
+    def build_address_index(self):
+        # Maps each address to (account id, (for_change, n)), so that
+        # is_mine and get_address_index do not scan every account.
+        # Imported addresses are numbered in sorted order, which changes
+        # as keys are imported; their sequence is None and looked up by
+        # get_address_index.
+        self.address_index = {}
+        # number of addresses indexed, per (account id, for_change)
+        self.address_index_size = {}
+        for acc_id in self.accounts:
+            self.index_new_addresses(acc_id)
+
+    def index_new_addresses(self, acc_id):
+        """Add the addresses created in an account since it was last
+        indexed."""
+        account = self.accounts[acc_id]
+        imported = isinstance(account, ImportedAccount)
+        for for_change in [0, 1]:
+            n = self.address_index_size.get((acc_id, for_change), 0)
+            addresses = account.get_addresses(for_change)[n:]
+            for address in addresses:
+                self.address_index[address] = acc_id, None if imported else (for_change, n)
+                n += 1
+            self.address_index_size[(acc_id, for_change)] = n
+            if addresses:
+                # transactions may have become relevant
+                self.invalidate_wallet_deltas()
+
+    def reindex_account(self, acc_id):
+        """Index an account from scratch, after it was replaced or its
+        addresses were renumbered."""
+        for address, (a, sequence) in self.address_index.items():
+            if a == acc_id:
+                self.address_index.pop(address)
+        self.address_index_size.pop((acc_id, 0), None)
+        self.address_index_size.pop((acc_id, 1), None)
+        self.invalidate_wallet_deltas()
+        if acc_id in self.accounts:
+            self.index_new_addresses(acc_id)
+
     def create_main_account(self):
         pass
 
@@ -379,11 +1521,15 @@ class Abstract_Wallet(PrintError):
         if self.accounts.get(IMPORTED_ACCOUNT) is None:
             self.accounts[IMPORTED_ACCOUNT] = ImportedAccount({'imported':{}})
         self.accounts[IMPORTED_ACCOUNT].add(address, pubkey, sec, password)
+        self.address_index[address] = IMPORTED_ACCOUNT, None
+        self.address_index_size[(IMPORTED_ACCOUNT, 0)] = len(self.accounts[IMPORTED_ACCOUNT].get_addresses(0))
+        self.invalidate_wallet_deltas()
+        self.invalidate_balances([address])
         self.save_accounts()
 
         # force resynchronization, because we need to re-run add_transaction
-        if address in self.history:
-            self.history.pop(address)
+        with self.transaction_lock:
+            self.history.pop(address, None)
 
         if self.synchronizer:
             self.synchronizer.add(address)
@@ -392,8 +1538,13 @@ class Abstract_Wallet(PrintError):
     def delete_imported_key(self, addr):
         account = self.accounts[IMPORTED_ACCOUNT]
         account.remove(addr)
+        self.address_index.pop(addr, None)
+        self.address_index_size[(IMPORTED_ACCOUNT, 0)] = len(account.get_addresses(0))
         if not account.get_addresses(0):
             self.accounts.pop(IMPORTED_ACCOUNT)
+        self.invalidate_wallet_deltas()
+        self.invalidate_balances([addr])
+        self.invalidate_history()
         self.save_accounts()
 
     def set_label(self, name, text = None):
@@ -401,16 +1552,18 @@ class Abstract_Wallet(PrintError):
         old_text = self.labels.get(name)
         if text:
             if old_text != text:
-                self.labels[name] = text
+                with self.transaction_lock:
+                    self.labels[name] = text
                 changed = True
         else:
             if old_text:
-                self.labels.pop(name)
+                with self.transaction_lock:
+                    self.labels.pop(name)
                 changed = True
 
         if changed:
             run_hook('set_label', self, name, text)
-            self.storage.put('labels', self.labels)
+            self.storage.put('labels', self.labels, copy=False)
 
         return changed
 
@@ -418,7 +1571,7 @@ class Abstract_Wallet(PrintError):
         return list(addr for acc in self.accounts for addr in self.get_account_addresses(acc, include_change))
 
     def is_mine(self, address):
-        return address in self.addresses(True)
+        return address in self.address_index
 
     def is_change(self, address):
         if not self.is_mine(address): return False
@@ -427,12 +1580,13 @@ class Abstract_Wallet(PrintError):
         return s[0] == 1
 
     def get_address_index(self, address):
-        for acc_id in self.accounts:
-            for for_change in [0,1]:
-                addresses = self.accounts[acc_id].get_addresses(for_change)
-                if address in addresses:
-                    return acc_id, (for_change, addresses.index(address))
-        raise Exception("Address not found", address)
+        try:
+            acc_id, sequence = self.address_index[address]
+        except KeyError:
+            raise Exception("Address not found", address)
+        if sequence is None:
+            sequence = self.accounts[acc_id].get_address_sequence(address)
+        return acc_id, sequence
 
     def get_private_key(self, address, password):
         if self.is_watching_only():
@@ -463,14 +1617,34 @@ class Abstract_Wallet(PrintError):
     def add_unverified_tx(self, tx_hash, tx_height):
         # Only add if confirmed and not verified
         if tx_height > 0 and tx_hash not in self.verified_tx:
+            if self.unverified_tx.get(tx_hash) != tx_height:
+                self.invalidate_history([tx_hash])
             self.unverified_tx[tx_hash] = tx_height
+            if self.verifier:
+                self.verifier.add(tx_hash)
 
-    def add_verified_tx(self, tx_hash, info):
+    @profiled
+    def add_verified_tx(self, tx_hash, info, merkle_branch=None):
         # Remove from the unverified map and add to the verified map and
+        # replace the stored merkle branch, if any, by merkle_branch
         self.unverified_tx.pop(tx_hash, None)
-        with self.lock:
+        with self.lock, self.transaction_lock:
+            old = self.verified_tx.get(tx_hash)
+            if old is not None:
+                self._unindex_verified_tx(tx_hash, old)
             self.verified_tx[tx_hash] = info  # (tx_height, timestamp, pos)
-        self.storage.put('verified_tx3', self.verified_tx)
+            tx_height, timestamp, pos = info
+            if self.verified_tx_index is not None:
+                bisect.insort(self.verified_tx_index, (tx_height, pos, tx_hash))
+            if merkle_branch is not None:
+                self.merkle_branches[tx_hash] = (pos, ''.join(merkle_branch))
+                branches = True
+            else:
+                branches = self.merkle_branches.pop(tx_hash, None) is not None
+        self.storage.put('verified_tx3', self.verified_tx, copy=False)
+        if branches:
+            self.storage.put('merkle_branches', self.merkle_branches)
+        self.invalidate_history([tx_hash])
 
         conf, timestamp = self.get_confirmations(tx_hash)
         self.network.trigger_callback('verified', tx_hash, conf, timestamp)
@@ -479,15 +1653,69 @@ class Abstract_Wallet(PrintError):
         '''Returns a map from tx hash to transaction height'''
         return self.unverified_tx
 
+    def get_merkle_branch(self, tx_hash):
+        '''Returns the stored (block_pos, merkle_branch) of a transaction,
+        or None if its branch was not persisted.'''
+        with self.lock.read():
+            item = self.merkle_branches.get(tx_hash)
+        if item is None:
+            return None
+        pos, branch = item
+        return pos, [branch[i:i+64] for i in range(0, len(branch), 64)]
+
+    def get_merkle_branch_txs(self):
+        with self.lock.read():
+            return self.merkle_branches.keys()
+
+    def unverify_tx(self, tx_hash):
+        '''Used by the verifier to move a verified transaction back to
+        the unverified map, so that it is verified again.  Its stored
+        merkle branch is kept, to be checked against the header first.'''
+        with self.lock, self.transaction_lock:
+            info = self.verified_tx.pop(tx_hash, None)
+            if info is None:
+                return
+            self._unindex_verified_tx(tx_hash, info)
+        tx_height, timestamp, pos = info
+        self.unverified_tx[tx_hash] = tx_height
+        self.invalidate_history([tx_hash])
+        self.storage.put('verified_tx3', self.verified_tx, copy=False)
+
+    def get_verified_tx_index(self):
+        '''Return verified_tx_index, sorting the verified transactions
+        the first time.  Call with self.lock held.'''
+        if self.verified_tx_index is None:
+            self.verified_tx_index = sorted((height, pos, tx_hash) for tx_hash, (height, timestamp, pos)
+                                            in self.verified_tx.items())
+        return self.verified_tx_index
+
+    def _unindex_verified_tx(self, tx_hash, info):
+        tx_height, timestamp, pos = info
+        if self.verified_tx_index is None:
+            return
+        i = bisect.bisect_left(self.verified_tx_index, (tx_height, pos, tx_hash))
+        if i < len(self.verified_tx_index) and self.verified_tx_index[i][2] == tx_hash:
+            del self.verified_tx_index[i]
+
     def undo_verifications(self, height):
-        '''Used by the verifier when a reorg has happened'''
-        txs = []
-        with self.lock:
-            for tx_hash, item in self.verified_tx:
-                tx_height, timestamp, pos = item
-                if tx_height >= height:
-                    self.verified_tx.pop(tx_hash, None)
-                    txs.append(tx_hash)
+        '''Used by the verifier when a reorg has happened.  Moves the
+        transactions at or above height back to the unverified map and
+        returns their hashes.  Their stored merkle branches are kept, so
+        that they can be verified again against the new headers.'''
+        with self.lock, self.transaction_lock:
+            index = self.get_verified_tx_index()
+            i = bisect.bisect_left(index, (height,))
+            removed = index[i:]
+            del index[i:]
+            txs = []
+            for tx_height, pos, tx_hash in removed:
+                self.verified_tx.pop(tx_hash, None)
+                txs.append(tx_hash)
+        for tx_height, pos, tx_hash in removed:
+            self.unverified_tx[tx_hash] = tx_height
+        if txs:
+            self.storage.put('verified_tx3', self.verified_tx, copy=False)
+            self.invalidate_history(txs)
         return txs
 
     def get_local_height(self):
@@ -496,7 +1724,7 @@ class Abstract_Wallet(PrintError):
 
     def get_confirmations(self, tx):
         """ return the number of confirmations of a monitored transaction. """
-        with self.lock:
+        with self.lock.read():
             if tx in self.verified_tx:
                 height, timestamp, pos = self.verified_tx[tx]
                 conf = (self.get_local_height() - height + 1)
@@ -512,7 +1740,7 @@ class Abstract_Wallet(PrintError):
 
     def get_txpos(self, tx_hash):
         "return position, even if the tx is unverified"
-        with self.lock:
+        with self.lock.read():
             x = self.verified_tx.get(tx_hash)
         y = self.unverified_tx.get(tx_hash)
         if x:
@@ -548,24 +1776,58 @@ class Abstract_Wallet(PrintError):
 
     def get_wallet_delta(self, tx):
         """ effect of tx on wallet """
-        addresses = self.addresses(True)
+        return self.classify_transaction(tx, self.get_prevout_values([tx]))
+
+    @profiled
+    def get_wallet_deltas(self, tx_hashes):
+        """Return a map from each of tx_hashes, which must be wallet
+        transactions, to its get_wallet_delta.  Results are cached until
+        the transaction or the outputs it spends change."""
+        result = {}
+        todo = []
+        for tx_hash in tx_hashes:
+            item = self.wallet_deltas.get(tx_hash)
+            if item is None:
+                todo.append(tx_hash)
+            else:
+                result[tx_hash] = item
+        txs = [self.transactions[tx_hash] for tx_hash in todo]
+        values = self.get_prevout_values(txs)
+        for tx_hash, tx in zip(todo, txs):
+            result[tx_hash] = self.wallet_deltas[tx_hash] = self.classify_transaction(tx, values)
+        return result
+
+    def invalidate_wallet_deltas(self, tx_hashes=None):
+        if tx_hashes is None:
+            self.wallet_deltas = {}
+        else:
+            for tx_hash in tx_hashes:
+                self.wallet_deltas.pop(tx_hash, None)
+
+    def get_prevout_values(self, txs):
+        """Return a map from outpoint to value for the wallet outputs
+        spent by txs."""
+        values = {}
+        prevout_hashes = set(txin['prevout_hash'] for tx in txs for txin in tx.inputs()
+                             if not txin.get('is_coinbase'))
+        with self.transaction_lock.read():
+            for prevout_hash in prevout_hashes:
+                for addr, l in self.txo.get(prevout_hash, {}).items():
+                    for n, v, cb in l:
+                        values['%s:%d' % (prevout_hash, n)] = v
+        return values
+
+    def classify_transaction(self, tx, prevout_values):
         is_relevant = False
         is_send = False
         is_pruned = False
         is_partial = False
         v_in = v_out = v_out_mine = 0
         for item in tx.inputs():
-            addr = item.get('address')
-            if addr in addresses:
+            if self.is_mine(item.get('address')):
                 is_send = True
                 is_relevant = True
-                d = self.txo.get(item['prevout_hash'], {}).get(addr, [])
-                for n, v, cb in d:
-                    if n == item['prevout_n']:
-                        value = v
-                        break
-                else:
-                    value = None
+                value = prevout_values.get('%s:%d' % (item['prevout_hash'], item['prevout_n']))
                 if value is None:
                     is_pruned = True
                 else:
@@ -576,7 +1838,7 @@ class Abstract_Wallet(PrintError):
             is_partial = False
         for addr, value in tx.get_outputs():
             v_out += value
-            if addr in addresses:
+            if self.is_mine(addr):
                 v_out_mine += value
                 is_relevant = True
         if is_pruned:
@@ -602,20 +1864,21 @@ class Abstract_Wallet(PrintError):
         h = self.history.get(address, [])
         received = {}
         sent = {}
-        for tx_hash, height in h:
-            l = self.txo.get(tx_hash, {}).get(address, [])
-            for n, v, is_cb in l:
-                received[tx_hash + ':%d'%n] = (height, v, is_cb)
-        for tx_hash, height in h:
-            l = self.txi.get(tx_hash, {}).get(address, [])
-            for txi, v in l:
-                sent[txi] = height
+        with self.transaction_lock.read():
+            for tx_hash, height in h:
+                l = self.txo.get(tx_hash, {}).get(address, [])
+                for n, v, is_cb in l:
+                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
+            for tx_hash, height in h:
+                l = self.txi.get(tx_hash, {}).get(address, [])
+                for txi, v in l:
+                    sent[txi] = height
         return received, sent
 
     def get_addr_utxo(self, address):
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
+        coins = {}
+        for ser, addr, value, height, is_cb, claim_type in self.get_utxos([address]):
+            coins[ser] = (height, value, is_cb)
         return coins
 
     # return the total amount ever received by an address
@@ -626,8 +1889,26 @@ class Abstract_Wallet(PrintError):
 
     # return the balance of a bitcoin address: confirmed and matured, unconfirmed, unmatured
     def get_addr_balance(self, address, exclude_claimtrietx=False):
+        return self.get_cached_addr_balance(address, exclude_claimtrietx)[:3]
+
+    def get_cached_addr_balance(self, address, exclude_claimtrietx):
+        """Return (c, u, x, valid_below) for an address, where valid_below
+        is the height at which an immature coinbase output matures."""
+        local_height = self.get_local_height()
+        key = address, exclude_claimtrietx
+        item = self.addr_balances.get(key)
+        if item is not None and (item[3] is None or local_height < item[3]):
+            return item
+        generation = self.balance_generation
+        item = self.compute_addr_balance(address, exclude_claimtrietx, local_height)
+        if generation == self.balance_generation:
+            self.addr_balances[key] = item
+        return item
+
+    def compute_addr_balance(self, address, exclude_claimtrietx, local_height):
         received, sent = self.get_addr_io(address)
         c = u = x = 0
+        valid_below = None
         for txo, (tx_height, v, is_cb) in received.items():
             exclude_tx = False
             # check if received transaction is a claimtrie tx to ourself
@@ -638,8 +1919,9 @@ class Abstract_Wallet(PrintError):
                     exclude_tx = True
 
             if not exclude_tx:
-                if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
+                if is_cb and tx_height + COINBASE_MATURITY > local_height:
                     x += v
+                    valid_below = min(valid_below or tx_height + COINBASE_MATURITY, tx_height + COINBASE_MATURITY)
                 elif tx_height > 0:
                     c += v
                 else:
@@ -649,7 +1931,38 @@ class Abstract_Wallet(PrintError):
                         c -= v
                     else:
                         u -= v
-        return c, u, x
+        return c, u, x, valid_below
+
+    def invalidate_balances(self, addresses=None):
+        """Drop the cached balances of addresses, or of every address,
+        and the cached totals."""
+        self.balance_generation += 1
+        self.balance_totals = {}
+        if addresses is None:
+            self.addr_balances = {}
+            return
+        for address in addresses:
+            self.addr_balances.pop((address, False), None)
+            self.addr_balances.pop((address, True), None)
+
+    def get_cached_total(self, key, exclude_claimtrietx, get_domain):
+        local_height = self.get_local_height()
+        item = self.balance_totals.get((key, exclude_claimtrietx))
+        if item is not None and (item[3] is None or local_height < item[3]):
+            return item[:3]
+        generation = self.balance_generation
+        cc = uu = xx = 0
+        valid_below = None
+        for addr in get_domain():
+            c, u, x, below = self.get_cached_addr_balance(addr, exclude_claimtrietx)
+            cc += c
+            uu += u
+            xx += x
+            if below is not None:
+                valid_below = min(valid_below or below, below)
+        if generation == self.balance_generation:
+            self.balance_totals[(key, exclude_claimtrietx)] = cc, uu, xx, valid_below
+        return cc, uu, xx
 
 
     # get coin object in order to abandon calimtrie transactions
@@ -698,35 +2011,34 @@ class Abstract_Wallet(PrintError):
 
 
     # noinspection PyPep8
-    def get_spendable_coins(self, domain = None, exclude_frozen = True, abandon_txid=None):
+    def get_spendable_coins(self, domain = None, exclude_frozen = True, abandon_txid=None,
+                            confirmed_only=False):
         coins = []
         found_abandon_txid = False
-        if domain is None:
-            domain = self.addresses(True)
-        if exclude_frozen:
-            domain = set(domain) - self.frozen_addresses
-        for addr in domain:
-            c = self.get_addr_utxo(addr)
-            for txo, v in c.items():
-                tx_height, value, is_cb = v
-                if is_cb and tx_height + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                prevout_hash, prevout_n = txo.split(':')
-                tx = self.transactions.get(prevout_hash)
-                tx.deserialize()
-                txout = tx.outputs()[int(prevout_n)]
-                if txout[0] & (TYPE_CLAIM | TYPE_SUPPORT | TYPE_UPDATE) == 0 or (abandon_txid is not None and prevout_hash == abandon_txid):
-                    output = {
-                        'address':addr,
-                        'value':value,
-                        'prevout_n':int(prevout_n),
-                        'prevout_hash':prevout_hash,
-                        'height':tx_height,
-                        'coinbase':is_cb,
-                        'is_claim': bool(txout[0] & TYPE_CLAIM),
-                        'is_support': bool(txout[0] & TYPE_SUPPORT),
-                        'is_update': bool(txout[0] & TYPE_UPDATE),
-                    }
+        for utxo in self.get_utxos(domain, exclude_frozen, mature_only=True):
+            txo, addr, value, tx_height, is_cb, claim_type = utxo
+            prevout_hash, prevout_n = txo.split(':')
+            unconfirmed = self.is_unconfirmed(prevout_hash)
+            if confirmed_only and unconfirmed:
+                continue
+            if claim_type == 0 or (abandon_txid is not None and prevout_hash == abandon_txid):
+                output = {
+                    'address':addr,
+                    'value':value,
+                    'prevout_n':int(prevout_n),
+                    'prevout_hash':prevout_hash,
+                    'height':tx_height,
+                    'coinbase':is_cb,
+                    'unconfirmed': unconfirmed,
+                    'is_claim': bool(claim_type & TYPE_CLAIM),
+                    'is_support': bool(claim_type & TYPE_SUPPORT),
+                    'is_update': bool(claim_type & TYPE_UPDATE),
+                }
+                if claim_type:
+                    # only claimtrie outputs need their transaction parsed
+                    tx = self.transactions.get(prevout_hash)
+                    tx.deserialize()
+                    txout = tx.outputs()[int(prevout_n)]
                     if txout[0] & TYPE_CLAIM:
                         output['claim_name'] = txout[1][0][0]
                         output['claim_value'] = txout[1][0][1]
@@ -737,10 +2049,9 @@ class Abstract_Wallet(PrintError):
                         output['claim_name'] = txout[1][0][0]
                         output['claim_id'] = txout[1][0][1]
                         output['claim_value'] = txout[1][0][2]
-                    coins.append(output)
-                if abandon_txid is not None and prevout_hash == abandon_txid:
-                    found_abandon_txid = True
-                continue
+                coins.append(output)
+            if abandon_txid is not None and prevout_hash == abandon_txid:
+                found_abandon_txid = True
         if abandon_txid is not None and not found_abandon_txid:
             raise ValueError("Can't spend from the given txid")
         return coins
@@ -772,20 +2083,20 @@ class Abstract_Wallet(PrintError):
 
     def get_account_from_address(self, addr):
         "Returns the account that contains this address, or None"
-        for acc_id in self.accounts:    # similar to get_address_index but simpler
-            if addr in self.get_account_addresses(acc_id):
-                return acc_id
-        return None
+        item = self.address_index.get(addr)
+        return item[0] if item else None
 
     def get_account_balance(self, account, exclude_claimtrietx=False):
-        return self.get_balance(self.get_account_addresses(account, exclude_claimtrietx))
+        return self.get_cached_total(('account', account), exclude_claimtrietx,
+                                     lambda: self.get_account_addresses(account, exclude_claimtrietx))
 
     def get_frozen_balance(self):
         return self.get_balance(self.frozen_addresses)
 
+    @profiled
     def get_balance(self, domain=None, exclude_claimtrietx=False):
         if domain is None:
-            domain = self.addresses(True)
+            return self.get_cached_total(('wallet',), exclude_claimtrietx, lambda: self.addresses(True))
         cc = uu = xx = 0
         for addr in domain:
             c, u, x = self.get_addr_balance(addr,exclude_claimtrietx)
@@ -799,12 +2110,7 @@ class Abstract_Wallet(PrintError):
             return self.history.get(address, [])
 
     def get_status(self, h):
-        if not h:
-            return None
-        status = ''
-        for tx_hash, height in h:
-            status += tx_hash + ':%d:' % height
-        return hashlib.sha256( status ).digest().encode('hex')
+        return history_status(h)
 
     def find_pay_to_pubkey_address(self, prevout_hash, prevout_n):
         dd = self.txo.get(prevout_hash, {})
@@ -814,9 +2120,11 @@ class Abstract_Wallet(PrintError):
                     self.print_error("found pay-to-pubkey address:", addr)
                     return addr
 
+    @profiled
     def add_transaction(self, tx_hash, tx):
         print_error("Adding tx: ", tx_hash)
         is_coinbase = tx.inputs()[0].get('is_coinbase') == True
+        changed = [tx_hash]
         with self.transaction_lock:
             # add inputs
             self.txi[tx_hash] = d = {}
@@ -839,6 +2147,8 @@ class Abstract_Wallet(PrintError):
                             break
                     else:
                         self.pruned_txo[ser] = tx_hash
+                    self.spent_outpoints[ser] = tx_hash
+                    self.remove_utxo(ser)
 
             # add outputs
             self.txo[tx_hash] = d = {}
@@ -866,82 +2176,156 @@ class Abstract_Wallet(PrintError):
                     if dd.get(addr) is None:
                         dd[addr] = []
                     dd[addr].append((ser, v))
+                    self.storage.touch('txi', next_tx)
+                    changed.append(next_tx)
             # save
             self.transactions[tx_hash] = tx
+            for addr in d:
+                height = self.get_history_height(addr, tx_hash)
+                if height is not None:
+                    self.add_utxos(tx_hash, addr, height)
+            self.invalidate_balances(set(self.txi[tx_hash]) | set(d))
+            self.invalidate_history(changed)
+            self.invalidate_wallet_deltas(changed)
             print_error("Saved")
 
+    @profiled
     def remove_transaction(self, tx_hash):
+        changed = [tx_hash]
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             # tx = self.transactions.pop(tx_hash)
-            for ser, hh in self.pruned_txo.items():
-                if hh == tx_hash:
+            # drop the spends of tx whose funding transaction is unknown
+            tx = self.transactions.get(tx_hash)
+            if tx is not None:
+                prevouts = [txin['prevout_hash'] + ':%d' % txin['prevout_n']
+                             for txin in tx.inputs() if not txin.get('is_coinbase')]
+            else:
+                prevouts = self.pruned_txo.keys()
+            for ser in prevouts:
+                if self.pruned_txo.get(ser) == tx_hash:
                     self.pruned_txo.pop(ser)
-            # add tx to pruned_txo, and undo the txi addition
-            for next_tx, dd in self.txi.items():
-                for addr, l in dd.items():
-                    ll = l[:]
-                    for item in ll:
-                        ser, v = item
-                        prev_hash, prev_n = ser.split(':')
-                        if prev_hash == tx_hash:
-                            l.remove(item)
-                            self.pruned_txo[ser] = next_tx
-                    if not l:
-                        dd.pop(addr)
-                    else:
+                    self.spent_outpoints.pop(ser, None)
+            # the outputs of tx are gone, and the coins it spent are unspent again
+            for addr, l in self.txo.get(tx_hash, {}).items():
+                for n, v, is_cb in l:
+                    self.remove_utxo(tx_hash + ':%d' % n)
+                    self.remove_claim(tx_hash + ':%d' % n)
+            self.invalidate_balances(set(self.txi.get(tx_hash, {})) | set(self.txo.get(tx_hash, {})))
+            for addr, l in self.txi.get(tx_hash, {}).items():
+                for ser, v in l:
+                    self.spent_outpoints.pop(ser, None)
+                    prev_hash = ser.split(':')[0]
+                    height = self.get_history_height(addr, prev_hash)
+                    if height is not None:
+                        self.add_utxos(prev_hash, addr, height)
+            # add the outputs of tx spent by other transactions to
+            # pruned_txo, and undo their txi addition
+            for addr, l in self.txo.get(tx_hash, {}).items():
+                for n, v, is_cb in l:
+                    ser = tx_hash + ':%d' % n
+                    next_tx = self.spent_outpoints.get(ser)
+                    dd = self.txi.get(next_tx)
+                    if not dd or addr not in dd:
+                        continue
+                    l = [item for item in dd[addr] if item[0] != ser]
+                    if len(l) == len(dd[addr]):
+                        continue
+                    if l:
                         dd[addr] = l
+                    else:
+                        dd.pop(addr)
+                    self.pruned_txo[ser] = next_tx
+                    self.storage.touch('txi', next_tx)
+                    changed.append(next_tx)
             try:
                 self.txi.pop(tx_hash)
                 self.txo.pop(tx_hash)
             except KeyError:
                 self.print_error("tx was not in history", tx_hash)
+        self.invalidate_history(changed)
+        self.invalidate_wallet_deltas(changed)
 
+    @profiled
     def receive_tx_callback(self, tx_hash, tx, tx_height):
+        tx_hash = intern_str(tx_hash)
         self.add_transaction(tx_hash, tx)
-        self.save_transactions()
+        self.schedule_save()
         self.add_unverified_tx(tx_hash, tx_height)
+        item = self.unconfirmed_tx.get(tx_hash)
+        if item is not None:
+            # fee is recomputed now that the transaction is known
+            item.pop('fee', None)
 
 
+    @profiled
     def receive_history_callback(self, addr, hist):
-        with self.lock:
+        hist = compact_history(hist)
+        unconfirmed_changed = False
+        with self.lock, self.transaction_lock:
             old_hist = self.history.get(addr, [])
             for tx_hash, height in old_hist:
                 if (tx_hash, height) not in hist:
                     # remove tx if it's not referenced in histories
-                    self.tx_addr_hist[tx_hash].remove(addr)
-                    if not self.tx_addr_hist[tx_hash]:
+                    s = self.tx_addr_hist.get(tx_hash, [])
+                    if addr in s:
+                        s.remove(addr)
+                        self.storage.touch('tx_addr_hist', tx_hash)
+                    if not s:
                         self.remove_transaction(tx_hash)
+                        unconfirmed_changed |= self.update_unconfirmed_tx(tx_hash, None)
 
             self.history[addr] = hist
 
+        with self.transaction_lock:
+            tx_hashes = set(tx_hash for tx_hash, height in hist)
+            for tx_hash, height in old_hist:
+                if tx_hash not in tx_hashes:
+                    for n, v, is_cb in self.txo.get(tx_hash, {}).get(addr, []):
+                        self.remove_utxo(tx_hash + ':%d' % n)
+                        self.remove_claim(tx_hash + ':%d' % n)
+            for tx_hash, height in hist:
+                self.add_utxos(tx_hash, addr, height)
+        self.invalidate_balances([addr])
+        self.invalidate_history([tx_hash for tx_hash, height in old_hist + hist])
+
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
             self.add_unverified_tx(tx_hash, tx_height)
+            unconfirmed_changed |= self.update_unconfirmed_tx(tx_hash, tx_height)
             # add reference in tx_addr_hist
-            s = self.tx_addr_hist.get(tx_hash, set())
-            s.add(addr)
-            self.tx_addr_hist[tx_hash] = s
+            with self.transaction_lock:
+                s = self.tx_addr_hist.setdefault(tx_hash, [])
+                if addr not in s:
+                    s.append(addr)
             # if addr is new, we have to recompute txi and txo
             tx = self.transactions.get(tx_hash)
             if tx is not None and self.txi.get(tx_hash, {}).get(addr) is None and self.txo.get(tx_hash, {}).get(addr) is None:
                 self.add_transaction(tx_hash, tx)
 
+        if unconfirmed_changed:
+            self.save_unconfirmed_index()
         # Write updated TXI, TXO etc.
-        self.save_transactions()
+        self.schedule_save()
 
     def get_history(self, domain=None):
-        from collections import defaultdict
         # get domain
         if domain is None:
             domain = self.get_account_addresses(None)
 
-        # 1. Get the history of each address in the domain, maintain the
-        #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
+        # 1. Get the history of each address in the domain.  The delta of
+        #    a tx is its wallet delta if all its wallet addresses are in the
+        #    domain, else the sum of its deltas on domain addresses
+        domain = set(domain)
+        tx_hashes = set(tx_hash for addr in domain for tx_hash, height in self.get_address_history(addr))
+        whole, partial = [], []
+        for tx_hash in tx_hashes:
+            addresses = [addr for addr in self.tx_addr_hist.get(tx_hash, []) if self.is_mine(addr)]
+            (whole if domain.issuperset(addresses) else partial).append(tx_hash)
+        tx_deltas = self.get_history_deltas(whole)
+        for tx_hash in partial:
+            tx_deltas[tx_hash] = 0
+            for addr in domain.intersection(self.tx_addr_hist.get(tx_hash, [])):
                 delta = self.get_tx_delta(tx_hash, addr)
                 if delta is None or tx_deltas[tx_hash] is None:
                     tx_deltas[tx_hash] = None
@@ -976,58 +2360,255 @@ class Abstract_Wallet(PrintError):
 
         return h2
 
-    def get_name_claims(self, domain=None):
-        claims = []
+    def invalidate_history(self, tx_hashes=None):
+        """Mark the history rows of tx_hashes, or the whole history
+        index, to be recomputed on the next query."""
+        if tx_hashes is None:
+            self.history_rebuild = True
+        else:
+            self.history_dirty.update(tx_hashes)
+
+    def get_history_deltas(self, tx_hashes):
+        """Return a map from each of tx_hashes to its delta on the wallet,
+        taken from get_wallet_deltas, or None if it spends pruned
+        outputs.  Transactions not downloaded yet have a delta of 0."""
+        pruned_spenders = set(self.pruned_txo.values())
+        known = [tx_hash for tx_hash in tx_hashes
+                 if tx_hash not in pruned_spenders and tx_hash in self.transactions]
+        wallet_deltas = self.get_wallet_deltas(known)
+        deltas = {}
+        for tx_hash in tx_hashes:
+            if tx_hash in pruned_spenders:
+                deltas[tx_hash] = None
+            elif tx_hash in wallet_deltas:
+                deltas[tx_hash] = wallet_deltas[tx_hash][2]
+            else:
+                deltas[tx_hash] = 0
+        return deltas
+
+    def update_history_index(self):
+        with self.history_lock:
+            if self.history_rebuild:
+                self.history_rebuild = False
+                self.history_dirty = set()
+                self.history_pos = dict((tx_hash, self.get_txpos(tx_hash))
+                                        for tx_hash, addresses in self.tx_addr_hist.items() if addresses)
+                self.history_deltas = self.get_history_deltas(self.history_pos.keys())
+                self.history_rows = sorted((key, tx_hash) for tx_hash, key in self.history_pos.items())
+                self.history_sums = []
+                return
+            # transactions marked while this runs are handled next time
+            dirty, self.history_dirty = self.history_dirty, set()
+            rows = self.history_rows
+            first = len(rows)
+            added = []
+            for tx_hash in dirty:
+                key = self.history_pos.pop(tx_hash, None)
+                if key is not None:
+                    i = bisect.bisect_left(rows, (key, tx_hash))
+                    del rows[i]
+                    self.history_deltas.pop(tx_hash)
+                    first = min(first, i)
+                if self.tx_addr_hist.get(tx_hash):
+                    key = self.get_txpos(tx_hash)
+                    i = bisect.bisect_left(rows, (key, tx_hash))
+                    rows.insert(i, (key, tx_hash))
+                    self.history_pos[tx_hash] = key
+                    added.append(tx_hash)
+                    first = min(first, i)
+            self.history_deltas.update(self.get_history_deltas(added))
+            del self.history_sums[first:]
+
+    def get_history_sums(self, i):
+        """Return the sum of the known deltas of history rows 0 to i, and
+        the number of unknown ones."""
+        sums = self.history_sums
+        while len(sums) <= i:
+            total, unknown = sums[-1] if sums else (0, 0)
+            delta = self.history_deltas[self.history_rows[len(sums)][1]]
+            sums.append((total, unknown + 1) if delta is None else (total + delta, unknown))
+        return sums[i]
+
+    @profiled
+    def get_history_page(self, limit=None, offset=0, since_height=None, since_txid=None):
+        """Return rows of the wallet history in the format of get_history,
+        oldest first.  since_height skips the rows confirmed below that
+        height and since_txid the rows up to and including that
+        transaction; offset and limit then select a page of what is left.
+        Only the rows returned are computed, so polling for new rows does
+        not cost the size of the history."""
+        self.update_history_index()
+        c, u, x = self.get_balance()
+        with self.history_lock:
+            rows = self.history_rows
+            start = 0
+            if since_height is not None:
+                start = bisect.bisect_left(rows, ((since_height,),))
+            if since_txid is not None:
+                key = self.history_pos.get(since_txid)
+                if key is None:
+                    raise BaseException('Transaction not in wallet history: %s' % since_txid)
+                start = max(start, bisect.bisect_right(rows, (key, since_txid)))
+            start += offset
+            end = len(rows) if limit is None else min(len(rows), start + limit)
+            if start >= end:
+                return []
+            # balances are anchored at the current balance, as in get_history:
+            # a row's balance is unknown if a later row has an unknown delta
+            last_total, last_unknown = self.get_history_sums(len(rows) - 1)
+            result = []
+            for i in xrange(start, end):
+                tx_hash = rows[i][1]
+                total, unknown = self.get_history_sums(i)
+                balance = c + u + x - (last_total - total) if unknown == last_unknown else None
+                conf, timestamp = self.get_confirmations(tx_hash)
+                result.append((tx_hash, conf, self.history_deltas[tx_hash], timestamp, balance))
+        return result
+
+    @profiled
+    def get_name_claims(self, domain=None, name=None, claim_id=None, category=None,
+                        include_spent=True, expires_before=None):
+        """Return the claims, supports and updates of the wallet, read from
+        the claim registry.  Each argument that is not None narrows the
+        result: the claim name or id, the category ('claim', 'support'
+        or 'update'), and the height the claim expires before.  domain
+        selects addresses, by default those of the visible accounts."""
+        local_height = self.get_local_height()
         if domain is None:
             domain = self.get_account_addresses(None)
-
-        for addr in domain:
-            txos, txis = self.get_addr_io(addr)
-            for txo, v in txos.items():
-                tx_height, value, is_cb = v
-                prevout_hash, prevout_n = txo.split(':')
-
-                tx = self.transactions.get(prevout_hash)
-                tx.deserialize()
-                txout = tx.outputs()[int(prevout_n)]
-                if txout[0] & (TYPE_CLAIM | TYPE_UPDATE | TYPE_SUPPORT):
-                    local_height = self.network.get_local_height()
-                    expired = tx_height + lbrycrd.EXPIRATION_BLOCKS <= local_height
-                    output = {
-                        'txid': prevout_hash,
-                        'nout': int(prevout_n),
-                        'address': addr,
-                        'amount': str(Decimal(value)/lbrycrd.COIN),
-                        'height': tx_height,
-                        'expiration_height': tx_height + lbrycrd.EXPIRATION_BLOCKS,
-                        'expired': expired,
-                        'confirmations': local_height - tx_height,
-                        'is_spent': txo in txis,
-                    }
-                    if txout[0] & TYPE_CLAIM:
-                        output['category']='claim'
-                        claim_name, claim_value = txout[1][0]
-                        output['name'] = claim_name
-                        output['value'] = claim_value
-                        claim_id = lbrycrd.claim_id_hash(rev_hex(output['txid']).decode('hex'),output['nout'])
-                        claim_id = lbrycrd.encode_claim_id_hex(claim_id)
-                        output['claim_id'] = claim_id
-                    elif txout[0] & TYPE_SUPPORT:
-                        output['category']='support'
-                        claim_name, claim_id = txout[1][0]
-                        output['name'] = claim_name
-                        output['claim_id'] = lbrycrd.encode_claim_id_hex(claim_id)
-                    elif txout[0] & TYPE_UPDATE:
-                        output['category']='update'
-                        claim_name, claim_id, claim_value = txout[1][0]
-                        output['name'] = claim_name
-                        output['value'] = claim_value
-                        output['claim_id'] = lbrycrd.encode_claim_id_hex(claim_id)
-                    if not expired:
-                        output['blocks_to_expiration'] = tx_height + lbrycrd.EXPIRATION_BLOCKS - local_height
-                    claims.append(output)
+        with self.transaction_lock.read():
+            if claim_id is not None:
+                outpoints = set(self.claims_by_id.get(claim_id, ()))
+            elif name is not None:
+                outpoints = set(self.claims_by_name.get(name, ()))
+            elif expires_before is not None:
+                i = bisect.bisect_left(self.claim_expirations, (expires_before,))
+                outpoints = set(ser for h, ser in self.claim_expirations[:i])
+            else:
+                outpoints = set(self.claims)
+            domain = set(domain)
+            claims = []
+            for ser in outpoints:
+                item = self.claims[ser]
+                expiration_height = item['height'] + lbrycrd.EXPIRATION_BLOCKS
+                if (item['address'] not in domain
+                        or (name is not None and item['name'].decode('hex') != name)
+                        or (category is not None and item['category'] != category)
+                        or (expires_before is not None and not (item['height'] > 0 and expiration_height < expires_before))
+                        or (not include_spent and ser in self.spent_outpoints)):
+                    continue
+                claims.append(self.get_claim_output(ser, local_height))
+        claims.sort(key=lambda x: (x['height'], x['txid'], x['nout']))
         return claims
 
+    def get_claim_output(self, ser, local_height):
+        item = self.claims[ser]
+        tx_height = item['height']
+        expiration_height = tx_height + lbrycrd.EXPIRATION_BLOCKS
+        expired = expiration_height <= local_height
+        output = dict(item)
+        output['name'] = item['name'].decode('hex')
+        if 'value' in item:
+            output['value'] = item['value'].decode('hex')
+        output.update({
+            'amount': str(Decimal(item['amount'])/lbrycrd.COIN),
+            'expiration_height': expiration_height,
+            'expired': expired,
+            'confirmations': local_height - tx_height,
+            'is_spent': ser in self.spent_outpoints,
+        })
+        if not expired:
+            output['blocks_to_expiration'] = expiration_height - local_height
+        return output
+
+    def check_claim_expirations(self, height):
+        """Report the unspent claims that expired, or came within
+        claim_expiring_blocks of expiring, since the last call, with the
+        claim_expired and claim_expiring network events.  The first call
+        reports only the claims that are expiring.  Claims and updates
+        that are expiring are queued in claim_renewals if
+        claim_auto_renew is set.  Only the claims whose expiration height
+        was passed are visited."""
+        last = self.claim_expiry_height
+        if last is not None and height <= last:
+            # a reorg; claims are not reported twice
+            return
+        self.claim_expiry_height = height
+        self.storage.put('claim_expiry_height', height)
+        warning = self.claim_expiring_blocks
+        # expiration heights in (last, height] expired, and those in
+        # (max(last + warning, height), height + warning] are expiring
+        if last is None:
+            ranges = [('claim_expiring', height, height + warning)]
+        else:
+            ranges = [('claim_expired', last, height),
+                      ('claim_expiring', max(last + warning, height), height + warning)]
+        events = []
+        with self.transaction_lock:
+            for event, low, high in ranges:
+                i = bisect.bisect_right(self.claim_expirations, (low + 1,))
+                j = bisect.bisect_right(self.claim_expirations, (high + 1,))
+                for expiration_height, ser in self.claim_expirations[i:j]:
+                    if ser not in self.spent_outpoints:
+                        events.append((event, ser, self.get_claim_output(ser, height)))
+            renewals = [ser for event, ser, output in events
+                        if event == 'claim_expiring' and self.claim_auto_renew and output['category'] != 'support'
+                        and ser not in self.claim_renewals]
+            for ser in renewals:
+                self.claim_renewals[ser] = 0
+            if renewals:
+                self.storage.put('claim_renewals', self.claim_renewals)
+        for event, ser, output in events:
+            self.print_error(event, output['txid'], output['nout'])
+            if self.network:
+                self.network.trigger_callback(event, output)
+
+    def get_due_claim_renewals(self, pending):
+        """Outpoints of the queued claims whose next attempt is due, and
+        whose last renewal is not in pending, the hashes of the queued
+        broadcasts.  Called with self.transaction_lock held."""
+        now = time.time()
+        return [ser for ser, next_try in sorted(self.claim_renewals.items())
+                if next_try <= now and self.claim_renewal_txs.get(ser) not in pending]
+
+    def has_due_claim_renewals(self):
+        with self.lock.read():
+            pending = set(self.pending_broadcasts)
+        with self.transaction_lock.read():
+            return bool(self.get_due_claim_renewals(pending))
+
+    def get_claim_renewals(self):
+        """Return the outputs of the claims queued for renewal whose next
+        attempt is due.  Claims leave the queue once spent, by their
+        renewal or otherwise; while their renewal is queued for the
+        broadcaster they are skipped.  See reschedule_claim_renewal."""
+        local_height = self.get_local_height()
+        with self.lock.read():
+            pending = set(self.pending_broadcasts)
+        with self.transaction_lock:
+            done = [ser for ser in self.claim_renewals
+                    if ser not in self.claims or ser in self.spent_outpoints]
+            for ser in done:
+                self.claim_renewals.pop(ser)
+                self.claim_renewal_txs.pop(ser, None)
+            if done:
+                self.storage.put('claim_renewals', self.claim_renewals)
+                self.storage.put('claim_renewal_txs', self.claim_renewal_txs)
+            return [self.get_claim_output(ser, local_height) for ser in self.get_due_claim_renewals(pending)]
+
+    def reschedule_claim_renewal(self, ser, tx_hash=None):
+        """Keep a claim whose renewal was attempted queued, to be renewed
+        again after CLAIM_RENEWAL_RETRY seconds if it is not spent by
+        then.  tx_hash is the renewal sent, if any; the claim is not
+        renewed again while it is queued for the broadcaster."""
+        with self.transaction_lock:
+            if ser in self.claim_renewals:
+                self.claim_renewals[ser] = int(time.time()) + CLAIM_RENEWAL_RETRY
+                self.storage.put('claim_renewals', self.claim_renewals)
+                if tx_hash:
+                    self.claim_renewal_txs[ser] = tx_hash
+                    self.storage.put('claim_renewal_txs', self.claim_renewal_txs)
+
     def get_label(self, tx_hash):
         label = self.labels.get(tx_hash, '')
         if label is '':
@@ -1071,6 +2652,7 @@ class Abstract_Wallet(PrintError):
         klass = COIN_CHOOSERS[self.coin_chooser_name(config)]
         return klass()
 
+    @profiled
     def make_unsigned_transaction(self, coins, outputs, config, fixed_fee=None, change_addr=None, abandon_txid=None):
         # check outputs
         for type, data, value in outputs:
@@ -1122,6 +2704,17 @@ class Abstract_Wallet(PrintError):
         tx = coin_chooser.make_tx(coins, outputs, change_addrs[:max_change],
                                   fee_estimator, dust_threshold, abandon_txid=abandon_txid)
 
+        # Unconfirmed coins are spent paying the fee their unconfirmed
+        # ancestors lack, so that the miners take them together
+        if fixed_fee is None:
+            deficit = self.get_unconfirmed_fee_deficit(
+                [txin['prevout_hash'] for txin in tx.inputs()], self.fee_per_kb(config))
+            if deficit:
+                base_estimator = fee_estimator
+                fee_estimator = lambda size: base_estimator(size) + deficit
+                tx = coin_chooser.make_tx(coins, outputs, change_addrs[:max_change],
+                                          fee_estimator, dust_threshold, abandon_txid=abandon_txid)
+
         # Sort the inputs and outputs deterministically
         tx.BIP_LI01_sort()
 
@@ -1154,6 +2747,7 @@ class Abstract_Wallet(PrintError):
             txin['redeemPubkey'] = account.get_pubkey(*sequence)
             txin['num_sig'] = 1
 
+    @profiled
     def sign_transaction(self, tx, password):
         if self.is_watching_only():
             return
@@ -1175,30 +2769,90 @@ class Abstract_Wallet(PrintError):
             tx.sign(keypairs)
 
 
-    def sendtx(self, tx):
+    def sendtx(self, tx, timeout=None):
         # synchronous
         h = self.send_tx(tx)
-        self.tx_event.wait()
+        self.wait_tx(h, timeout)
         return self.receive_tx(h, tx)
 
     def send_tx(self, tx):
-        # asynchronous
-        self.tx_event.clear()
-        # fixme: this does not handle the case where server does not answer
+        # asynchronous, see wait_tx and receive_tx
         assert self.network.interface, "Not connected."
-        self.network.send([('blockchain.transaction.broadcast', [str(tx)])], self.on_broadcast)
-        return tx.hash()
-
-    def on_broadcast(self, r):
-        self.tx_result = r.get('result')
-        self.tx_event.set()
+        tx_hash = tx.hash()
+        with self.tx_waiters_lock:
+            self.tx_waiters.setdefault(tx_hash, {'event': threading.Event(), 'response': None})
+        # the broadcaster retries until the tx is seen in our history
+        self.add_pending_broadcast(tx)
+        self.network.send([('blockchain.transaction.broadcast', [str(tx)])],
+                          partial(self.on_broadcast, tx_hash))
+        return tx_hash
+
+    def on_broadcast(self, tx_hash, r):
+        with self.tx_waiters_lock:
+            waiter = self.tx_waiters.get(tx_hash)
+        # an answer arriving after receive_tx gave up is left to the broadcaster
+        if waiter is not None:
+            waiter['response'] = r
+            waiter['event'].set()
+
+    def wait_tx(self, tx_hash, timeout=None):
+        """Wait for the answer to the broadcast of tx_hash by send_tx."""
+        with self.tx_waiters_lock:
+            waiter = self.tx_waiters.get(tx_hash)
+        if waiter is not None:
+            waiter['event'].wait(timeout)
 
     def receive_tx(self, tx_hash, tx):
-        out = self.tx_result
-        if out != tx_hash:
-            return False, "error: " + out
-        run_hook('receive_tx', tx, self)
-        return True, out
+        with self.tx_waiters_lock:
+            waiter = self.tx_waiters.pop(tx_hash, None)
+        r = waiter['response'] if waiter else None
+        if r is None:
+            # the broadcaster retries
+            return False, "error: no answer from the server, the transaction will be sent again"
+        if not is_rejected(tx_hash, r):
+            run_hook('receive_tx', tx, self)
+            return True, tx_hash
+        # rejected by the server, do not retry
+        self.remove_pending_broadcast(tx_hash)
+        return False, "error: " + str(r.get('error') or r.get('result'))
+
+    def add_pending_broadcast(self, tx, next_try=None):
+        """Queue tx for the broadcaster.  By default it was just sent,
+        and is sent again after RETRY_INTERVAL seconds."""
+        now = int(time.time())
+        with self.lock:
+            self.pending_broadcasts[tx.hash()] = {
+                'tx': str(tx),
+                'first_sent': now,
+                'attempts': 0,
+                'next_try': now + RETRY_INTERVAL if next_try is None else int(next_try),
+            }
+            self.storage.put('pending_broadcasts', self.pending_broadcasts)
+
+    def remove_pending_broadcast(self, tx_hash):
+        with self.lock:
+            if self.pending_broadcasts.pop(tx_hash, None) is not None:
+                self.storage.put('pending_broadcasts', self.pending_broadcasts)
+
+    def reschedule_broadcast(self, tx_hash, next_try):
+        with self.lock:
+            item = self.pending_broadcasts.get(tx_hash)
+            if item is not None:
+                item['attempts'] += 1
+                item['next_try'] = int(next_try)
+                self.storage.put('pending_broadcasts', self.pending_broadcasts)
+
+    def get_pending_broadcasts(self):
+        '''Returns the transactions queued for rebroadcast.  'seen' is
+        True once the transaction is in the history of a wallet address.'''
+        with self.lock.read():
+            out = []
+            for tx_hash, item in self.pending_broadcasts.items():
+                d = dict(item)
+                d['txid'] = tx_hash
+                d['seen'] = bool(self.tx_addr_hist.get(tx_hash))
+                out.append(d)
+        return out
 
     def update_password(self, old_password, new_password):
         if new_password == '':
@@ -1251,6 +2905,8 @@ class Abstract_Wallet(PrintError):
             if tx_hash not in vr:
                 self.print_error("removing transaction", tx_hash)
                 self.transactions.pop(tx_hash)
+                with self.lock:
+                    self.merkle_branches.pop(tx_hash, None)
 
     def start_threads(self, network):
         self.network = network
@@ -1258,21 +2914,52 @@ class Abstract_Wallet(PrintError):
             self.prepare_for_verifier()
             self.verifier = SPV(self.network, self)
             self.synchronizer = Synchronizer(self, network)
-            network.add_jobs([self.verifier, self.synchronizer])
+            self.broadcaster = Broadcaster(self, network)
+            self.saver = WalletSaver(self)
+            self.save_interval = network.config.get('wallet_save_interval', SAVE_INTERVAL)
+            self.save_max_changes = network.config.get('wallet_save_max_changes', SAVE_MAX_CHANGES)
+            network.add_jobs([self.verifier, self.synchronizer, self.broadcaster, self.saver])
+            if network.config.get('warm_up_transactions', False):
+                self.warmup = TransactionWarmup(self)
+                network.add_jobs([self.warmup])
+            if self.unverified_indexes:
+                self.index_verifier = IndexVerifier(self)
+                network.add_jobs([self.index_verifier])
+            self.claim_expiring_blocks = network.config.get('claim_expiring_blocks', CLAIM_EXPIRING_BLOCKS)
+            self.claim_auto_renew = network.config.get('claim_auto_renew', False)
+            self.claim_monitor = ClaimExpiryMonitor(self, network)
+            network.add_jobs([self.claim_monitor])
         else:
             self.verifier = None
             self.synchronizer = None
+            self.broadcaster = None
+            self.saver = None
+            while self.verify_derived_indexes():
+                pass
 
     def stop_threads(self):
         if self.network:
-            self.network.remove_jobs([self.synchronizer, self.verifier])
+            self.network.remove_jobs([self.synchronizer, self.verifier, self.broadcaster, self.saver])
+            if self.warmup:
+                self.network.remove_jobs([self.warmup])
+                self.warmup = None
+            if self.index_verifier:
+                self.network.remove_jobs([self.index_verifier])
+                self.index_verifier = None
+            self.network.remove_jobs([self.claim_monitor])
+            self.claim_monitor = None
             self.synchronizer.release()
             self.synchronizer = None
             self.verifier = None
+            self.broadcaster = None
+            self.saver = None
             # Now no references to the syncronizer or verifier
             # remain so they will be GC-ed
             self.storage.put('stored_height', self.get_local_height())
+        if self.unsaved_changes:
+            self.save_transactions()
         self.storage.write()
+        self.storage.compact()
 
     def wait_until_synchronized(self, callback=None):
         def wait_for_wallet():
@@ -1315,6 +3002,8 @@ class Abstract_Wallet(PrintError):
 
     def add_account(self, account_id, account):
         self.accounts[account_id] = account
+        self.reindex_account(account_id)
+        self.invalidate_balances([])
         self.save_accounts()
 
     def save_accounts(self):
@@ -1322,6 +3011,15 @@ class Abstract_Wallet(PrintError):
         for k, v in self.accounts.items():
             d[k] = v.dump()
         self.storage.put('accounts', d)
+        # the saved address lists are those of the accounts, shared with
+        # the storage rather than copied on each new address
+        addresses = self.storage.get('account_addresses', {}, copy=False)
+        with self.storage.lock:
+            addresses.clear()
+            for k, v in self.accounts.items():
+                if not isinstance(v, ImportedAccount):
+                    addresses[k] = [v.receiving_addresses, v.change_addresses]
+        self.storage.put('account_addresses', addresses, copy=False)
 
     def can_import(self):
         return not self.is_watching_only()
@@ -1555,6 +3253,7 @@ class Imported_Wallet(Abstract_Wallet):
         a = self.accounts.get(IMPORTED_ACCOUNT)
         if not a:
             self.accounts[IMPORTED_ACCOUNT] = ImportedAccount({'imported':{}})
+            self.reindex_account(IMPORTED_ACCOUNT)
 
     def is_watching_only(self):
         acc = self.accounts[IMPORTED_ACCOUNT]
@@ -1666,8 +3365,11 @@ class Deterministic_Wallet(Abstract_Wallet):
         return address
 
     def add_address(self, address):
-        if address not in self.history:
-            self.history[address] = []
+        if address not in self.address_index:
+            for acc_id in self.accounts:
+                self.index_new_addresses(acc_id)
+        with self.transaction_lock:
+            self.history.setdefault(address, [])
         if self.synchronizer:
             self.synchronizer.add(address)
         self.save_accounts()
@@ -1968,7 +3670,8 @@ class Multisig_Wallet(BIP32_RD_Wallet, Mnemonic):
                 v['xpubs'] = [v['xpub'], v['xpub2'], v['xpub3']]
             elif v.get('xpub2'):
                 v['xpubs'] = [v['xpub'], v['xpub2']]
-            self.accounts = {'0': Multisig_Account(v)}
+            self.accounts = {'0': Multisig_Account(self.with_saved_addresses('0', v))}
+        self.build_address_index()
 
     def create_main_account(self):
         account = Multisig_Account({'xpubs': self.master_public_keys.values(), 'm': self.m})
@@ -2032,6 +3735,7 @@ class OldWallet(Deterministic_Wallet):
 
     def create_account(self, mpk):
         self.accounts['0'] = OldAccount({'mpk':mpk, 0:[], 1:[]})
+        self.reindex_account('0')
         self.save_accounts()
 
     def create_watching_only_wallet(self, mpk):
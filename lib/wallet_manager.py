@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+#
+# LBRYum - lightweight LBRYcrd client
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+
+from util import PrintError
+
+
+class WalletWatcher(PrintError):
+    '''Keeps the address subscriptions of a wallet that was evicted.
+
+    Only the status of each address is kept.  When the server notifies
+    a status other than the one the wallet had, on_activity is called
+    with the wallet path, once.
+    '''
+
+    def __init__(self, path, statuses, network, on_activity):
+        self.path = path
+        self.statuses = statuses
+        self.network = network
+        self.on_activity = on_activity
+        self.active = False
+        msgs = [('blockchain.address.subscribe', [addr]) for addr in statuses]
+        if msgs:
+            network.send(msgs, self.addr_subscription_response)
+
+    def diagnostic_name(self):
+        return 'WalletWatcher'
+
+    def addr_subscription_response(self, response):
+        if response.get('error') or self.active:
+            return
+        addr = response['params'][0]
+        if addr in self.statuses and self.statuses[addr] != response['result']:
+            self.print_error("activity on", addr)
+            self.active = True
+            self.on_activity(self.path)
+
+    def release(self):
+        self.network.unsubscribe(self.addr_subscription_response)
+
+
+class WalletManager(PrintError):
+    '''The wallets loaded by the daemon, least recently used first.
+
+    Once there are more than max_wallets wallets, or their transactions
+    add up to more than max_transactions, the least recently used ones
+    are evicted: their threads are stopped, which saves them, and a
+    WalletWatcher keeps their addresses subscribed.  A wallet with
+    activity is queued to be loaded again, see pop_active.  Wallets
+    with pending broadcasts are not evicted, nor wallets pinned by a
+    user that holds on to them, such as a window or a running command.
+
+    Either limit may be None.  The network shares the headers and a
+    cache of raw transactions between all the wallets.
+    '''
+
+    def __init__(self, network, max_wallets=None, max_transactions=None):
+        self.network = network
+        self.max_wallets = max_wallets
+        self.max_transactions = max_transactions
+        self.wallets = OrderedDict()
+        self.watchers = {}
+        # paths of evicted wallets with activity, oldest first
+        self.active = OrderedDict()
+        # path -> number of pins of the wallet, see pin
+        self.pins = {}
+        self.lock = threading.RLock()
+
+    def diagnostic_name(self):
+        return 'WalletManager'
+
+    def __contains__(self, path):
+        return path in self.wallets
+
+    def __len__(self):
+        return len(self.wallets)
+
+    def items(self):
+        with self.lock:
+            return self.wallets.items()
+
+    def get(self, path, pin=False):
+        '''Return the wallet at path if it is loaded, and mark it as the
+        most recently used.  With pin, the wallet is also pinned.'''
+        with self.lock:
+            wallet = self.wallets.pop(path, None)
+            if wallet is not None:
+                self.wallets[path] = wallet
+                if pin:
+                    self.pin(path)
+            return wallet
+
+    def add(self, path, wallet, pin=False):
+        '''Add a loaded wallet whose threads are started, and evict the
+        least recently used wallets over the limits.  With pin, the
+        wallet is pinned before others are evicted.'''
+        with self.lock:
+            watcher = self.watchers.pop(path, None)
+            if watcher:
+                watcher.release()
+            self.active.pop(path, None)
+            self.wallets[path] = wallet
+            if pin:
+                self.pin(path)
+            self.evict()
+
+    def pin(self, path):
+        '''Keep the wallet at path from being evicted until unpin is
+        called as many times.'''
+        with self.lock:
+            self.pins[path] = self.pins.get(path, 0) + 1
+
+    def unpin(self, path):
+        with self.lock:
+            n = self.pins.pop(path, 0) - 1
+            if n > 0:
+                self.pins[path] = n
+            self.evict()
+
+    def over_limits(self):
+        if self.max_wallets is not None and len(self.wallets) > self.max_wallets:
+            return True
+        if self.max_transactions is not None:
+            return sum(len(w.transactions) for w in self.wallets.values()) > self.max_transactions
+        return False
+
+    def evict(self):
+        '''Evict the least recently used wallets over the limits.  Also
+        called from the daemon loop, as wallets whose broadcasts were
+        sent or dropped become evictable.'''
+        with self.lock:
+            if not self.over_limits():
+                return
+            # the most recently used wallet is never evicted
+            candidates = [path for path, wallet in self.wallets.items()[:-1]
+                          if path not in self.pins and not wallet.get_pending_broadcasts()]
+            while candidates and self.over_limits():
+                self.evict_wallet(candidates.pop(0))
+
+    def evict_wallet(self, path):
+        with self.lock:
+            wallet = self.wallets.pop(path)
+            statuses = dict((addr, wallet.get_status(wallet.get_address_history(addr)))
+                            for addr in wallet.addresses(True))
+            wallet.stop_threads()
+            self.print_error("evicted", path)
+            if self.network:
+                self.watchers[path] = WalletWatcher(path, statuses, self.network, self.set_active)
+
+    def set_active(self, path):
+        with self.lock:
+            if path in self.watchers:
+                self.active[path] = True
+
+    def pop_active(self):
+        '''Return the path of the evicted wallet that first had activity,
+        or None.'''
+        with self.lock:
+            if self.active:
+                return self.active.popitem(last=False)[0]
+
+    def stop(self):
+        with self.lock:
+            for path, wallet in self.wallets.items():
+                wallet.stop_threads()
+            for watcher in self.watchers.values():
+                watcher.release()
+            self.watchers = {}
+            self.active.clear()
+            self.pins = {}
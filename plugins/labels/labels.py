@@ -119,13 +119,14 @@ class LabelsPlugin(BasePlugin):
                     continue
                 result[key] = value
 
-            for key, value in result.items():
-                if force or not wallet.labels.get(key):
-                    wallet.labels[key] = value
+            with wallet.storage.lock:
+                for key, value in result.items():
+                    if force or not wallet.labels.get(key):
+                        wallet.labels[key] = value
 
             self.print_error("received %d labels" % len(response))
             # do not write to disk because we're in a daemon thread
-            wallet.storage.put('labels', wallet.labels)
+            wallet.storage.put('labels', wallet.labels, copy=False)
             self.set_nonce(wallet, response["nonce"] + 1)
             self.on_pulled(wallet)
 